@@ -200,6 +200,15 @@ public function destroy($jobId)
         // Also delete from legacy Redis key format
         $redis->del("job:{$jobId}");
         
+        // Final output indexed by the downloader (the converted file for
+        // download -> convert jobs), kept after the job hash expires
+        $indexedOutput = $redis->get("download:output:{$jobId}");
+        if ($indexedOutput && is_file($indexedOutput)) {
+            @unlink($indexedOutput);
+            $filesDeleted[] = $indexedOutput;
+        }
+        $redis->del("download:output:{$jobId}");
+        
         // Delete cached thumbnail
         $thumbnailPath = $storagePath . '/thumbnails/' . $jobId . '.jpg';
         if (file_exists($thumbnailPath)) {
@@ -221,8 +230,12 @@ public function destroy($jobId)
             $filesDeleted[] = $previewCachePath;
         }
         
-        // Clean up downloads folder - any file starting with job_id
+        // Clean up downloads folder - any file starting with job_id. New downloads
+        // live in downloads/ab/cd/ from sha1(job_id), as in the downloader's
+        // get_download_dir(); older ones directly in downloads/
+        $hash = sha1($jobId);
         $downloadDirs = [
+            $storagePath . '/downloads/' . substr($hash, 0, 2) . '/' . substr($hash, 2, 2),
             $storagePath . '/downloads',
             $storagePath . '/converted',
             $storagePath . '/torrents',
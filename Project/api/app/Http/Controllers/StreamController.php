@@ -60,7 +60,7 @@ public function preview(Request $request)
         try {
             $response = Http::timeout(60)->post("{$this->streamerUrl}/preview", [
                 'file_path' => $request->file_path,
-                'start_time' => $request->start_time ?? '00:00:00',
+                'start_time' => $request->start_time ?? 'auto',
                 'duration' => $request->duration ?? 30,
             ]);
 
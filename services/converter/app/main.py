@@ -3,20 +3,28 @@ AllOne Converter - Conversion Microservice
 Handles video/audio conversion using FFmpeg
 """
 import os
+import sys
 import uuid
+import socket
 import asyncio
-import subprocess
 import json
+import time
+import hmac
+import shutil
+import hashlib
+import csv
+from collections import OrderedDict
 from datetime import datetime, timezone
-from typing import Optional
-from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File, Form
+from typing import Optional, List
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Header, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, FileResponse
+from starlette.requests import ClientDisconnect
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
-import redis
+import redis.asyncio as aioredis
+import httpx
 import aiofiles
-import pusher
 
 
 class Settings(BaseSettings):
@@ -28,6 +36,41 @@ class Settings(BaseSettings):
     pusher_secret: str = "allone-secret"
     pusher_host: str = "websocket"
     pusher_port: int = 6001
+    pusher_timeout: float = 5.0
+    redis_max_connections: int = 50
+    redis_socket_timeout: float = 10.0
+    # Worker pool: "api" only enqueues, "worker" only consumes, "all" does both
+    converter_role: str = "all"
+    worker_slots: int = 0  # CPU slots per worker, 0 = number of available cores
+    job_lease_seconds: int = 60
+    # Progress throttling: per-job minimum interval (s) and change (%) between updates
+    progress_min_interval: float = 1.0
+    progress_min_delta: float = 1.0
+    progress_flush_interval: float = 0.5
+    # Content-addressed cache of conversion outputs
+    conversion_cache_enabled: bool = True
+    conversion_cache_max_bytes: int = 20 * 1024 ** 3
+    # Segmented encoding: long inputs are cut on keyframes and encoded in parallel
+    segment_min_duration: float = 600  # seconds; inputs at least this long are segmented
+    segment_target_seconds: float = 60
+    # A segmented job fails when no chunk finishes for this many job leases
+    segment_stall_leases: int = 10
+    # ffprobe results: in-process LRU entries and shared Redis TTL (s)
+    probe_cache_size: int = 512
+    probe_cache_ttl: int = 86400
+    # Uploads
+    max_upload_bytes: int = 10 * 1024 ** 3
+    upload_session_ttl: int = 86400
+    # Adaptive encoding policy: trade speed for quality to meet this turnaround (s)
+    encoding_policy_enabled: bool = True
+    encoding_target_turnaround: float = 900
+    # Streamer frame analysis picks job thumbnails; past the timeout (0 disables
+    # it) the thumbnail falls back to the frame at 1s
+    streamer_service_url: str = "http://streamer:8000"
+    thumbnail_analysis_timeout: float = 5
+    # Terminal job events (completed/failed) kept in the Redis Stream that
+    # drives other services' pipelines
+    events_stream_maxlen: int = 10000
     
     class Config:
         env_file = ".env"
@@ -45,21 +88,95 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Redis connection
-redis_client = redis.Redis(
-    host=settings.redis_host,
-    port=settings.redis_port,
-    decode_responses=True
+# Redis connection (async, pooled). The socket timeout must stay above the
+# BLMOVE block time used by the worker loop.
+redis_client = aioredis.Redis(
+    connection_pool=aioredis.ConnectionPool(
+        host=settings.redis_host,
+        port=settings.redis_port,
+        decode_responses=True,
+        max_connections=settings.redis_max_connections,
+        socket_timeout=settings.redis_socket_timeout,
+        socket_connect_timeout=2,
+        socket_keepalive=True,
+        health_check_interval=30,
+        retry_on_timeout=True
+    )
 )
 
+
+class AsyncPusher:
+    """Async client for the Pusher HTTP API (Soketi compatible)
+    
+    Uses one keep-alive httpx client so triggers don't pay a TCP handshake
+    each time, and bounded timeouts so a slow Soketi can't stall callers.
+    """
+    
+    def __init__(self, app_id: str, key: str, secret: str, host: str,
+                 port: int, ssl: bool = False, timeout: float = 5.0):
+        self.app_id = app_id
+        self.key = key
+        self.secret = secret
+        scheme = "https" if ssl else "http"
+        self.client = httpx.AsyncClient(
+            base_url=f"{scheme}://{host}:{port}",
+            timeout=httpx.Timeout(timeout, connect=2.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10,
+                                keepalive_expiry=30)
+        )
+    
+    def _sign(self, path: str, body: bytes) -> dict:
+        params = {
+            "auth_key": self.key,
+            "auth_timestamp": str(int(time.time())),
+            "auth_version": "1.0",
+            "body_md5": hashlib.md5(body).hexdigest()
+        }
+        query = "&".join(f"{k}={params[k]}" for k in sorted(params))
+        string_to_sign = f"POST\n{path}\n{query}"
+        params["auth_signature"] = hmac.new(
+            self.secret.encode(), string_to_sign.encode(), hashlib.sha256
+        ).hexdigest()
+        return params
+    
+    async def _post(self, path: str, payload: dict):
+        body = json.dumps(payload).encode()
+        response = await self.client.post(
+            path,
+            content=body,
+            params=self._sign(path, body),
+            headers={"Content-Type": "application/json"}
+        )
+        response.raise_for_status()
+    
+    async def trigger(self, channel: str, event_name: str, data: dict):
+        await self._post(f"/apps/{self.app_id}/events", {
+            "name": event_name,
+            "channels": [channel],
+            "data": json.dumps(data)
+        })
+    
+    async def trigger_batch(self, events: list):
+        await self._post(f"/apps/{self.app_id}/batch_events", {
+            "batch": [
+                {"channel": e["channel"], "name": e["name"], "data": json.dumps(e["data"])}
+                for e in events
+            ]
+        })
+    
+    async def aclose(self):
+        await self.client.aclose()
+
+
 # Pusher client for broadcasting
-pusher_client = pusher.Pusher(
+pusher_client = AsyncPusher(
     app_id=settings.pusher_app_id,
     key=settings.pusher_key,
     secret=settings.pusher_secret,
     host=settings.pusher_host,
     port=settings.pusher_port,
-    ssl=False
+    ssl=False,
+    timeout=settings.pusher_timeout
 )
 
 
@@ -68,6 +185,8 @@ class ConversionRequest(BaseModel):
     output_format: str
     ffmpeg_params: Optional[str] = None
     job_id: Optional[str] = None
+    segmented: Optional[bool] = None  # None = automatic, based on input duration
+    cache: bool = True  # False always encodes (e.g. benchmarks)
 
 
 class ConversionStatus(BaseModel):
@@ -76,83 +195,182 @@ class ConversionStatus(BaseModel):
     progress: float
     output_path: Optional[str] = None
     error: Optional[str] = None
+    strategy: Optional[str] = None  # copy, copy_video, copy_audio, encode
+
+
+class BatchConversionRequest(BaseModel):
+    input_path: str
+    profiles: List[str]
+    batch_id: Optional[str] = None
+
+
+class UploadSessionRequest(BaseModel):
+    filename: str
+    size: int
 
 
 CONVERSION_PROFILES = {
     "youtube_hd": {
         "name": "YouTube HD (MP4)",
         "extension": "mp4",
-        "params": "-c:v libx264 -preset fast -crf 23 -c:a aac -b:a 192k -vf scale=1920:1080"
+        "params": "-c:v libx264 -preset fast -crf 23 -c:a aac -b:a 192k -vf scale=1920:1080",
+        "cost": 4,
+        "targets": {"video_codec": "h264", "width": 1920, "height": 1080, "audio_codec": "aac"}
     },
     "instagram_story": {
         "name": "Instagram Story (MP4)",
         "extension": "mp4",
-        "params": "-c:v libx264 -preset fast -crf 25 -c:a aac -b:a 128k -vf scale=1080:1920"
+        "params": "-c:v libx264 -preset fast -crf 25 -c:a aac -b:a 128k -vf scale=1080:1920",
+        "cost": 4,
+        "targets": {"video_codec": "h264", "width": 1080, "height": 1920, "audio_codec": "aac"}
     },
     "audio_mp3": {
         "name": "Áudio MP3",
         "extension": "mp3",
-        "params": "-vn -ar 44100 -ac 2 -b:a 192k"
+        "params": "-vn -ar 44100 -ac 2 -b:a 192k",
+        "cost": 1,
+        "targets": {"audio_codec": "mp3", "sample_rate": 44100, "channels": 2}
     },
     "gif": {
         "name": "GIF Animado",
         "extension": "gif",
-        "params": "-vf scale=480:-1 -r 10"
+        "params": "-vf scale=480:-1 -r 10",
+        "cost": 2
     },
     "hls": {
         "name": "HLS Streaming",
         "extension": "m3u8",
-        "params": "-c:v libx264 -c:a aac -f hls -hls_time 4 -hls_list_size 0 -hls_segment_filename"
+        "params": "-c:v libx264 -c:a aac -f hls -hls_time 4 -hls_list_size 0 -hls_segment_filename",
+        "cost": 4
     },
     "webm": {
         "name": "WebM (VP9)",
         "extension": "webm",
-        "params": "-c:v libvpx-vp9 -crf 30 -b:v 0 -c:a libopus"
+        "params": "-c:v libvpx-vp9 -crf 30 -b:v 0 -c:a libopus",
+        "cost": 6,
+        "targets": {"video_codec": "vp9", "audio_codec": "opus"}
     },
     "thumbnail": {
         "name": "Thumbnail",
         "extension": "jpg",
-        "params": "-ss 00:00:01 -vframes 1 -vf scale=320:180"
+        "params": "-ss 00:00:01 -vframes 1 -vf scale=320:180",
+        "cost": 1
     }
 }
 
 
+# Cost of a custom ffmpeg_params job, in CPU slots
+DEFAULT_JOB_COST = 2
+
+QUEUE_KEY = "conversion:queue"
+PROCESSING_KEY = "conversion:processing"
+# Completed/failed jobs, consumed by the downloader's pipeline orchestrator
+EVENTS_STREAM_KEY = "conversion:events"
+TERMINAL_STATUSES = ("completed", "failed")
+
+
 def get_job_key(job_id: str) -> str:
     return f"conversion:job:{job_id}"
 
 
-def broadcast_job_update(job_id: str, status: str, progress: float = 0,
-                         file_name: str = None, error: str = None,
-                         thumbnail: str = None, output_path: str = None):
+def get_lease_key(job_id: str) -> str:
+    return f"conversion:lease:{job_id}"
+
+
+def get_worker_slots() -> int:
+    """Number of CPU slots this worker may fill with ffmpeg threads"""
+    if settings.worker_slots > 0:
+        return settings.worker_slots
+    try:
+        # Respects cpusets/affinity set by the container runtime
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class CapacityPool:
+    """Tracks the CPU slots held by running conversions on this worker"""
+    
+    def __init__(self, total: int):
+        self.total = total
+        self.used = 0
+        self.running = 0
+        self._cond = asyncio.Condition()
+    
+    async def wait_available(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.used < self.total)
+    
+    async def acquire(self, cost: int) -> int:
+        """Block until `cost` slots are free; returns the slots actually held"""
+        cost = max(1, min(cost, self.total))
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.used + cost <= self.total)
+            self.used += cost
+            self.running += 1
+        return cost
+    
+    async def release(self, cost: int):
+        async with self._cond:
+            self.used -= cost
+            self.running -= 1
+            self._cond.notify_all()
+
+
+capacity_pool = CapacityPool(get_worker_slots())
+worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+# Running jobs and thumbnails; the loop only holds weak references to tasks
+background_tasks = set()
+
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def build_job_event(job_id: str, status: str, progress: float = 0,
+                    file_name: str = None, error: str = None,
+                    thumbnail: str = None, output_path: str = None) -> dict:
+    """Build the job.updated payload sent to the frontend"""
+    # Convert thumbnail path to URL if it exists
+    thumbnail_url = None
+    if thumbnail:
+        filename = os.path.basename(thumbnail)
+        thumbnail_url = f"http://localhost:8080/api/thumbnails/{filename}"
+    
+    return {
+        "job_id": job_id,
+        "type": "conversion",
+        "status": status,
+        "progress": int(progress),
+        "file_name": file_name,
+        "error": error,
+        "metadata": {
+            "thumbnail": thumbnail_url,
+            "output_path": output_path
+        } if thumbnail_url or output_path else None,
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+
+
+async def broadcast_job_update(job_id: str, status: str, progress: float = 0,
+                               file_name: str = None, error: str = None,
+                               thumbnail: str = None, output_path: str = None):
     """Broadcast job update via Pusher/Soketi"""
     try:
-        # Convert thumbnail path to URL if it exists
-        thumbnail_url = None
-        if thumbnail:
-            filename = os.path.basename(thumbnail)
-            thumbnail_url = f"http://localhost:8080/api/thumbnails/{filename}"
-        
-        event_data = {
-            "job_id": job_id,
-            "type": "conversion",
-            "status": status,
-            "progress": int(progress),
-            "file_name": file_name,
-            "error": error,
-            "metadata": {
-                "thumbnail": thumbnail_url,
-                "output_path": output_path
-            } if thumbnail_url or output_path else None,
-            "timestamp": datetime.now(timezone.utc).isoformat()
-        }
-        pusher_client.trigger('jobs', 'job.updated', event_data)
+        event_data = build_job_event(job_id, status, progress, file_name,
+                                     error, thumbnail, output_path)
+        await pusher_client.trigger('jobs', 'job.updated', event_data)
     except Exception as e:
         print(f"Failed to broadcast job update: {e}")
 
 
-def update_job_status(job_id: str, status: str, progress: float = 0, 
-                      output_path: str = None, error: str = None,
-                      thumbnail: str = None, title: str = None):
+async def update_job_status(job_id: str, status: str, progress: float = 0, 
+                            output_path: str = None, error: str = None,
+                            thumbnail: str = None, title: str = None):
     """Update job status in Redis and broadcast via WebSocket"""
     job_data = {
         "job_id": job_id,
@@ -168,14 +386,19 @@ def update_job_status(job_id: str, status: str, progress: float = 0,
     if title:
         job_data["title"] = title
     
-    redis_client.hset(get_job_key(job_id), mapping=job_data)
-    redis_client.expire(get_job_key(job_id), 86400)  # 24h expiry
-    
-    # Publish status update to Redis (for backward compatibility)
-    redis_client.publish(f"conversion:status:{job_id}", json.dumps(job_data))
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(get_job_key(job_id), mapping=job_data)
+        pipe.expire(get_job_key(job_id), 86400)  # 24h expiry
+        # Publish status update to Redis (for backward compatibility)
+        pipe.publish(f"conversion:status:{job_id}", json.dumps(job_data))
+        # Unlike pub/sub, stream entries wait for consumers that are down
+        if status in TERMINAL_STATUSES:
+            pipe.xadd(EVENTS_STREAM_KEY, job_data, maxlen=settings.events_stream_maxlen,
+                      approximate=True)
+        await pipe.execute()
     
     # Broadcast via Pusher/WebSocket for real-time updates
-    broadcast_job_update(
+    await broadcast_job_update(
         job_id=job_id,
         status=status,
         progress=progress,
@@ -186,28 +409,594 @@ def update_job_status(job_id: str, status: str, progress: float = 0,
     )
 
 
-def get_video_duration(input_path: str) -> float:
-    """Get video duration using ffprobe"""
+class ProgressAggregator:
+    """Coalesces per-frame ffmpeg progress into throttled, batched updates
+    
+    Progress reports only record the latest value per job. A background loop
+    flushes them with one Redis pipeline and Pusher batch triggers, skipping
+    jobs that changed too little or were updated too recently. Terminal
+    states bypass the aggregator and go out immediately via update_job_status.
+    """
+    
+    # Pusher accepts at most 10 events per batch trigger
+    PUSHER_BATCH_SIZE = 10
+    
+    def __init__(self, min_interval: float, min_delta: float, flush_interval: float):
+        self.min_interval = min_interval
+        self.min_delta = min_delta
+        self.flush_interval = flush_interval
+        self.pending = {}  # job_id -> latest progress
+        self.last_sent = {}  # job_id -> (monotonic time, progress)
+        self._lock = asyncio.Lock()
+    
+    def report(self, job_id: str, progress: float):
+        self.pending[job_id] = progress
+    
+    async def finish(self, job_id: str):
+        """Drop a job's pending updates before its terminal state is written"""
+        async with self._lock:
+            self.pending.pop(job_id, None)
+            self.last_sent.pop(job_id, None)
+    
+    def _take_due(self) -> dict:
+        now = time.monotonic()
+        due = {}
+        for job_id, progress in list(self.pending.items()):
+            last = self.last_sent.get(job_id)
+            if last and (now - last[0] < self.min_interval or
+                         abs(progress - last[1]) < self.min_delta):
+                continue
+            due[job_id] = progress
+            self.last_sent[job_id] = (now, progress)
+            del self.pending[job_id]
+        return due
+    
+    async def _write(self, due: dict):
+        events = []
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for job_id, progress in due.items():
+                job_data = {"job_id": job_id, "status": "processing", "progress": progress}
+                pipe.hset(get_job_key(job_id), mapping=job_data)
+                pipe.expire(get_job_key(job_id), 86400)
+                pipe.publish(f"conversion:status:{job_id}", json.dumps(job_data))
+                events.append({
+                    "channel": "jobs",
+                    "name": "job.updated",
+                    "data": build_job_event(job_id, "processing", progress)
+                })
+            await pipe.execute()
+        
+        batches = [events[i:i + self.PUSHER_BATCH_SIZE]
+                   for i in range(0, len(events), self.PUSHER_BATCH_SIZE)]
+        results = await asyncio.gather(
+            *(pusher_client.trigger_batch(batch) for batch in batches),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Failed to broadcast progress batch: {result}")
+    
+    async def flush(self):
+        async with self._lock:
+            due = self._take_due()
+            if due:
+                await self._write(due)
+    
+    async def run(self):
+        while True:
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Progress flush failed: {e}")
+            await asyncio.sleep(self.flush_interval)
+
+
+progress_aggregator = ProgressAggregator(
+    settings.progress_min_interval,
+    settings.progress_min_delta,
+    settings.progress_flush_interval
+)
+
+
+# ===========================================
+# Conversion result cache
+# ===========================================
+# Outputs are stored under cache/conversions keyed by sha256(input content +
+# normalized params). Hits are hard-linked into the job's output path.
+
+HASH_XATTR = "user.allone.sha256"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+CACHE_ENTRIES_KEY = "conversion:cache:entries"
+CACHE_LRU_KEY = "conversion:cache:lru"
+CACHE_BYTES_KEY = "conversion:cache:bytes"
+CACHE_STATS_KEY = "conversion:cache:stats"
+
+
+def get_inflight_key(cache_key: str) -> str:
+    return f"conversion:cache:inflight:{cache_key}"
+
+
+def get_waiters_key(cache_key: str) -> str:
+    return f"conversion:cache:waiters:{cache_key}"
+
+
+def get_hash_sidecar_path(path: str) -> str:
+    name = hashlib.md5(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(settings.storage_path, "cache", "hashes", f"{name}.json")
+
+
+def file_stamp(st: os.stat_result) -> str:
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def read_stored_hash(path: str, stamp: str) -> Optional[str]:
+    """Return the stored content hash if it still matches the file's size/mtime"""
     try:
-        result = subprocess.run([
-            "ffprobe", "-v", "error", "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1", input_path
-        ], capture_output=True, text=True)
-        return float(result.stdout.strip())
-    except:
+        value = os.getxattr(path, HASH_XATTR).decode()
+        stored_stamp, digest = value.rsplit(":", 1)
+        if stored_stamp == stamp:
+            return digest
+    except (OSError, AttributeError, ValueError):
+        pass
+    
+    try:
+        with open(get_hash_sidecar_path(path)) as f:
+            sidecar = json.load(f)
+        if sidecar.get("stamp") == stamp:
+            return sidecar.get("sha256")
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def store_content_hash(path: str, digest: str):
+    """Remember a file's hash in an xattr, or a sidecar file if xattrs are unsupported"""
+    stamp = file_stamp(os.stat(path))
+    try:
+        os.setxattr(path, HASH_XATTR, f"{stamp}:{digest}".encode())
+        return
+    except (OSError, AttributeError):
+        pass
+    
+    sidecar_path = get_hash_sidecar_path(path)
+    os.makedirs(os.path.dirname(sidecar_path), exist_ok=True)
+    with open(sidecar_path, "w") as f:
+        json.dump({"path": path, "stamp": stamp, "sha256": digest}, f)
+
+
+def hash_file(path: str) -> str:
+    """sha256 of a file's content, read in chunks; blocking, call via to_thread"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def compute_content_hash(path: str) -> str:
+    """Stored content hash of a file, hashing it when missing or stale"""
+    stamp = file_stamp(os.stat(path))
+    digest = read_stored_hash(path, stamp)
+    if digest:
+        return digest
+    
+    digest = hash_file(path)
+    store_content_hash(path, digest)
+    return digest
+
+
+def lookup_content_hash(path: str) -> Optional[str]:
+    """Stored content hash of a file, or None when it would have to be read"""
+    return read_stored_hash(path, file_stamp(os.stat(path)))
+
+
+def get_conversion_cache_key(content_hash: str, extension: str, params: str) -> str:
+    normalized = " ".join(params.split())
+    return hashlib.sha256(f"{content_hash}|{extension}|{normalized}".encode()).hexdigest()
+
+
+def get_cache_object_path(cache_key: str, extension: str) -> str:
+    return os.path.join(settings.storage_path, "cache", "conversions",
+                        cache_key[:2], f"{cache_key}.{extension}")
+
+
+def link_or_copy(src: str, dst: str):
+    """Hard-link src to dst, copying when they live on different filesystems
+    
+    Raises FileExistsError instead of overwriting an existing dst.
+    """
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        raise
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+async def drop_cache_entry(cache_key: str) -> int:
+    """Forget a cache entry; returns the bytes released"""
+    entry = await redis_client.hget(CACHE_ENTRIES_KEY, cache_key)
+    if not entry or not await redis_client.hdel(CACHE_ENTRIES_KEY, cache_key):
         return 0
+    await redis_client.zrem(CACHE_LRU_KEY, cache_key)
+    entry = json.loads(entry)
+    await redis_client.decrby(CACHE_BYTES_KEY, entry["size"])
+    try:
+        await asyncio.to_thread(os.remove, entry["path"])
+    except OSError:
+        pass
+    return entry["size"]
 
 
-def get_media_info(input_path: str) -> dict:
-    """Get media information using ffprobe"""
+async def link_cached_output(cache_key: str, output_path: str) -> bool:
+    """Materialize a cached result at output_path; False on a miss"""
+    entry = await redis_client.hget(CACHE_ENTRIES_KEY, cache_key)
+    if not entry:
+        return False
+    entry = json.loads(entry)
     try:
-        result = subprocess.run([
-            "ffprobe", "-v", "quiet", "-print_format", "json",
-            "-show_format", "-show_streams", input_path
-        ], capture_output=True, text=True)
-        return json.loads(result.stdout)
-    except Exception as e:
-        return {"error": str(e)}
+        intact = os.path.getsize(entry["path"]) == entry["size"]
+    except OSError:
+        intact = False
+    if not intact:
+        # Evicted, removed or truncated underneath us
+        await drop_cache_entry(cache_key)
+        return False
+    try:
+        try:
+            await asyncio.to_thread(link_or_copy, entry["path"], output_path)
+        except FileExistsError:
+            # Left by an earlier attempt at this job: replace it
+            os.unlink(output_path)
+            await asyncio.to_thread(link_or_copy, entry["path"], output_path)
+    except OSError as e:
+        # The cached copy is fine; convert this job normally instead
+        print(f"Could not link cached output to {output_path}: {e}")
+        return False
+    await redis_client.zadd(CACHE_LRU_KEY, {cache_key: time.time()})
+    return True
+
+
+async def evict_cache_entries():
+    """Evict least recently used entries until the cache fits its byte budget"""
+    total = int(await redis_client.get(CACHE_BYTES_KEY) or 0)
+    while total > settings.conversion_cache_max_bytes:
+        oldest = await redis_client.zrange(CACHE_LRU_KEY, 0, 0)
+        if not oldest:
+            break
+        released = await drop_cache_entry(oldest[0])
+        if released:
+            await redis_client.hincrby(CACHE_STATS_KEY, "evictions", 1)
+            await redis_client.hincrby(CACHE_STATS_KEY, "evicted_bytes", released)
+        else:
+            await redis_client.zrem(CACHE_LRU_KEY, oldest[0])
+        total = int(await redis_client.get(CACHE_BYTES_KEY) or 0)
+
+
+async def store_cached_output(cache_key: str, output_path: str):
+    """Add a finished output to the cache"""
+    extension = os.path.splitext(output_path)[1].lstrip(".")
+    object_path = get_cache_object_path(cache_key, extension)
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    try:
+        await asyncio.to_thread(link_or_copy, output_path, object_path)
+    except FileExistsError:
+        pass
+    size = os.path.getsize(object_path)
+    
+    entry = json.dumps({"path": object_path, "size": size})
+    if await redis_client.hsetnx(CACHE_ENTRIES_KEY, cache_key, entry):
+        await redis_client.incrby(CACHE_BYTES_KEY, size)
+    await redis_client.zadd(CACHE_LRU_KEY, {cache_key: time.time()})
+    await evict_cache_entries()
+
+
+async def complete_from_cache(job_id: str, cache_key: str, output_path: str,
+                              title: str = None) -> bool:
+    if not await link_cached_output(cache_key, output_path):
+        return False
+    await redis_client.hincrby(CACHE_STATS_KEY, "hits", 1)
+    await update_job_status(job_id, "completed", 100, output_path, title=title)
+    return True
+
+
+async def finish_cache_leader(cache_key: str, success: bool, output_path: str,
+                              error: str = None):
+    """Publish the leader's result and resolve every job waiting on the same key"""
+    if success:
+        try:
+            await store_cached_output(cache_key, output_path)
+        except OSError as e:
+            print(f"Failed to cache conversion output: {e}")
+    await redis_client.delete(get_inflight_key(cache_key))
+    
+    while True:
+        waiter_id = await redis_client.spop(get_waiters_key(cache_key))
+        if not waiter_id:
+            break
+        spec = await load_job_spec(waiter_id)
+        if not spec:
+            continue
+        if success and await complete_from_cache(waiter_id, cache_key,
+                                                 spec["output_path"], spec.get("title")):
+            continue
+        if success:
+            # Output could not be cached; run the waiter as a normal job
+            spec.pop("cache_key", None)
+            await enqueue_job(waiter_id, spec)
+        else:
+            await update_job_status(waiter_id, "failed", 0,
+                                    error=error or "Conversion failed")
+
+
+async def claim_or_wait(job_id: str, cache_key: str, spec: dict) -> str:
+    """Single-flight per cache key: returns "hit", "leader" or "waiting"
+    
+    The first job for a key becomes the leader and is queued normally. Later
+    jobs register as waiters and are completed from the cache by the leader.
+    """
+    title = spec.get("title")
+    while True:
+        if await complete_from_cache(job_id, cache_key, spec["output_path"], title):
+            return "hit"
+        
+        if await redis_client.set(get_inflight_key(cache_key), job_id, nx=True, ex=6 * 3600):
+            await redis_client.hincrby(CACHE_STATS_KEY, "misses", 1)
+            return "leader"
+        
+        await redis_client.hset(get_job_key(job_id), "spec", json.dumps(spec))
+        await redis_client.sadd(get_waiters_key(cache_key), job_id)
+        
+        # The leader may have finished between our checks; if we can still
+        # remove ourselves from the waiters, nobody will resolve us
+        if await redis_client.exists(get_inflight_key(cache_key)):
+            await redis_client.hincrby(CACHE_STATS_KEY, "coalesced", 1)
+            return "waiting"
+        if not await redis_client.srem(get_waiters_key(cache_key), job_id):
+            return "waiting"
+
+
+async def claim_batch_output(job_id: str, output: dict, input_path: str, title: str,
+                             content_hash: str) -> bool:
+    """Claim a batch output's cache key; True when the batch must encode it"""
+    output["cache_key"] = get_conversion_cache_key(content_hash, output["extension"],
+                                                   output["params"])
+    spec = {
+        "input_path": input_path,
+        "output_path": output["output_path"],
+        "params": output["params"],
+        "title": title,
+        "cost": CONVERSION_PROFILES[output["profile"]]["cost"]
+    }
+    return await claim_or_wait(job_id, output["cache_key"], spec) == "leader"
+
+
+async def claim_deferred_cache(job_id: str, spec: dict) -> bool:
+    """Hash a dequeued job's input and claim its cache key(s) on the worker
+    
+    Returns False when nothing is left to encode: the result was cached or
+    another job is producing it. Batches drop the outputs they don't own.
+    """
+    spec.pop("cache_deferred")
+    try:
+        content_hash = await asyncio.to_thread(compute_content_hash, spec["input_path"])
+    except OSError as e:
+        print(f"Could not hash {spec['input_path']}, encoding without the cache: {e}")
+        return True
+    
+    if spec.get("kind") == "batch":
+        spec["outputs"] = [
+            output for output in spec["outputs"]
+            if await claim_batch_output(output["job_id"], output, spec["input_path"],
+                                        spec.get("title"), content_hash)
+        ]
+        if not spec["outputs"]:
+            await redis_client.hset(get_batch_key(job_id), "status", "finished")
+            return False
+        # A requeued run must not claim again what this one now leads
+        await redis_client.hset(get_job_key(job_id), "spec", json.dumps(spec))
+        return True
+    
+    # Keyed on the spec as submitted, before the encoding policy changed it
+    submitted = await load_job_spec(job_id) or dict(spec)
+    submitted.pop("cache_deferred", None)
+    extension = os.path.splitext(spec["output_path"])[1].lstrip(".")
+    spec["cache_key"] = submitted["cache_key"] = get_conversion_cache_key(
+        content_hash, extension, submitted["params"]
+    )
+    if await claim_or_wait(job_id, spec["cache_key"], submitted) != "leader":
+        return False
+    await redis_client.hset(get_job_key(job_id), "spec", json.dumps(submitted))
+    return True
+
+
+# ===========================================
+# Uploads
+# ===========================================
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# One PATCH writes an upload at a time; its lock is refreshed while the body streams
+UPLOAD_LOCK_SECONDS = 300
+
+# Refresh or delete a lock only if we still own it
+REFRESH_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Running hashes of resumable uploads received by this process:
+# upload_id -> (offset, sha256)
+upload_hashers = {}
+
+
+def get_upload_key(upload_id: str) -> str:
+    return f"upload:session:{upload_id}"
+
+
+def get_upload_lock_key(upload_id: str) -> str:
+    return f"upload:lock:{upload_id}"
+
+
+def get_upload_path(upload_id: str, filename: str) -> str:
+    upload_dir = os.path.join(settings.storage_path, "uploads")
+    os.makedirs(upload_dir, exist_ok=True)
+    return os.path.join(upload_dir, f"{upload_id}_{filename}")
+
+
+def remove_if_exists(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def finalize_upload(part_path: str, file_path: str, digest: str):
+    """Atomically move a finished upload into place and record its hash
+    
+    The stored hash lets the conversion cache skip re-reading the file.
+    """
+    await asyncio.to_thread(os.replace, part_path, file_path)
+    await asyncio.to_thread(store_content_hash, file_path, digest)
+
+
+def upload_session_result(session: dict) -> dict:
+    return {
+        "upload_id": session["upload_id"],
+        "file_path": session["file_path"],
+        "filename": session["filename"],
+        "size": int(session["size"]),
+        "offset": int(session["offset"]),
+        "status": session["status"],
+        "sha256": session.get("sha256")
+    }
+
+
+# ===========================================
+# Probe cache
+# ===========================================
+# Shared with the streamer through Redis (same storage volume and key format)
+
+PROBE_KEY_PREFIX = "media:probe"
+
+
+async def run_ffprobe(input_path: str) -> tuple:
+    """Probe a file without blocking the event loop; returns (ok, info)"""
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "quiet", "-print_format", "json",
+        "-show_format", "-show_streams", input_path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    stdout, _ = await process.communicate()
+    try:
+        return process.returncode == 0, json.loads(stdout or b"{}")
+    except ValueError as e:
+        return False, {"error": str(e)}
+
+
+class ProbeCache:
+    """ffprobe results keyed on file identity (path, size, mtime, inode)
+    
+    Lookups try an in-process LRU, then the shared Redis tier, and only then
+    run ffprobe. Concurrent lookups of the same file share one probe.
+    """
+    
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+    
+    @staticmethod
+    def identity(path: str) -> str:
+        st = os.stat(path)
+        return f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}:{st.st_ino}"
+    
+    async def get(self, path: str) -> dict:
+        try:
+            identity = await asyncio.to_thread(self.identity, path)
+        except OSError as e:
+            return {"error": str(e)}
+        
+        info = self.entries.get(identity)
+        if info is not None:
+            self.entries.move_to_end(identity)
+            return info
+        
+        future = self.inflight.get(identity)
+        if future is None:
+            future = asyncio.ensure_future(self._load(identity, path))
+            self.inflight[identity] = future
+            future.add_done_callback(lambda _: self.inflight.pop(identity, None))
+        # A cancelled caller must not cancel the probe other callers wait on
+        return await asyncio.shield(future)
+    
+    async def _load(self, identity: str, path: str) -> dict:
+        redis_key = f"{PROBE_KEY_PREFIX}:{hashlib.sha1(identity.encode()).hexdigest()}"
+        try:
+            cached = await redis_client.get(redis_key)
+        except Exception as e:
+            print(f"Probe cache lookup failed: {e}")
+            cached = None
+        
+        if cached:
+            info = json.loads(cached)
+        else:
+            ok, info = await run_ffprobe(path)
+            if not ok:
+                # Don't cache failures; the file may still be being written
+                return info
+            try:
+                await redis_client.set(redis_key, json.dumps(info), ex=self.ttl)
+            except Exception as e:
+                print(f"Probe cache store failed: {e}")
+        
+        self.entries[identity] = info
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return info
+
+
+probe_cache = ProbeCache(settings.probe_cache_size, settings.probe_cache_ttl)
+
+
+async def get_media_info(input_path: str) -> dict:
+    """Get media information using ffprobe (cached)"""
+    return await probe_cache.get(input_path)
+
+
+async def get_video_duration(input_path: str) -> float:
+    """Get video duration from the cached probe"""
+    info = await get_media_info(input_path)
+    try:
+        return float(info["format"]["duration"])
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+async def pick_thumbnail_time(input_path: str) -> str:
+    """Ask the streamer's frame analysis for a representative frame time"""
+    if settings.thumbnail_analysis_timeout > 0:
+        try:
+            async with httpx.AsyncClient(timeout=settings.thumbnail_analysis_timeout) as client:
+                response = await client.get(
+                    f"{settings.streamer_service_url}/analysis",
+                    params={"file_path": input_path, "limit": 1}
+                )
+            if response.status_code == 200:
+                return f"{response.json()['thumbnail_time']:.3f}"
+        except Exception as e:
+            print(f"Thumbnail analysis unavailable: {e}")
+    return "00:00:01"
 
 
 async def generate_thumbnail_for_job(job_id: str, input_path: str) -> str:
@@ -219,7 +1008,7 @@ async def generate_thumbnail_for_job(job_id: str, input_path: str) -> str:
         output_path = os.path.join(thumb_dir, f"{job_id}.jpg")
         
         # Check if file is a video by looking at streams
-        info = get_media_info(input_path)
+        info = await get_media_info(input_path)
         has_video = False
         if "streams" in info:
             for stream in info["streams"]:
@@ -230,10 +1019,11 @@ async def generate_thumbnail_for_job(job_id: str, input_path: str) -> str:
         if not has_video:
             return ""
         
-        # Generate thumbnail at 1 second mark
+        # Input seeking to the analysed frame: no decode from the start
+        thumbnail_time = await pick_thumbnail_time(input_path)
         cmd = [
-            "ffmpeg", "-y", "-i", input_path,
-            "-ss", "00:00:01", "-vframes", "1",
+            "ffmpeg", "-y", "-ss", thumbnail_time, "-i", input_path,
+            "-vframes", "1",
             "-vf", "scale=320:180:force_original_aspect_ratio=decrease,pad=320:180:(ow-iw)/2:(oh-ih)/2",
             output_path
         ]
@@ -253,43 +1043,53 @@ async def generate_thumbnail_for_job(job_id: str, input_path: str) -> str:
         return ""
 
 
-async def run_conversion(job_id: str, input_path: str, output_path: str, 
-                         ffmpeg_params: str, title: str = None):
-    """Run FFmpeg conversion with progress tracking"""
-    update_job_status(job_id, "processing", 0, title=title)
+async def attach_thumbnail(job_id: str, thumbnail_path: str, title: str = None):
+    """Store a generated thumbnail on a job and broadcast it"""
+    if not await redis_client.exists(get_job_key(job_id)):
+        return  # deleted while the thumbnail was being made
+    await redis_client.hset(get_job_key(job_id), "thumbnail", thumbnail_path)
+    job_data = await redis_client.hgetall(get_job_key(job_id))
+    job_data.pop("spec", None)
+    await redis_client.publish(f"conversion:status:{job_id}", json.dumps(job_data))
+    # Broadcast thumbnail update via WebSocket; the encode may already be
+    # further along (or done), so keep its current status and progress
+    await broadcast_job_update(
+        job_id=job_id,
+        status=job_data.get("status", "processing"),
+        progress=float(job_data.get("progress") or 0),
+        file_name=title,
+        output_path=job_data.get("output_path") or None,
+        thumbnail=thumbnail_path
+    )
+
+
+async def thumbnail_jobs(thumbnail_id: str, input_path: str, job_ids: list,
+                         title: str = None):
+    """Generate a thumbnail and attach it to job_ids
     
-    # Generate thumbnail first
-    thumbnail_path = await generate_thumbnail_for_job(job_id, input_path)
+    Started as its own task once the encode is running, so the frame analysis
+    never delays ffmpeg or holds CPU slots.
+    """
+    thumbnail_path = await generate_thumbnail_for_job(thumbnail_id, input_path)
     if thumbnail_path:
-        # Update job with thumbnail and broadcast update
-        redis_client.hset(get_job_key(job_id), "thumbnail", thumbnail_path)
-        job_data = redis_client.hgetall(get_job_key(job_id))
-        job_data["thumbnail"] = thumbnail_path
-        redis_client.publish(f"conversion:status:{job_id}", json.dumps(job_data))
-        # Broadcast thumbnail update via WebSocket
-        broadcast_job_update(
-            job_id=job_id,
-            status="processing",
-            progress=0,
-            file_name=title,
-            thumbnail=thumbnail_path
-        )
-    
-    duration = get_video_duration(input_path)
+        for job_id in job_ids:
+            await attach_thumbnail(job_id, thumbnail_path, title)
+
+
+async def run_ffmpeg(cmd: list, duration: float, job_ids: list) -> tuple:
+    """Run an ffmpeg command that writes -progress to stdout
     
-    # Build FFmpeg command
-    cmd = ["ffmpeg", "-y", "-i", input_path, "-progress", "pipe:1"]
-    cmd.extend(ffmpeg_params.split())
-    cmd.append(output_path)
+    Progress is reported for every job in job_ids. Returns (returncode, stderr).
+    """
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    # Drain stderr concurrently so a full pipe can't stall ffmpeg
+    stderr_task = asyncio.create_task(process.stderr.read())
     
     try:
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        current_time = 0
         while True:
             line = await process.stdout.readline()
             if not line:
@@ -298,24 +1098,881 @@ async def run_conversion(job_id: str, input_path: str, output_path: str,
             line = line.decode().strip()
             if line.startswith("out_time_ms="):
                 try:
-                    time_ms = int(line.split("=")[1])
-                    current_time = time_ms / 1000000
+                    current_time = int(line.split("=")[1]) / 1000000
                     if duration > 0:
                         progress = min((current_time / duration) * 100, 99)
-                        update_job_status(job_id, "processing", progress)
-                except:
+                        for job_id in job_ids:
+                            progress_aggregator.report(job_id, progress)
+                except ValueError:
                     pass
         
         await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        stderr_task.cancel()
+        raise
+    stderr = await stderr_task
+    return process.returncode, stderr.decode(errors="replace")
+
+
+async def run_conversion(job_id: str, input_path: str, output_path: str, 
+                         ffmpeg_params: str, title: str = None, threads: int = 0) -> bool:
+    """Run FFmpeg conversion with progress tracking; returns True on success"""
+    await update_job_status(job_id, "processing", 0, title=title)
+    
+    # Thumbnail beside the encode instead of before it
+    start_background_task(thumbnail_jobs(job_id, input_path, [job_id], title))
+    
+    duration = await get_video_duration(input_path)
+    
+    # Build FFmpeg command
+    cmd = ["ffmpeg", "-y", "-i", input_path, "-progress", "pipe:1"]
+    cmd.extend(ffmpeg_params.split())
+    if threads:
+        cmd.extend(["-threads", str(threads)])
+    cmd.append(output_path)
+    
+    try:
+        returncode, stderr = await run_ffmpeg(cmd, duration, [job_id])
+        await progress_aggregator.finish(job_id)
         
-        if process.returncode == 0:
-            update_job_status(job_id, "completed", 100, output_path)
-        else:
-            stderr = await process.stderr.read()
-            update_job_status(job_id, "failed", 0, error=stderr.decode())
+        if returncode == 0:
+            await update_job_status(job_id, "completed", 100, output_path)
+            return True
+        await update_job_status(job_id, "failed", 0, error=stderr)
             
     except Exception as e:
-        update_job_status(job_id, "failed", 0, error=str(e))
+        await progress_aggregator.finish(job_id)
+        await update_job_status(job_id, "failed", 0, error=str(e))
+    return False
+
+
+# ===========================================
+# Adaptive encoding policy
+# ===========================================
+# Each job gets the slowest (best quality) speed preset whose estimated
+# turnaround, including the queue ahead of it, still meets the target.
+# Encode speeds are learned from finished jobs, so estimates follow the
+# hardware the workers actually run on.
+
+# Speed tiers per encoder, slowest first, with relative speeds that seed the
+# estimates until real ones are observed. VP9 tiers are -cpu-used values.
+ENCODER_LADDERS = {
+    "libx264": [("slow", 0.5), ("medium", 1.0), ("fast", 1.3), ("veryfast", 2.4),
+                ("superfast", 4.0), ("ultrafast", 6.0)],
+    "libx265": [("slow", 0.12), ("medium", 0.3), ("fast", 0.45), ("veryfast", 0.9),
+                ("superfast", 1.5), ("ultrafast", 2.2)],
+    "libvpx-vp9": [("1", 0.15), ("2", 0.25), ("3", 0.5), ("4", 0.9), ("5", 1.3)]
+}
+# Media seconds encoded per wall second, per thread, at relative speed 1.0
+BASE_THREAD_SPEED = 0.25
+SPEED_EWMA_ALPHA = 0.3
+
+POLICY_LOG_KEY = "encoding:policy:log"
+POLICY_SPEEDS_KEY = "encoding:policy:speeds"
+POLICY_LOG_LENGTH = 1000
+
+
+def get_option(args: list, *names: str) -> Optional[str]:
+    for i, arg in enumerate(args[:-1]):
+        if arg in names:
+            return args[i + 1]
+    return None
+
+
+def set_option(args: list, name: str, value: str) -> list:
+    """Replace an option's value, or append the option"""
+    args = list(args)
+    for i, arg in enumerate(args[:-1]):
+        if arg == name:
+            args[i + 1] = value
+            return args
+    return args + [name, value]
+
+
+def estimate_thread_speeds(ladder: list, observed: dict) -> dict:
+    """Per-thread speed of every tier; unobserved tiers scale from observed ones"""
+    scales = [observed[tier] / relative for tier, relative in ladder if tier in observed]
+    scale = sum(scales) / len(scales) if scales else BASE_THREAD_SPEED
+    return {tier: observed.get(tier, relative * scale) for tier, relative in ladder}
+
+
+async def load_observed_speeds(profile: str, codec: str) -> dict:
+    prefix = f"{profile}:{codec}:"
+    speeds = await redis_client.hgetall(POLICY_SPEEDS_KEY)
+    return {field[len(prefix):]: float(value)
+            for field, value in speeds.items() if field.startswith(prefix)}
+
+
+async def choose_encoding_policy(job_id: str, spec: dict) -> Optional[dict]:
+    """Pick an encoder speed tier and thread count for a job, and log the decision"""
+    codec = get_option(spec["params"].split(), "-c:v", "-vcodec")
+    ladder = ENCODER_LADDERS.get(codec)
+    if not settings.encoding_policy_enabled or not ladder:
+        return None
+    
+    duration = await get_video_duration(spec["input_path"])
+    if not duration:
+        # Nothing to estimate from; keep the profile's own settings
+        return None
+    queue_depth = await redis_client.llen(QUEUE_KEY)
+    cost = min(spec.get("cost", DEFAULT_JOB_COST), capacity_pool.total)
+    
+    # An idle worker lends the job extra threads; a busy one keeps it to its cost
+    threads = cost
+    if queue_depth == 0 and capacity_pool.used == 0:
+        threads = min(cost * 2, capacity_pool.total)
+    
+    # Assume queued jobs are of similar length and run (slots / cost) at a time
+    parallel = max(capacity_pool.total // threads, 1)
+    waves = queue_depth / parallel
+    # Segmented jobs spread their chunks over the same slots
+    chunk_parallelism = parallel if spec.get("kind") == "segmented" else 1
+    
+    profile = spec.get("profile", "custom")
+    speeds = estimate_thread_speeds(ladder, await load_observed_speeds(profile, codec))
+    tier, turnaround = ladder[-1][0], 0.0
+    for candidate, _ in ladder:
+        encode_time = duration / (speeds[candidate] * threads * chunk_parallelism)
+        turnaround = (waves + 1) * encode_time
+        if turnaround <= settings.encoding_target_turnaround:
+            tier = candidate
+            break
+    
+    decision = {
+        "job_id": job_id,
+        "profile": profile,
+        "codec": codec,
+        "tier": tier,
+        "threads": threads,
+        "queue_depth": queue_depth,
+        "duration": round(duration, 2),
+        "estimated_turnaround": round(turnaround, 1),
+        "target_turnaround": settings.encoding_target_turnaround,
+        "worker": worker_id,
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.lpush(POLICY_LOG_KEY, json.dumps(decision))
+        pipe.ltrim(POLICY_LOG_KEY, 0, POLICY_LOG_LENGTH - 1)
+        await pipe.execute()
+    return decision
+
+
+def apply_encoding_policy(spec: dict, decision: dict) -> dict:
+    """Return a copy of the job spec with the chosen tier and threads"""
+    args = spec["params"].split()
+    if decision["codec"] == "libvpx-vp9":
+        # Row multithreading and log2(threads) tile columns let VP9 use the threads
+        args = set_option(args, "-deadline", "good")
+        args = set_option(args, "-cpu-used", decision["tier"])
+        args = set_option(args, "-row-mt", "1")
+        args = set_option(args, "-tile-columns", str(min(decision["threads"].bit_length() - 1, 4)))
+    else:
+        args = set_option(args, "-preset", decision["tier"])
+        if decision["codec"] == "libx265":
+            args = set_option(args, "-x265-params", f"pools={decision['threads']}")
+    return {**spec, "params": " ".join(args), "cost": decision["threads"]}
+
+
+async def record_encoding_speed(decision: dict, elapsed: float):
+    """Fold a finished job's per-thread speed into the learned estimates"""
+    if not decision["duration"] or elapsed <= 0:
+        return
+    field = f"{decision['profile']}:{decision['codec']}:{decision['tier']}"
+    speed = decision["duration"] / elapsed / decision["threads"]
+    previous = await redis_client.hget(POLICY_SPEEDS_KEY, field)
+    if previous:
+        speed = SPEED_EWMA_ALPHA * speed + (1 - SPEED_EWMA_ALPHA) * float(previous)
+    await redis_client.hset(POLICY_SPEEDS_KEY, field, round(speed, 4))
+
+
+# ===========================================
+# Remux fast path
+# ===========================================
+# Streams that already match a profile's target codec (and size) are copied
+# instead of re-encoded: "copy" copies everything, "copy_video"/"copy_audio"
+# copy one stream and encode the other, "encode" is the normal path.
+
+REMUX_STATS_KEY = "conversion:remux:stats"
+STRATEGIES = ("copy", "copy_video", "copy_audio", "encode")
+
+
+def pick_stream(info: dict, codec_type: str) -> Optional[dict]:
+    for stream in info.get("streams", []):
+        # Cover art shows up as a one-frame video stream
+        if stream.get("disposition", {}).get("attached_pic"):
+            continue
+        if stream.get("codec_type") == codec_type:
+            return stream
+    return None
+
+
+def video_matches(stream: Optional[dict], targets: dict) -> bool:
+    if not stream or stream.get("codec_name") != targets["video_codec"]:
+        return False
+    for dimension in ("width", "height"):
+        if targets.get(dimension) and stream.get(dimension) != targets[dimension]:
+            return False
+    return True
+
+
+def audio_matches(stream: Optional[dict], targets: dict) -> bool:
+    if not stream or stream.get("codec_name") != targets.get("audio_codec"):
+        return False
+    if targets.get("sample_rate") and int(stream.get("sample_rate") or 0) != targets["sample_rate"]:
+        return False
+    if targets.get("channels") and stream.get("channels") != targets["channels"]:
+        return False
+    return True
+
+
+def choose_strategy(profile: dict, info: dict) -> str:
+    """Decide which streams of the input can be copied for a profile"""
+    targets = profile.get("targets")
+    if not targets or "streams" not in info:
+        return "encode"
+    
+    audio = pick_stream(info, "audio")
+    audio_ok = audio_matches(audio, targets)
+    if "video_codec" not in targets:
+        # Audio-only profile
+        return "copy" if audio_ok else "encode"
+    
+    video = pick_stream(info, "video")
+    video_ok = video_matches(video, targets)
+    # A missing audio stream needs no encoding either
+    audio_ok = audio_ok or audio is None
+    if video_ok and audio_ok:
+        return "copy"
+    if video_ok:
+        return "copy_video"
+    if audio_ok and audio is not None:
+        return "copy_audio"
+    return "encode"
+
+
+def build_strategy_params(strategy: str, params: str, extension: str) -> str:
+    if "-vn" in params.split():
+        return "-vn -map 0:a:0 -c:a copy"
+    video_args, audio_args = split_av_params(params, extension)
+    maps = ["-map", "0:v:0", "-map", "0:a:0?"]
+    if strategy == "copy":
+        return " ".join(maps + ["-c", "copy"])
+    if strategy == "copy_video":
+        return " ".join(maps + ["-c:v", "copy"] + audio_args)
+    return " ".join(maps + video_args + ["-c:a", "copy"])
+
+
+async def estimate_encode_seconds(profile_name: str, duration: float) -> float:
+    """Estimated wall time of a full encode with the profile's own settings"""
+    profile = CONVERSION_PROFILES[profile_name]
+    params = profile["params"].split()
+    codec = get_option(params, "-c:v", "-vcodec")
+    ladder = ENCODER_LADDERS.get(codec)
+    if not ladder or not duration:
+        return 0
+    speeds = estimate_thread_speeds(ladder, await load_observed_speeds(profile_name, codec))
+    tier = get_option(params, "-preset", "-cpu-used")
+    speed = speeds.get(tier) or speeds[ladder[len(ladder) // 2][0]]
+    return duration / (speed * min(profile["cost"], capacity_pool.total))
+
+
+async def record_strategy_metrics(spec: dict, elapsed: float):
+    """Count jobs, wall time and estimated encode time saved per strategy"""
+    strategy = spec.get("strategy", "encode")
+    duration = await get_video_duration(spec["input_path"])
+    saved = 0
+    if strategy != "encode" and spec.get("profile") in CONVERSION_PROFILES:
+        saved = max(await estimate_encode_seconds(spec["profile"], duration) - elapsed, 0)
+    
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hincrby(REMUX_STATS_KEY, f"{strategy}:jobs", 1)
+        pipe.hincrbyfloat(REMUX_STATS_KEY, f"{strategy}:wall_seconds", round(elapsed, 3))
+        pipe.hincrbyfloat(REMUX_STATS_KEY, f"{strategy}:media_seconds", round(duration, 3))
+        pipe.hincrbyfloat(REMUX_STATS_KEY, f"{strategy}:saved_seconds", round(saved, 3))
+        await pipe.execute()
+
+
+# ===========================================
+# Batch (single-pass, multi-output) conversions
+# ===========================================
+
+def get_batch_key(batch_id: str) -> str:
+    return f"conversion:batch:{batch_id}"
+
+
+def split_profile_params(params: str, extension: str) -> dict:
+    """Split profile params into the parts a shared filter graph needs
+    
+    The -vf chain moves into -filter_complex, -vn/-an become stream selection,
+    and everything else stays a per-output option.
+    """
+    args = params.split()
+    result = {
+        "filter": None,
+        "video": True,
+        "audio": extension not in ("gif", "jpg", "png"),
+        "args": []
+    }
+    i = 0
+    while i < len(args):
+        if args[i] == "-vf" and i + 1 < len(args):
+            result["filter"] = args[i + 1]
+            i += 2
+            continue
+        if args[i] == "-vn":
+            result["video"] = False
+        elif args[i] == "-an":
+            result["audio"] = False
+        else:
+            result["args"].append(args[i])
+        i += 1
+    return result
+
+
+def build_batch_command(input_path: str, outputs: list, has_video: bool,
+                        has_audio: bool, threads: int = 0) -> list:
+    """Build one ffmpeg command that decodes once and writes every output"""
+    graph = []
+    video_outputs = [o for o in outputs if o["video"] and has_video]
+    audio_outputs = [o for o in outputs if o["audio"] and has_audio]
+    
+    if video_outputs:
+        labels = "".join(f"[v{i}]" for i in range(len(video_outputs)))
+        graph.append(f"[0:v]split={len(video_outputs)}{labels}")
+        for i, output in enumerate(video_outputs):
+            if output["filter"]:
+                graph.append(f"[v{i}]{output['filter']}[vout{i}]")
+                output["video_map"] = f"[vout{i}]"
+            else:
+                output["video_map"] = f"[v{i}]"
+    
+    if audio_outputs:
+        labels = "".join(f"[a{i}]" for i in range(len(audio_outputs)))
+        graph.append(f"[0:a]asplit={len(audio_outputs)}{labels}")
+        for i, output in enumerate(audio_outputs):
+            output["audio_map"] = f"[a{i}]"
+    
+    cmd = ["ffmpeg", "-y", "-i", input_path, "-progress", "pipe:1"]
+    if graph:
+        cmd.extend(["-filter_complex", ";".join(graph)])
+    
+    for output in outputs:
+        if "video_map" in output:
+            cmd.extend(["-map", output["video_map"]])
+        if "audio_map" in output:
+            cmd.extend(["-map", output["audio_map"]])
+        cmd.extend(output["args"])
+        if threads:
+            cmd.extend(["-threads", str(threads)])
+        cmd.append(output["output_path"])
+    return cmd
+
+
+async def run_batch_conversion(batch_id: str, input_path: str, outputs: list,
+                               title: str = None, threads: int = 0):
+    """Encode several profiles from a single decode of the input"""
+    job_ids = [o["job_id"] for o in outputs]
+    for job_id in job_ids:
+        await update_job_status(job_id, "processing", 0, title=title)
+    
+    # Probe and thumbnail once for the whole batch
+    start_background_task(thumbnail_jobs(batch_id, input_path, job_ids, title))
+    
+    info = await get_media_info(input_path)
+    stream_types = {s.get("codec_type") for s in info.get("streams", [])}
+    has_video = "video" in stream_types
+    has_audio = "audio" in stream_types
+    duration = float(info.get("format", {}).get("duration") or 0)
+    
+    runnable = []
+    for output in outputs:
+        output.update(split_profile_params(output["params"], output["extension"]))
+        if output["video"] and not output["audio"] and not has_video:
+            await update_job_status(output["job_id"], "failed", 0,
+                                    error="Input has no video stream")
+        elif not output["video"] and not has_audio:
+            await update_job_status(output["job_id"], "failed", 0,
+                                    error="Input has no audio stream")
+        else:
+            runnable.append(output)
+    
+    results = {o["job_id"]: False for o in outputs}
+    if runnable:
+        cmd = build_batch_command(input_path, runnable, has_video, has_audio, threads)
+        runnable_ids = [o["job_id"] for o in runnable]
+        try:
+            returncode, stderr = await run_ffmpeg(cmd, duration, runnable_ids)
+        except Exception as e:
+            returncode, stderr = -1, str(e)
+        
+        for output in runnable:
+            await progress_aggregator.finish(output["job_id"])
+            if returncode == 0 and os.path.exists(output["output_path"]):
+                await update_job_status(output["job_id"], "completed", 100, output["output_path"])
+                results[output["job_id"]] = True
+            else:
+                await update_job_status(output["job_id"], "failed", 0,
+                                        error=stderr or "Output was not written")
+    
+    await redis_client.hset(get_batch_key(batch_id), "status", "finished")
+    return results
+
+
+# ===========================================
+# Segmented (chunked, parallel) conversions
+# ===========================================
+# The video stream is cut on keyframes with stream copy and every chunk is
+# queued as its own job, so any worker sharing storage_path can encode it.
+# Audio is encoded once for the whole input, then the encoded chunks are
+# joined with the concat demuxer and muxed with the audio, without re-encoding.
+
+SEGMENTABLE_EXTENSIONS = ("mp4", "mkv", "mov", "webm")
+# Options that change timing or container layout and can't be applied per chunk
+SEGMENT_UNSAFE_OPTIONS = ("-vn", "-f", "-ss", "-t", "-to", "-filter_complex", "-map")
+AUDIO_OPTIONS = ("-c:a", "-acodec", "-b:a", "-ar", "-ac", "-af", "-q:a", "-aq")
+DEFAULT_CODECS = {
+    "webm": ("libvpx-vp9", "libopus"),
+    "default": ("libx264", "aac")
+}
+
+
+def get_segments_key(job_id: str) -> str:
+    return f"conversion:segments:{job_id}"
+
+
+def get_segment_work_dir(job_id: str) -> str:
+    return os.path.join(settings.storage_path, "work", job_id)
+
+
+def can_segment(extension: str, params: str) -> bool:
+    args = params.split()
+    return extension in SEGMENTABLE_EXTENSIONS and not any(
+        option in args for option in SEGMENT_UNSAFE_OPTIONS
+    )
+
+
+def split_av_params(params: str, extension: str) -> tuple:
+    """Split encoder params into (video args, audio args) with explicit codecs"""
+    args = params.split()
+    video, audio = [], []
+    i = 0
+    while i < len(args):
+        if args[i] in AUDIO_OPTIONS and i + 1 < len(args):
+            audio.extend(args[i:i + 2])
+            i += 2
+            continue
+        video.append(args[i])
+        i += 1
+    
+    # Chunks and audio go through intermediate .mkv/.mka files, whose default
+    # encoders differ from the final container's
+    video_codec, audio_codec = DEFAULT_CODECS.get(extension, DEFAULT_CODECS["default"])
+    if "-c:v" not in video and "-vcodec" not in video:
+        video = ["-c:v", video_codec] + video
+    if "-c:a" not in audio and "-acodec" not in audio:
+        audio = ["-c:a", audio_codec] + audio
+    return video, audio
+
+
+async def run_process(cmd: list) -> tuple:
+    """Run a command to completion; returns (returncode, stderr)"""
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, stderr.decode(errors="replace")
+
+
+async def split_on_keyframes(input_path: str, work_dir: str) -> list:
+    """Cut the first video stream into GOP-aligned chunks with stream copy
+    
+    The segment muxer only cuts on keyframes, so every chunk starts with one
+    and can be encoded independently.
+    """
+    list_path = os.path.join(work_dir, "chunks.csv")
+    returncode, stderr = await run_process([
+        "ffmpeg", "-y", "-i", input_path, "-map", "0:v:0", "-c", "copy",
+        "-f", "segment", "-segment_time", str(settings.segment_target_seconds),
+        "-segment_list", list_path, "-segment_list_type", "csv",
+        "-reset_timestamps", "1",
+        os.path.join(work_dir, "source_%05d.mkv")
+    ])
+    if returncode != 0:
+        raise RuntimeError(stderr)
+    
+    chunks = []
+    with open(list_path, newline="") as f:
+        for name, start, end in csv.reader(f):
+            index = len(chunks)
+            chunks.append({
+                "source": os.path.join(work_dir, name),
+                "output": os.path.join(work_dir, f"encoded_{index:05d}.mkv"),
+                "duration": float(end) - float(start)
+            })
+    return chunks
+
+
+async def encode_audio_track(input_path: str, audio_path: str, audio_args: list):
+    """Encode the audio of the whole input in one pass on this worker"""
+    cost = await capacity_pool.acquire(1)
+    try:
+        returncode, stderr = await run_process(
+            ["ffmpeg", "-y", "-i", input_path, "-map", "0:a:0", "-vn"] + audio_args +
+            ["-threads", str(cost), audio_path]
+        )
+        if returncode != 0:
+            raise RuntimeError(stderr)
+    finally:
+        await capacity_pool.release(cost)
+
+
+async def execute_chunk(chunk_id: str, spec: dict, threads: int):
+    """Encode one chunk of a segmented conversion and record the result"""
+    segments_key = get_segments_key(spec["parent_id"])
+    if await redis_client.hexists(segments_key, "cancelled"):
+        await redis_client.delete(get_job_key(chunk_id))
+        return
+    
+    cmd = ["ffmpeg", "-y", "-i", spec["input_path"], "-an"] + spec["params"].split()
+    if threads:
+        cmd.extend(["-threads", str(threads)])
+    cmd.append(spec["output_path"])
+    
+    try:
+        returncode, stderr = await run_process(cmd)
+    except Exception as e:
+        returncode, stderr = -1, str(e)
+    
+    # One field per chunk index, so a chunk that runs twice after a requeue
+    # isn't counted twice
+    result = "ok" if returncode == 0 else (stderr or "Chunk encode failed")
+    await redis_client.hset(segments_key, str(spec["index"]), result)
+    await redis_client.expire(segments_key, 86400)
+    await redis_client.delete(get_job_key(chunk_id))
+
+
+async def wait_for_chunks(job_id: str, chunks: list, duration: float):
+    """Wait until every chunk is encoded, reporting progress as chunks finish
+    
+    Raises when a chunk fails, or when none finishes within
+    segment_stall_leases job leases (a lost chunk or a hung ffmpeg).
+    """
+    segments_key = get_segments_key(job_id)
+    stall_seconds = settings.segment_stall_leases * settings.job_lease_seconds
+    finished_count = 0
+    last_finished = time.monotonic()
+    while True:
+        results = await redis_client.hgetall(segments_key)
+        for field, result in results.items():
+            if field.isdigit() and result != "ok":
+                raise RuntimeError(result)
+        
+        finished = [i for i in range(len(chunks)) if results.get(str(i)) == "ok"]
+        if len(finished) == len(chunks):
+            return
+        if len(finished) > finished_count:
+            finished_count = len(finished)
+            last_finished = time.monotonic()
+        elif time.monotonic() - last_finished > stall_seconds:
+            raise RuntimeError(f"No chunk finished in {stall_seconds}s "
+                               f"({finished_count}/{len(chunks)} done)")
+        if duration > 0:
+            # The last 5% covers the concat and mux
+            done = sum(chunks[i]["duration"] for i in finished)
+            progress_aggregator.report(job_id, min(done / duration * 95, 95))
+        await asyncio.sleep(1)
+
+
+async def run_segmented_conversion(job_id: str, spec: dict) -> bool:
+    """Encode a long input as parallel keyframe-aligned chunks; True on success"""
+    input_path = spec["input_path"]
+    output_path = spec["output_path"]
+    title = spec.get("title")
+    extension = os.path.splitext(output_path)[1].lstrip(".")
+    await update_job_status(job_id, "processing", 0, title=title)
+    
+    start_background_task(thumbnail_jobs(job_id, input_path, [job_id], title))
+    
+    info = await get_media_info(input_path)
+    has_audio = any(s.get("codec_type") == "audio" for s in info.get("streams", []))
+    duration = float(info.get("format", {}).get("duration") or 0)
+    video_args, audio_args = split_av_params(spec["params"], extension)
+    
+    work_dir = get_segment_work_dir(job_id)
+    segments_key = get_segments_key(job_id)
+    audio_path = os.path.join(work_dir, "audio.mka")
+    audio_task = None
+    os.makedirs(work_dir, exist_ok=True)
+    await redis_client.delete(segments_key)
+    
+    try:
+        chunks = await split_on_keyframes(input_path, work_dir)
+        if has_audio:
+            audio_task = asyncio.create_task(encode_audio_track(input_path, audio_path, audio_args))
+        
+        # Chunks go on the consuming end of the queue so they run before
+        # newer jobs, on whichever workers have free slots
+        for index, chunk in enumerate(chunks):
+            chunk_id = f"{job_id}_chunk{index:05d}"
+            await redis_client.hset(get_job_key(chunk_id), "spec", json.dumps({
+                "kind": "chunk",
+                "parent_id": job_id,
+                "index": index,
+                "input_path": chunk["source"],
+                "output_path": chunk["output"],
+                "params": " ".join(video_args),
+                "cost": spec.get("cost", DEFAULT_JOB_COST)
+            }))
+            await redis_client.expire(get_job_key(chunk_id), 86400)
+            await redis_client.rpush(QUEUE_KEY, chunk_id)
+        
+        await wait_for_chunks(job_id, chunks, duration)
+        if audio_task:
+            await audio_task
+        
+        concat_path = os.path.join(work_dir, "concat.txt")
+        with open(concat_path, "w") as f:
+            for chunk in chunks:
+                f.write(f"file '{chunk['output']}'\n")
+        
+        cmd = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", concat_path]
+        if has_audio:
+            cmd.extend(["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0"])
+        cmd.extend(["-c", "copy"])
+        if extension in ("mp4", "mov"):
+            cmd.extend(["-movflags", "+faststart"])
+        cmd.append(output_path)
+        
+        returncode, stderr = await run_process(cmd)
+        if returncode != 0:
+            raise RuntimeError(stderr)
+        
+        await progress_aggregator.finish(job_id)
+        await update_job_status(job_id, "completed", 100, output_path)
+        return True
+    except Exception as e:
+        # Queued chunks of a failed job are skipped instead of encoded
+        await redis_client.hset(segments_key, "cancelled", "1")
+        if audio_task and not audio_task.done():
+            audio_task.cancel()
+        await progress_aggregator.finish(job_id)
+        await update_job_status(job_id, "failed", 0, error=str(e))
+        return False
+    finally:
+        await redis_client.expire(segments_key, 3600)
+        await asyncio.to_thread(shutil.rmtree, work_dir, True)
+
+
+async def enqueue_job(job_id: str, spec: dict):
+    """Persist a job spec and push it onto the shared conversion queue"""
+    await redis_client.hset(get_job_key(job_id), "spec", json.dumps(spec))
+    await redis_client.lpush(QUEUE_KEY, job_id)
+
+
+async def load_job_spec(job_id: str) -> Optional[dict]:
+    spec = await redis_client.hget(get_job_key(job_id), "spec")
+    return json.loads(spec) if spec else None
+
+
+async def lease_heartbeat(job_id: str):
+    """Keep the job lease alive so other workers don't requeue it"""
+    interval = max(settings.job_lease_seconds // 3, 1)
+    while True:
+        await redis_client.set(get_lease_key(job_id), worker_id, ex=settings.job_lease_seconds)
+        await asyncio.sleep(interval)
+
+
+async def release_job(job_id: str):
+    await redis_client.lrem(PROCESSING_KEY, 1, job_id)
+    await redis_client.delete(get_lease_key(job_id))
+
+
+stale_suspects = set()
+
+
+async def recover_stale_jobs():
+    """Requeue jobs whose worker died (no lease on two consecutive sweeps)"""
+    global stale_suspects
+    
+    suspects = set()
+    for job_id in await redis_client.lrange(PROCESSING_KEY, 0, -1):
+        if await redis_client.exists(get_lease_key(job_id)):
+            continue
+        if job_id not in stale_suspects:
+            # Lease may not be written yet right after the pop; check next sweep
+            suspects.add(job_id)
+            continue
+        if await redis_client.lrem(PROCESSING_KEY, 1, job_id):
+            print(f"Requeueing stale conversion job {job_id}")
+            await requeue_job(job_id, await load_job_spec(job_id))
+    stale_suspects = suspects
+
+
+async def requeue_job(job_id: str, spec: Optional[dict]):
+    """Put a job back on the queue and show it as pending again
+    
+    Chunks are internal and a batch is shown through its member jobs, so
+    neither is broadcast under its own ID.
+    """
+    await redis_client.rpush(QUEUE_KEY, job_id)
+    kind = (spec or {}).get("kind")
+    if kind == "batch":
+        for output in spec.get("outputs", []):
+            await update_job_status(output["job_id"], "pending", 0)
+    elif kind != "chunk":
+        await update_job_status(job_id, "pending", 0)
+
+
+async def execute_batch(batch_id: str, spec: dict, threads: int):
+    results = await run_batch_conversion(
+        batch_id,
+        spec["input_path"],
+        spec["outputs"],
+        spec.get("title"),
+        threads=threads
+    )
+    for output in spec["outputs"]:
+        if output.get("cache_key"):
+            success = results.get(output["job_id"], False)
+            error = None
+            if not success:
+                error = await redis_client.hget(get_job_key(output["job_id"]), "error")
+            await finish_cache_leader(output["cache_key"], success, output["output_path"], error)
+
+
+async def plan_job(job_id: str, spec: dict) -> tuple:
+    """Apply the encoding policy to a dequeued job; returns (spec, decision)"""
+    decision = None
+    if spec.get("kind") in (None, "segmented"):
+        try:
+            decision = await choose_encoding_policy(job_id, spec)
+        except Exception as e:
+            print(f"Encoding policy failed for {job_id}: {e}")
+        if decision:
+            spec = apply_encoding_policy(spec, decision)
+    return spec, decision
+
+
+async def execute_job(job_id: str, spec: dict, decision: Optional[dict], cost: int,
+                      heartbeat: asyncio.Task):
+    """Run a dequeued job on the CPU slots the worker loop reserved for it"""
+    kind = spec.get("kind")
+    try:
+        if spec.get("cache_deferred") and not await claim_deferred_cache(job_id, spec):
+            return
+        started = time.monotonic()
+        if kind == "segmented":
+            # The parent only coordinates; its chunks and audio take their own
+            # slots, so it holds none while it waits on them
+            success = await run_segmented_conversion(job_id, spec)
+        else:
+            if kind == "batch":
+                await execute_batch(job_id, spec, cost)
+                return
+            if kind == "chunk":
+                await execute_chunk(job_id, spec, cost)
+                return
+            
+            success = await run_conversion(
+                job_id,
+                spec["input_path"],
+                spec["output_path"],
+                spec["params"],
+                spec.get("title"),
+                threads=cost
+            )
+            if success and decision:
+                await record_encoding_speed(decision, time.monotonic() - started)
+    except asyncio.CancelledError:
+        # Shutting down: hand the job back instead of dropping it
+        await requeue_job(job_id, spec)
+        raise
+    else:
+        if success:
+            await record_strategy_metrics(spec, time.monotonic() - started)
+        if spec.get("cache_key"):
+            error = None
+            if not success:
+                error = await redis_client.hget(get_job_key(job_id), "error")
+            await finish_cache_leader(spec["cache_key"], success, spec["output_path"], error)
+    finally:
+        heartbeat.cancel()
+        await release_job(job_id)
+        if cost:
+            await capacity_pool.release(cost)
+
+
+async def conversion_worker():
+    """Pull jobs from the Redis queue and run them within the CPU budget"""
+    print(f"Conversion worker {worker_id} started with {capacity_pool.total} slots")
+    last_recovery = 0
+    
+    while True:
+        try:
+            if time.monotonic() - last_recovery > settings.job_lease_seconds:
+                await recover_stale_jobs()
+                last_recovery = time.monotonic()
+            
+            # Only take work when at least one slot is free so queued jobs
+            # stay available to other workers
+            await capacity_pool.wait_available()
+            
+            job_id = await redis_client.blmove(QUEUE_KEY, PROCESSING_KEY, 5, "RIGHT", "LEFT")
+            if not job_id:
+                continue
+            
+            heartbeat = asyncio.create_task(lease_heartbeat(job_id))
+            spec = await load_job_spec(job_id)
+            if not spec:
+                heartbeat.cancel()
+                await release_job(job_id)
+                continue
+            
+            # Reserve the job's slots before popping again, so this worker never
+            # takes more than it can run and the rest stays in the shared queue
+            spec, decision = await plan_job(job_id, spec)
+            cost = 0
+            if spec.get("kind") != "segmented":
+                cost = await capacity_pool.acquire(spec.get("cost", DEFAULT_JOB_COST))
+            start_background_task(execute_job(job_id, spec, decision, cost, heartbeat))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Conversion worker error: {e}")
+            await asyncio.sleep(1)
+
+
+async def run_worker():
+    await asyncio.gather(conversion_worker(), progress_aggregator.run())
+
+
+@app.on_event("startup")
+async def start_worker():
+    if settings.converter_role in ("worker", "all"):
+        app.state.worker_task = asyncio.create_task(run_worker())
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    # Stop taking jobs, then requeue the running ones while Redis is still open
+    tasks = list(background_tasks)
+    if hasattr(app.state, "worker_task"):
+        tasks.append(app.state.worker_task)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await pusher_client.aclose()
+    await redis_client.aclose()
 
 
 @app.get("/")
@@ -326,7 +1983,7 @@ async def root():
 @app.get("/health")
 async def health():
     try:
-        redis_client.ping()
+        await redis_client.ping()
         return {"status": "healthy", "redis": "connected"}
     except:
         return JSONResponse(status_code=503, content={"status": "unhealthy"})
@@ -339,7 +1996,7 @@ async def get_profiles():
 
 
 @app.post("/convert")
-async def convert(request: ConversionRequest, background_tasks: BackgroundTasks):
+async def convert(request: ConversionRequest):
     """Start a conversion job"""
     job_id = request.job_id or str(uuid.uuid4())
     
@@ -351,9 +2008,11 @@ async def convert(request: ConversionRequest, background_tasks: BackgroundTasks)
         profile = CONVERSION_PROFILES[request.output_format]
         extension = profile["extension"]
         params = profile["params"]
+        cost = profile["cost"]
     else:
         extension = request.output_format
         params = request.ffmpeg_params or ""
+        cost = DEFAULT_JOB_COST
     
     # Generate output path
     input_name = os.path.splitext(os.path.basename(request.input_path))[0]
@@ -379,42 +2038,401 @@ async def convert(request: ConversionRequest, background_tasks: BackgroundTasks)
         output_path = os.path.join(hls_dir, "playlist.m3u8")
         params = f"-c:v libx264 -c:a aac -f hls -hls_time 4 -hls_list_size 0 -hls_segment_filename {segment_path}"
     
+    # Copy streams that already match the profile instead of re-encoding them
+    strategy = "encode"
+    if request.output_format in CONVERSION_PROFILES:
+        info = await get_media_info(request.input_path)
+        strategy = choose_strategy(CONVERSION_PROFILES[request.output_format], info)
+        if strategy != "encode":
+            params = build_strategy_params(strategy, params, extension)
+            if strategy in ("copy", "copy_video"):
+                cost = 1
+    
     # Initialize job with title
-    update_job_status(job_id, "pending", 0, title=original_filename)
+    await update_job_status(job_id, "pending", 0, title=original_filename)
+    await redis_client.hset(get_job_key(job_id), "strategy", strategy)
+    
+    spec = {
+        "input_path": request.input_path,
+        "output_path": output_path,
+        "params": params,
+        "title": original_filename,
+        "profile": request.output_format if request.output_format in CONVERSION_PROFILES else "custom",
+        "strategy": strategy,
+        "cost": cost
+    }
+    
+    # HLS writes a directory of segments, so it bypasses the result cache
+    cache = "miss"
+    if settings.conversion_cache_enabled and request.cache and request.output_format != "hls":
+        content_hash = await asyncio.to_thread(lookup_content_hash, request.input_path)
+        if content_hash is None:
+            # Hashing reads the whole input, so for a file not seen before
+            # (uploads store theirs) it happens on the worker instead
+            spec["cache_deferred"] = True
+            cache = "deferred"
+        else:
+            spec["cache_key"] = get_conversion_cache_key(content_hash, extension, params)
+            outcome = await claim_or_wait(job_id, spec["cache_key"], spec)
+            if outcome == "hit":
+                return {"job_id": job_id, "status": "completed", "cache": "hit", "strategy": strategy}
+            if outcome == "waiting":
+                return {"job_id": job_id, "status": "pending", "cache": "coalesced", "strategy": strategy}
+    
+    # Long inputs are encoded as parallel keyframe-aligned chunks
+    if (strategy == "encode" and request.segmented is not False
+            and can_segment(extension, params)):
+        duration = await get_video_duration(request.input_path)
+        if request.segmented or duration >= settings.segment_min_duration:
+            spec["kind"] = "segmented"
+    
+    # Queue the job; a worker with enough free CPU slots will pick it up
+    await enqueue_job(job_id, spec)
+    
+    return {
+        "job_id": job_id,
+        "status": "pending",
+        "cache": cache,
+        "strategy": strategy,
+        "segmented": spec.get("kind") == "segmented"
+    }
+
+
+@app.post("/convert/batch")
+async def convert_batch(request: BatchConversionRequest):
+    """Convert one input to several profiles with a single decode pass"""
+    batch_id = request.batch_id or str(uuid.uuid4())
+    
+    if not os.path.exists(request.input_path):
+        raise HTTPException(status_code=404, detail="Input file not found")
+    if not request.profiles:
+        raise HTTPException(status_code=400, detail="No profiles requested")
+    
+    profiles = list(dict.fromkeys(request.profiles))
+    for name in profiles:
+        if name not in CONVERSION_PROFILES:
+            raise HTTPException(status_code=400, detail=f"Unknown profile: {name}")
+        if name == "hls":
+            raise HTTPException(status_code=400, detail="HLS is not supported in batch mode")
+    
+    input_name = os.path.splitext(os.path.basename(request.input_path))[0]
+    original_filename = os.path.basename(request.input_path)
+    if "_" in original_filename:
+        original_filename = original_filename.split("_", 1)[1]
+    
+    output_dir = os.path.join(settings.storage_path, "converted")
+    os.makedirs(output_dir, exist_ok=True)
+    
+    content_hash = None
+    if settings.conversion_cache_enabled:
+        content_hash = await asyncio.to_thread(lookup_content_hash, request.input_path)
     
-    # Start conversion in background
-    background_tasks.add_task(run_conversion, job_id, request.input_path, output_path, params, original_filename)
+    jobs = {}
+    outputs = []
+    for name in profiles:
+        profile = CONVERSION_PROFILES[name]
+        job_id = f"{batch_id}_{name}"
+        output = {
+            "job_id": job_id,
+            "profile": name,
+            "extension": profile["extension"],
+            "params": profile["params"],
+            "output_path": os.path.join(output_dir, f"{input_name}_{job_id}.{profile['extension']}")
+        }
+        jobs[name] = job_id
+        await update_job_status(job_id, "pending", 0, title=original_filename)
+        
+        # Outputs already cached (or being produced elsewhere) leave the graph
+        if content_hash and not await claim_batch_output(job_id, output, request.input_path,
+                                                         original_filename, content_hash):
+            continue
+        outputs.append(output)
+    
+    await redis_client.hset(get_batch_key(batch_id), mapping={
+        "batch_id": batch_id,
+        "input_path": request.input_path,
+        "jobs": json.dumps(jobs),
+        "status": "pending" if outputs else "finished"
+    })
+    await redis_client.expire(get_batch_key(batch_id), 86400)
+    
+    if outputs:
+        await enqueue_job(batch_id, {
+            "kind": "batch",
+            "input_path": request.input_path,
+            "title": original_filename,
+            "outputs": outputs,
+            # One decode feeds every encoder, so the batch is charged their sum
+            "cost": sum(CONVERSION_PROFILES[o["profile"]]["cost"] for o in outputs),
+            # Without a stored hash the worker hashes the input before encoding
+            "cache_deferred": settings.conversion_cache_enabled and not content_hash
+        })
+    
+    return {"batch_id": batch_id, "jobs": jobs, "status": "pending" if outputs else "finished"}
+
+
+@app.get("/batch/{batch_id}")
+async def get_batch_status(batch_id: str):
+    """Get the status of every output in a batch conversion"""
+    batch_data = await redis_client.hgetall(get_batch_key(batch_id))
+    if not batch_data:
+        raise HTTPException(status_code=404, detail="Batch not found")
     
-    return {"job_id": job_id, "status": "pending"}
+    jobs = json.loads(batch_data.get("jobs", "{}"))
+    outputs = {}
+    for name, job_id in jobs.items():
+        job_data = await redis_client.hgetall(get_job_key(job_id))
+        outputs[name] = {
+            "job_id": job_id,
+            "status": job_data.get("status", "unknown"),
+            "progress": float(job_data.get("progress", 0)),
+            "output_path": job_data.get("output_path") or None,
+            "error": job_data.get("error") or None
+        }
+    
+    return {"batch_id": batch_id, "status": batch_data.get("status"), "outputs": outputs}
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Get conversion cache usage and hit/miss counters"""
+    stats = await redis_client.hgetall(CACHE_STATS_KEY)
+    hits = int(stats.get("hits", 0))
+    misses = int(stats.get("misses", 0))
+    return {
+        "enabled": settings.conversion_cache_enabled,
+        "entries": await redis_client.hlen(CACHE_ENTRIES_KEY),
+        "bytes": int(await redis_client.get(CACHE_BYTES_KEY) or 0),
+        "max_bytes": settings.conversion_cache_max_bytes,
+        "hits": hits,
+        "misses": misses,
+        "coalesced": int(stats.get("coalesced", 0)),
+        "evictions": int(stats.get("evictions", 0)),
+        "evicted_bytes": int(stats.get("evicted_bytes", 0)),
+        "hit_ratio": round(hits / (hits + misses), 3) if hits + misses else 0
+    }
+
+
+@app.get("/queue")
+async def queue_status():
+    """Get conversion queue depth and this worker's slot usage"""
+    return {
+        "pending": await redis_client.llen(QUEUE_KEY),
+        "processing": await redis_client.llen(PROCESSING_KEY),
+        "worker": {
+            "id": worker_id,
+            "role": settings.converter_role,
+            "slots_total": capacity_pool.total,
+            "slots_used": capacity_pool.used,
+            "running": capacity_pool.running
+        }
+    }
+
+
+@app.get("/encoding/policy")
+async def encoding_policy(limit: int = 50):
+    """Get learned encoder speeds and the most recent policy decisions"""
+    decisions = await redis_client.lrange(POLICY_LOG_KEY, 0, max(limit, 1) - 1)
+    speeds = await redis_client.hgetall(POLICY_SPEEDS_KEY)
+    return {
+        "enabled": settings.encoding_policy_enabled,
+        "target_turnaround": settings.encoding_target_turnaround,
+        "speeds": {field: float(value) for field, value in speeds.items()},
+        "decisions": [json.loads(d) for d in decisions]
+    }
+
+
+@app.get("/remux/stats")
+async def remux_stats():
+    """Get job counts, wall time and encode time saved per conversion strategy"""
+    stats = await redis_client.hgetall(REMUX_STATS_KEY)
+    strategies = {}
+    for strategy in STRATEGIES:
+        strategies[strategy] = {
+            "jobs": int(stats.get(f"{strategy}:jobs", 0)),
+            "wall_seconds": round(float(stats.get(f"{strategy}:wall_seconds", 0)), 1),
+            "media_seconds": round(float(stats.get(f"{strategy}:media_seconds", 0)), 1),
+            "saved_seconds": round(float(stats.get(f"{strategy}:saved_seconds", 0)), 1)
+        }
+    return {
+        "strategies": strategies,
+        "total_saved_seconds": round(sum(s["saved_seconds"] for s in strategies.values()), 1)
+    }
 
 
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...), profile: str = Form(None)):
+async def upload_file(request: Request, file: UploadFile = File(...), profile: str = Form(None)):
     """Upload a file for conversion"""
-    job_id = str(uuid.uuid4())
+    if int(request.headers.get("content-length") or 0) > settings.max_upload_bytes:
+        raise HTTPException(status_code=413, detail="Upload exceeds the size limit")
     
-    # Save uploaded file
-    upload_dir = os.path.join(settings.storage_path, "uploads")
-    os.makedirs(upload_dir, exist_ok=True)
-    
-    file_path = os.path.join(upload_dir, f"{job_id}_{file.filename}")
+    job_id = str(uuid.uuid4())
+    filename = os.path.basename(file.filename)
+    file_path = get_upload_path(job_id, filename)
+    part_path = f"{file_path}.part"
     
-    async with aiofiles.open(file_path, 'wb') as f:
-        content = await file.read()
-        await f.write(content)
+    # Copy in fixed-size chunks, hashing as we go, so the file is never held in memory
+    sha = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(part_path, 'wb') as f:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > settings.max_upload_bytes:
+                    raise HTTPException(status_code=413, detail="Upload exceeds the size limit")
+                await f.write(chunk)
+                sha.update(chunk)
+        await finalize_upload(part_path, file_path, sha.hexdigest())
+    except BaseException:
+        await asyncio.to_thread(remove_if_exists, part_path)
+        raise
     
     return {
         "job_id": job_id,
         "file_path": file_path,
-        "filename": file.filename,
-        "size": len(content)
+        "filename": filename,
+        "size": size,
+        "sha256": sha.hexdigest()
     }
 
 
+@app.post("/uploads")
+async def create_upload_session(request: UploadSessionRequest):
+    """Start a resumable upload; send the bytes with PATCH /uploads/{upload_id}"""
+    if request.size <= 0:
+        raise HTTPException(status_code=400, detail="Upload size must be positive")
+    if request.size > settings.max_upload_bytes:
+        raise HTTPException(status_code=413, detail="Upload exceeds the size limit")
+    
+    upload_id = str(uuid.uuid4())
+    filename = os.path.basename(request.filename)
+    file_path = get_upload_path(upload_id, filename)
+    part_path = f"{file_path}.part"
+    async with aiofiles.open(part_path, 'wb'):
+        pass
+    
+    await redis_client.hset(get_upload_key(upload_id), mapping={
+        "upload_id": upload_id,
+        "filename": filename,
+        "file_path": file_path,
+        "part_path": part_path,
+        "size": request.size,
+        "offset": 0,
+        "status": "uploading"
+    })
+    await redis_client.expire(get_upload_key(upload_id), settings.upload_session_ttl)
+    
+    return {
+        "upload_id": upload_id,
+        "size": request.size,
+        "offset": 0,
+        "upload_url": f"/uploads/{upload_id}"
+    }
+
+
+@app.head("/uploads/{upload_id}")
+async def get_upload_offset(upload_id: str):
+    """Report how many bytes of a resumable upload have been received"""
+    session = await redis_client.hgetall(get_upload_key(upload_id))
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return Response(headers={
+        "Upload-Offset": session["offset"],
+        "Upload-Length": session["size"],
+        "Cache-Control": "no-store"
+    })
+
+
+@app.patch("/uploads/{upload_id}")
+async def append_upload(upload_id: str, request: Request, upload_offset: int = Header(...)):
+    """Append the request body to a resumable upload at Upload-Offset"""
+    if not await redis_client.exists(get_upload_key(upload_id)):
+        raise HTTPException(status_code=404, detail="Upload not found")
+    token = f"{worker_id}:{uuid.uuid4().hex}"
+    lock_key = get_upload_lock_key(upload_id)
+    if not await redis_client.set(lock_key, token, nx=True, ex=UPLOAD_LOCK_SECONDS):
+        raise HTTPException(status_code=409, detail="Another chunk is being written")
+    try:
+        return await write_upload_chunk(upload_id, request, upload_offset, token)
+    finally:
+        await redis_client.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+
+
+async def write_upload_chunk(upload_id: str, request: Request, upload_offset: int, token: str):
+    """Write one PATCH body while holding the upload's lock"""
+    # Read the session under the lock: an earlier PATCH may have just moved it
+    session = await redis_client.hgetall(get_upload_key(upload_id))
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    if session["status"] == "completed":
+        return upload_session_result(session)
+    
+    offset = int(session["offset"])
+    size = int(session["size"])
+    if upload_offset != offset:
+        raise HTTPException(status_code=409, detail="Upload-Offset does not match",
+                            headers={"Upload-Offset": str(offset)})
+    
+    # The running hash only lives in this process; if the upload moved
+    # between replicas the file is hashed once at the end instead
+    hashed_offset, sha = upload_hashers.pop(upload_id, (0, hashlib.sha256()))
+    if hashed_offset != offset:
+        sha = None
+    
+    lock_key = get_upload_lock_key(upload_id)
+    refreshed = time.monotonic()
+    written = 0
+    try:
+        async with aiofiles.open(session["part_path"], 'r+b') as f:
+            # Drop any tail left by an interrupted request that was never acknowledged
+            await f.truncate(offset)
+            await f.seek(offset)
+            async for chunk in request.stream():
+                if offset + written + len(chunk) > size:
+                    raise HTTPException(status_code=413, detail="Chunk exceeds the declared upload size")
+                await f.write(chunk)
+                written += len(chunk)
+                if sha:
+                    sha.update(chunk)
+                if time.monotonic() - refreshed > UPLOAD_LOCK_SECONDS / 3:
+                    refreshed = time.monotonic()
+                    if not await redis_client.eval(REFRESH_LOCK_SCRIPT, 1, lock_key,
+                                                   token, UPLOAD_LOCK_SECONDS):
+                        # Another PATCH owns the upload now; its offset stands
+                        written = 0
+                        sha = None
+                        raise HTTPException(status_code=409, detail="Upload lock lost")
+    except ClientDisconnect:
+        # Keep what arrived; the client resumes from the offset HEAD reports
+        pass
+    finally:
+        if written:
+            offset += written
+            await redis_client.hset(get_upload_key(upload_id), "offset", offset)
+        await redis_client.expire(get_upload_key(upload_id), settings.upload_session_ttl)
+        if sha and offset < size:
+            upload_hashers[upload_id] = (offset, sha)
+    
+    if offset < size:
+        return Response(status_code=204, headers={"Upload-Offset": str(offset)})
+    
+    digest = sha.hexdigest() if sha else await asyncio.to_thread(hash_file, session["part_path"])
+    await finalize_upload(session["part_path"], session["file_path"], digest)
+    session.update({"offset": offset, "status": "completed", "sha256": digest})
+    await redis_client.hset(get_upload_key(upload_id), mapping={
+        "status": "completed",
+        "sha256": digest
+    })
+    return upload_session_result(session)
+
+
 @app.get("/status/{job_id}")
 async def get_status(job_id: str):
     """Get conversion job status"""
-    job_data = redis_client.hgetall(get_job_key(job_id))
+    job_data = await redis_client.hgetall(get_job_key(job_id))
     
     if not job_data:
         raise HTTPException(status_code=404, detail="Job not found")
@@ -424,7 +2442,8 @@ async def get_status(job_id: str):
         status=job_data.get("status", "unknown"),
         progress=float(job_data.get("progress", 0)),
         output_path=job_data.get("output_path") or None,
-        error=job_data.get("error") or None
+        error=job_data.get("error") or None,
+        strategy=job_data.get("strategy") or None
     )
 
 
@@ -434,7 +2453,7 @@ async def get_info(path: str):
     if not os.path.exists(path):
         raise HTTPException(status_code=404, detail="File not found")
     
-    return get_media_info(path)
+    return await get_media_info(path)
 
 
 @app.post("/thumbnail")
@@ -450,15 +2469,20 @@ async def generate_thumbnail(input_path: str, time: str = "00:00:01"):
     output_path = os.path.join(thumb_dir, f"{job_id}.jpg")
     
     cmd = [
-        "ffmpeg", "-y", "-i", input_path,
-        "-ss", time, "-vframes", "1",
+        "ffmpeg", "-y", "-ss", time, "-i", input_path,
+        "-vframes", "1",
         "-vf", "scale=320:180",
         output_path
     ]
     
-    result = subprocess.run(cmd, capture_output=True)
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    await process.wait()
     
-    if result.returncode == 0:
+    if process.returncode == 0:
         return {"thumbnail_path": output_path}
     else:
         raise HTTPException(status_code=500, detail="Failed to generate thumbnail")
@@ -467,7 +2491,7 @@ async def generate_thumbnail(input_path: str, time: str = "00:00:01"):
 @app.get("/download/{job_id}")
 async def download_file(job_id: str):
     """Download converted file"""
-    job_data = redis_client.hgetall(get_job_key(job_id))
+    job_data = await redis_client.hgetall(get_job_key(job_id))
     
     if not job_data:
         raise HTTPException(status_code=404, detail="Job not found")
@@ -487,5 +2511,9 @@ async def download_file(job_id: str):
 
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        # Standalone worker process: `python -m src.main worker`
+        asyncio.run(run_worker())
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,160 @@
+"""
+AllOne Converter - encoding policy benchmark
+Measures speed, bitrate and SSIM of every encoder speed tier on lavfi sources
+
+The ladder run encodes a synthetic source with each tier and thread count
+locally. --seed-profile stores the measured per-thread speeds as the policy's
+starting estimates, and --load-jobs submits conversions to a running service
+and prints the tier the policy chose at each queue depth.
+
+    docker compose exec -T converter python - --seed-profile youtube_hd < services/converter/benchmarks/encoding_policy.py
+    docker compose exec -T converter python - --skip-ladder --load-jobs 12 < services/converter/benchmarks/encoding_policy.py
+"""
+import os
+import re
+import time
+import tempfile
+import argparse
+import subprocess
+
+# Must match ENCODER_LADDERS in app/main.py
+LADDERS = {
+    "libx264": ["slow", "medium", "fast", "veryfast", "superfast", "ultrafast"],
+    "libx265": ["slow", "medium", "fast", "veryfast", "superfast", "ultrafast"],
+    "libvpx-vp9": ["1", "2", "3", "4", "5"]
+}
+POLICY_SPEEDS_KEY = "encoding:policy:speeds"
+
+
+def lavfi_source(size: str, rate: int, seconds: int) -> list:
+    return ["-f", "lavfi", "-i", f"testsrc2=size={size}:rate={rate}:duration={seconds}"]
+
+
+def tier_args(codec: str, tier: str, threads: int) -> list:
+    if codec == "libvpx-vp9":
+        tiles = min(threads.bit_length() - 1, 4)
+        return ["-c:v", codec, "-crf", "30", "-b:v", "0", "-deadline", "good",
+                "-cpu-used", tier, "-row-mt", "1", "-tile-columns", str(tiles),
+                "-threads", str(threads)]
+    args = ["-c:v", codec, "-crf", "23", "-preset", tier, "-threads", str(threads)]
+    if codec == "libx265":
+        args += ["-x265-params", f"pools={threads}"]
+    return args
+
+
+def measure_ssim(path: str, source: list) -> float:
+    result = subprocess.run(
+        ["ffmpeg", "-v", "info", "-i", path] + source +
+        ["-lavfi", "[0:v][1:v]ssim", "-f", "null", "-"],
+        capture_output=True, text=True
+    )
+    match = re.search(r"All:([\d.]+)", result.stderr)
+    return float(match.group(1)) if match else 0
+
+
+def run_ladder(args) -> list:
+    source = lavfi_source(args.size, args.rate, args.seconds)
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for codec in args.codecs:
+            extension = "webm" if codec == "libvpx-vp9" else "mkv"
+            for tier in LADDERS[codec]:
+                for threads in args.threads:
+                    output = os.path.join(work_dir, f"out.{extension}")
+                    started = time.perf_counter()
+                    subprocess.run(
+                        ["ffmpeg", "-y", "-v", "error"] + source +
+                        tier_args(codec, tier, threads) + [output],
+                        check=True
+                    )
+                    elapsed = time.perf_counter() - started
+                    results.append({
+                        "codec": codec,
+                        "tier": tier,
+                        "threads": threads,
+                        "speed": args.seconds / elapsed,
+                        "thread_speed": args.seconds / elapsed / threads,
+                        "kbps": os.path.getsize(output) * 8 / args.seconds / 1000,
+                        "ssim": measure_ssim(output, source)
+                    })
+                    r = results[-1]
+                    print(f"{codec:<11} {tier:<10} {threads:>3} threads  "
+                          f"{r['speed']:6.2f}x realtime  {r['thread_speed']:6.3f}x/thread  "
+                          f"{r['kbps']:8.0f} kb/s  SSIM {r['ssim']:.4f}")
+    return results
+
+
+def seed_speeds(results: list, profile: str, redis_url: str):
+    """Store the best per-thread speed of each tier as the policy's estimate"""
+    import redis
+    client = redis.Redis.from_url(redis_url, decode_responses=True)
+    speeds = {}
+    for r in results:
+        field = f"{profile}:{r['codec']}:{r['tier']}"
+        speeds[field] = round(max(speeds.get(field, 0), r["thread_speed"]), 4)
+    client.hset(POLICY_SPEEDS_KEY, mapping=speeds)
+    print(f"seeded {len(speeds)} speed estimates for profile {profile}")
+
+
+def run_load(args):
+    """Submit jobs to the service and show the tier chosen at each queue depth"""
+    import httpx
+    source = os.path.join(args.storage_path, "uploads", "bench_policy_source.mp4")
+    os.makedirs(os.path.dirname(source), exist_ok=True)
+    job_ids = []
+    with httpx.Client(base_url=args.base_url, timeout=30) as client:
+        for i in range(args.load_jobs):
+            # A distinct source per job keeps the result cache out of the way
+            path = source.replace(".mp4", f"_{i}.mp4")
+            subprocess.run(
+                ["ffmpeg", "-y", "-v", "error"] + lavfi_source(args.size, args.rate, args.seconds) +
+                ["-c:v", "libx264", "-preset", "ultrafast", "-metadata", f"comment={time.time()}", path],
+                check=True
+            )
+            response = client.post("/convert", json={
+                "input_path": path,
+                "output_format": args.profile,
+                "segmented": False
+            })
+            response.raise_for_status()
+            job_ids.append(response.json()["job_id"])
+
+        pending = set(job_ids)
+        while pending:
+            time.sleep(1)
+            for job_id in list(pending):
+                status = client.get(f"/status/{job_id}").json()["status"]
+                if status in ("completed", "failed"):
+                    pending.discard(job_id)
+
+        decisions = client.get("/encoding/policy", params={"limit": 1000}).json()["decisions"]
+
+    chosen = [d for d in reversed(decisions) if d["job_id"] in job_ids]
+    for d in chosen:
+        print(f"queue depth {d['queue_depth']:>3}  {d['codec']:<11} {d['tier']:<10} "
+              f"{d['threads']:>2} threads  est. {d['estimated_turnaround']:7.1f}s "
+              f"(target {d['target_turnaround']:.0f}s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[1])
+    parser.add_argument("--codecs", nargs="+", default=["libx264", "libvpx-vp9"], choices=list(LADDERS))
+    parser.add_argument("--threads", nargs="+", type=int, default=[2, 4])
+    parser.add_argument("--size", default="1920x1080")
+    parser.add_argument("--rate", type=int, default=30)
+    parser.add_argument("--seconds", type=int, default=10, help="Source length in seconds")
+    parser.add_argument("--skip-ladder", action="store_true")
+    parser.add_argument("--seed-profile", help="Store measured speeds for this profile")
+    parser.add_argument("--redis-url", default="redis://redis:6379/0")
+    parser.add_argument("--load-jobs", type=int, default=0)
+    parser.add_argument("--profile", default="youtube_hd")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--storage-path", default="/app/storage")
+    args = parser.parse_args()
+
+    if not args.skip_ladder:
+        results = run_ladder(args)
+        if args.seed_profile:
+            seed_speeds(results, args.seed_profile, args.redis_url)
+    if args.load_jobs:
+        run_load(args)
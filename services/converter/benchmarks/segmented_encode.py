@@ -0,0 +1,108 @@
+"""
+AllOne Converter - segmented encoding benchmark
+Compares wall time of single-process and segmented (chunked) conversions
+
+Run inside the converter container so the generated source file is visible
+to the service:
+
+    docker compose exec -T converter python - --duration 1200 < services/converter/benchmarks/segmented_encode.py
+
+Each run converts a fresh remux of the same source so the result cache
+never answers it.
+"""
+import os
+import time
+import uuid
+import asyncio
+import argparse
+import subprocess
+import httpx
+
+
+def make_source(path: str, seconds: int):
+    """Create a synthetic test video with ffmpeg's lavfi sources"""
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={seconds}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-g", "60",
+        "-c:a", "aac", "-shortest",
+        path
+    ], check=True)
+
+
+def make_unique_copy(source: str) -> str:
+    """Remux the source with a unique tag so its content hash is new"""
+    tag = uuid.uuid4().hex
+    path = f"{os.path.splitext(source)[0]}_{tag[:8]}.mp4"
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error", "-i", source,
+        "-c", "copy", "-metadata", f"comment={tag}", path
+    ], check=True)
+    return path
+
+
+def probe_duration(path: str) -> float:
+    result = subprocess.run([
+        "ffprobe", "-v", "error", "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1", path
+    ], capture_output=True, text=True)
+    return float(result.stdout.strip() or 0)
+
+
+async def convert(client: httpx.AsyncClient, source: str, profile: str,
+                  segmented: bool) -> tuple:
+    """Run one conversion to completion; returns (wall seconds, output path)"""
+    started = time.perf_counter()
+    response = await client.post("/convert", json={
+        "input_path": source,
+        "output_format": profile,
+        "segmented": segmented
+    })
+    response.raise_for_status()
+    job = response.json()
+    if job.get("segmented") != segmented:
+        raise RuntimeError(f"Expected segmented={segmented}, got {job}")
+    
+    while True:
+        status = (await client.get(f"/status/{job['job_id']}")).json()
+        if status["status"] == "completed":
+            return time.perf_counter() - started, status["output_path"]
+        if status["status"] == "failed":
+            raise RuntimeError(status["error"])
+        await asyncio.sleep(0.5)
+
+
+async def main(args):
+    make_source(args.source, args.duration)
+    
+    results = {}
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=30) as client:
+        queue = (await client.get("/queue")).json()
+        for segmented in (False, True):
+            source = make_unique_copy(args.source)
+            try:
+                elapsed, output_path = await convert(client, source, args.profile, segmented)
+            finally:
+                os.remove(source)
+            results[segmented] = (elapsed, probe_duration(output_path))
+    
+    single, segmented = results[False], results[True]
+    print(f"source:           {args.duration}s 720p30, profile {args.profile}")
+    print(f"worker slots:     {queue['worker']['slots_total']} "
+          f"(other replicas sharing the queue also take chunks)")
+    print(f"single process:   {single[0]:.1f}s wall, output {single[1]:.2f}s")
+    print(f"segmented:        {segmented[0]:.1f}s wall, output {segmented[1]:.2f}s")
+    print(f"speedup:          {single[0] / segmented[0]:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[1])
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--profile", default="youtube_hd")
+    parser.add_argument("--duration", type=int, default=1200, help="Source length in seconds")
+    parser.add_argument("--source", default="/app/storage/uploads/bench_long_source.mp4")
+    asyncio.run(main(parser.parse_args()))
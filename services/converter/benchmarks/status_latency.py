@@ -0,0 +1,98 @@
+"""
+AllOne Converter - /status latency benchmark
+Measures GET /status/{job_id} latency while conversions are running
+
+Run inside the converter container so the generated source file is visible
+to the service:
+
+    docker compose exec -T converter python - --jobs 20 < services/converter/benchmarks/status_latency.py
+"""
+import os
+import time
+import asyncio
+import argparse
+import subprocess
+import httpx
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def make_source(path: str, seconds: int):
+    """Create a synthetic test video with ffmpeg's lavfi sources"""
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={seconds}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-shortest",
+        path
+    ], check=True)
+
+
+async def poll_status(client: httpx.AsyncClient, job_ids: list, requests: int,
+                      latencies: list):
+    for i in range(requests):
+        job_id = job_ids[i % len(job_ids)]
+        started = time.perf_counter()
+        response = await client.get(f"/status/{job_id}")
+        latencies.append((time.perf_counter() - started) * 1000)
+        response.raise_for_status()
+
+
+async def main(args):
+    make_source(args.source, args.duration)
+    
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=30) as client:
+        job_ids = []
+        for _ in range(args.jobs):
+            # Identical jobs would otherwise coalesce into one cached conversion
+            response = await client.post("/convert", json={
+                "input_path": args.source,
+                "output_format": args.profile,
+                "cache": False
+            })
+            response.raise_for_status()
+            job_ids.append(response.json()["job_id"])
+        
+        # Give the workers a moment to start ffmpeg
+        await asyncio.sleep(2)
+        
+        latencies = []
+        started = time.perf_counter()
+        per_client = args.requests // args.concurrency
+        await asyncio.gather(*(
+            poll_status(client, job_ids, per_client, latencies)
+            for _ in range(args.concurrency)
+        ))
+        elapsed = time.perf_counter() - started
+        
+        queue = (await client.get("/queue")).json()
+    
+    print(f"jobs submitted:   {args.jobs} ({args.profile})")
+    print(f"queue:            {queue['pending']} pending, {queue['processing']} processing")
+    print(f"requests:         {len(latencies)} in {elapsed:.2f}s "
+          f"({len(latencies) / elapsed:.0f} req/s, concurrency {args.concurrency})")
+    print(f"latency p50:      {percentile(latencies, 50):.2f} ms")
+    print(f"latency p95:      {percentile(latencies, 95):.2f} ms")
+    print(f"latency p99:      {percentile(latencies, 99):.2f} ms")
+    print(f"latency max:      {max(latencies):.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[1])
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--profile", default="youtube_hd")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=int, default=120, help="Source length in seconds")
+    parser.add_argument("--source", default="/app/storage/uploads/bench_source.mp4")
+    asyncio.run(main(parser.parse_args()))
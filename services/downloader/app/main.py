@@ -7,6 +7,17 @@ import uuid
 import asyncio
 import json
 import re
+import time
+import hmac
+import hashlib
+import socket
+import queue
+import signal
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 from typing import Optional, List
 from datetime import datetime, timezone
 from fastapi import FastAPI, HTTPException, BackgroundTasks
@@ -14,10 +25,9 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
-import redis
+import redis.asyncio as aioredis
 import httpx
 import yt_dlp
-import pusher
 
 
 class Settings(BaseSettings):
@@ -30,6 +40,37 @@ class Settings(BaseSettings):
     pusher_app_id: str = "100001"  # Must match Soketi config
     pusher_key: str = "allone-key"
     pusher_secret: str = "allone-secret"
+    pusher_timeout: float = 5.0
+    redis_max_connections: int = 50
+    redis_socket_timeout: float = 5.0
+    # Download executor: worker processes, concurrent jobs per site, and a
+    # per-job time limit (s)
+    download_workers: int = 4
+    download_site_limit: int = 2
+    download_timeout: float = 3 * 3600
+    # Progress publishing: minimum interval (s) between updates per job
+    progress_min_interval: float = 1.0
+    # Extracted info dicts are reused by /info and /download for this long (s);
+    # kept short because the format URLs inside them expire
+    info_cache_ttl: int = 600
+    # How long (s) a job's output path stays looked up by GET /output
+    output_index_ttl: int = 30 * 86400
+    # High-throughput mode: parallel HLS/DASH fragments, multi-connection
+    # plain HTTP downloads (aria2c, when installed) and chunked HTTP requests
+    download_fast_mode: bool = True
+    download_concurrent_fragments: int = 8
+    download_connections: int = 8  # aria2c connections per file
+    download_http_chunk_size: int = 10 * 1024 * 1024
+    # Bandwidth budgets in bytes/s (0 = unlimited): per job, and shared by
+    # all running jobs
+    download_rate_limit: int = 0
+    download_total_rate_limit: int = 0
+    # Pipeline orchestrator: converter events stream and consumer group, and
+    # the idle time (s) after which events unacked by a dead consumer are
+    # claimed (also how often claiming and retrying our own pending events runs)
+    conversion_events_stream: str = "conversion:events"
+    pipeline_consumer_group: str = "downloader"
+    pipeline_claim_idle: int = 60
     
     class Config:
         env_file = ".env"
@@ -47,21 +88,82 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Redis connection
-redis_client = redis.Redis(
-    host=settings.redis_host,
-    port=settings.redis_port,
-    decode_responses=True
+# Redis connection (async, pooled)
+redis_client = aioredis.Redis(
+    connection_pool=aioredis.ConnectionPool(
+        host=settings.redis_host,
+        port=settings.redis_port,
+        decode_responses=True,
+        max_connections=settings.redis_max_connections,
+        socket_timeout=settings.redis_socket_timeout,
+        socket_connect_timeout=2,
+        socket_keepalive=True,
+        health_check_interval=30,
+        retry_on_timeout=True
+    )
 )
 
+
+class AsyncPusher:
+    """Async Pusher HTTP API client with keep-alive connections and timeouts"""
+    
+    def __init__(self, app_id: str, key: str, secret: str, host: str,
+                 port: int, ssl: bool = False, timeout: float = 5.0):
+        self.app_id = app_id
+        self.key = key
+        self.secret = secret
+        scheme = "https" if ssl else "http"
+        self.client = httpx.AsyncClient(
+            base_url=f"{scheme}://{host}:{port}",
+            timeout=httpx.Timeout(timeout, connect=2.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10,
+                                keepalive_expiry=30)
+        )
+    
+    def _sign(self, path: str, body: bytes) -> dict:
+        params = {
+            "auth_key": self.key,
+            "auth_timestamp": str(int(time.time())),
+            "auth_version": "1.0",
+            "body_md5": hashlib.md5(body).hexdigest()
+        }
+        query = "&".join(f"{k}={params[k]}" for k in sorted(params))
+        string_to_sign = f"POST\n{path}\n{query}"
+        params["auth_signature"] = hmac.new(
+            self.secret.encode(), string_to_sign.encode(), hashlib.sha256
+        ).hexdigest()
+        return params
+    
+    async def _post(self, path: str, payload: dict):
+        body = json.dumps(payload).encode()
+        response = await self.client.post(
+            path,
+            content=body,
+            params=self._sign(path, body),
+            headers={"Content-Type": "application/json"}
+        )
+        response.raise_for_status()
+    
+    async def trigger(self, channel: str, event_name: str, data: dict):
+        await self._post(f"/apps/{self.app_id}/events", {
+            "name": event_name,
+            "channels": [channel],
+            "data": json.dumps(data)
+        })
+    
+    async def aclose(self):
+        await self.client.aclose()
+
+
 # Pusher client for broadcasting (same as torrent service)
-pusher_client = pusher.Pusher(
+pusher_client = AsyncPusher(
     app_id=settings.pusher_app_id,
     key=settings.pusher_key,
     secret=settings.pusher_secret,
     host=settings.pusher_host,
     port=settings.pusher_port,
-    ssl=False
+    ssl=False,
+    timeout=settings.pusher_timeout
 )
 
 
@@ -70,11 +172,14 @@ class DownloadRequest(BaseModel):
     format: Optional[str] = "best"
     convert_to: Optional[str] = None
     job_id: Optional[str] = None
+    # Stages to run, e.g. ["download", "convert", "thumbnail"]; defaults to
+    # download, then convert when convert_to is set
+    pipeline: Optional[List[str]] = None
 
 
 class DownloadStatus(BaseModel):
     job_id: str
-    status: str  # pending, downloading, converting, completed, failed
+    status: str  # pending, downloading, converting, completed, failed, cancelled
     progress: float
     title: Optional[str] = None
     output_path: Optional[str] = None
@@ -95,6 +200,22 @@ def get_job_key(job_id: str) -> str:
     return f"download:job:{job_id}"
 
 
+def get_output_key(job_id: str) -> str:
+    """job_id -> final output path; outlives the 24h job hash"""
+    return f"download:output:{job_id}"
+
+
+def get_download_dir(job_id: str) -> str:
+    """Sharded download directory for a job: downloads/ab/cd/ from the job id hash
+    
+    The API's QueueController::destroy() computes the same path.
+    """
+    digest = hashlib.sha1(job_id.encode()).hexdigest()
+    download_dir = os.path.join(settings.storage_path, "downloads", digest[:2], digest[2:4])
+    os.makedirs(download_dir, exist_ok=True)
+    return download_dir
+
+
 def get_thumbnail_path(job_id: str) -> str:
     """Get local thumbnail path for a job"""
     thumb_dir = os.path.join(settings.storage_path, "thumbnails")
@@ -127,9 +248,9 @@ async def download_thumbnail(url: str, job_id: str) -> Optional[str]:
     return url
 
 
-def broadcast_job_update(job_id: str, status: str, progress: float = 0,
-                         title: str = None, output_path: str = None,
-                         error: str = None, thumbnail: str = None):
+async def broadcast_job_update(job_id: str, status: str, progress: float = 0,
+                               title: str = None, output_path: str = None,
+                               error: str = None, thumbnail: str = None):
     """Broadcast job update via Pusher/Soketi WebSocket"""
     try:
         event_data = {
@@ -146,15 +267,15 @@ def broadcast_job_update(job_id: str, status: str, progress: float = 0,
             },
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
-        pusher_client.trigger('jobs', 'job.updated', event_data)
+        await pusher_client.trigger('jobs', 'job.updated', event_data)
         print(f"📡 Broadcast: {job_id} - {status} - {progress}%")
     except Exception as e:
         print(f"Failed to broadcast job update: {e}")
 
 
-def update_job_status(job_id: str, status: str, progress: float = 0,
-                      title: str = None, output_path: str = None, 
-                      error: str = None, thumbnail: str = None):
+async def update_job_status(job_id: str, status: str, progress: float = 0,
+                            title: str = None, output_path: str = None, 
+                            error: str = None, thumbnail: str = None):
     """Update job status in Redis and broadcast via WebSocket"""
     job_data = {
         "job_id": job_id,
@@ -165,189 +286,775 @@ def update_job_status(job_id: str, status: str, progress: float = 0,
         "error": error or "",
         "thumbnail": thumbnail or ""
     }
-    redis_client.hset(get_job_key(job_id), mapping=job_data)
-    redis_client.expire(get_job_key(job_id), 86400)  # 24h expiry
-    
-    # Publish status update to Redis
-    redis_client.publish(f"download:status:{job_id}", json.dumps(job_data))
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(get_job_key(job_id), mapping=job_data)
+        pipe.expire(get_job_key(job_id), 86400)  # 24h expiry
+        # Publish status update to Redis
+        pipe.publish(f"download:status:{job_id}", json.dumps(job_data))
+        await pipe.execute()
     
     # Broadcast via Pusher/WebSocket
-    broadcast_job_update(job_id, status, progress, title, output_path, error, thumbnail)
+    await broadcast_job_update(job_id, status, progress, title, output_path, error, thumbnail)
+
+
+# ===========================================
+# Info cache
+# ===========================================
+# Extraction (page fetch plus JS challenge solving) is the slow part of a
+# job, so it happens once per URL: /info and the download worker share the
+# same options, and the sanitized info dict is cached in Redis under the
+# normalized URL. A download given a cached info dict goes straight to
+# format selection via process_ie_result.
+
+INFO_KEY_PREFIX = "download:info:"
+TRACKING_PARAMS = {"si", "feature", "fbclid", "gclid", "igshid"}
+
+# Options that change what extraction returns; /info and downloads must agree
+YDL_EXTRACT_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'noplaylist': True,
+    'js_runtimes': {'node': {}},  # Use Node.js for JS challenges (required for YouTube)
+    'extractor_args': {
+        'youtube': {
+            'player_client': ['android', 'web'],  # Use multiple clients for better format availability
+        }
+    },
+    'http_headers': {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    },
+    'no_check_certificate': True,
+    # Stalled connections must fail so the job's deadline can be enforced
+    'socket_timeout': 30,
+}
+
+
+def normalize_url(url: str) -> str:
+    """Canonical form of a URL for the info cache
+    
+    Lowercases scheme and host, drops www., fragments and tracking
+    parameters, and sorts the query.
+    """
+    parts = urlparse(url.strip())
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if parts.port:
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.startswith("utm_") and k not in TRACKING_PARAMS
+    )
+    return urlunparse((parts.scheme.lower(), host, parts.path.rstrip("/") or "/",
+                       "", urlencode(query), ""))
+
+
+def get_info_key(url: str) -> str:
+    return INFO_KEY_PREFIX + hashlib.sha1(normalize_url(url).encode()).hexdigest()
+
+
+async def get_cached_info(url: str) -> Optional[dict]:
+    try:
+        data = await redis_client.get(get_info_key(url))
+        return json.loads(data) if data else None
+    except Exception as e:
+        print(f"Info cache read failed: {e}")
+        return None
+
+
+async def cache_video_info(url: str, info: dict):
+    try:
+        await redis_client.set(get_info_key(url), json.dumps(info), ex=settings.info_cache_ttl)
+    except Exception as e:
+        print(f"Info cache write failed: {e}")
+
+
+def extract_video_info(url: str, ydl_opts: dict) -> dict:
+    """Blocking yt-dlp metadata extraction; runs in the download pool
+    
+    Returns the sanitized (JSON-safe) info dict, as cached and as accepted by
+    process_ie_result.
+    """
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return ydl.sanitize_info(ydl.extract_info(url, download=False), remove_private_keys=True)
+
+
+# ===========================================
+# Download executor
+# ===========================================
+# yt-dlp runs in a pool of worker processes, so extraction (JS challenges
+# included) and downloads never hold the event loop or the GIL. Workers send
+# progress through a Manager queue to one async publisher, which throttles
+# it into Redis/Pusher updates. Jobs are limited per site, and cancellation
+# and timeouts are flags the worker's progress hook checks. Bandwidth budgets
+# are shared the same way: the parent splits the global budget across
+# running jobs and each worker's hook sleeps while its job is over budget.
+
+download_pool: Optional[ProcessPoolExecutor] = None
+progress_manager = None
+progress_queue = None
+cancel_flags = None  # job_id -> reason, shared with the workers
+rate_limits = None  # job_id -> bytes/s (0 = unlimited), shared with the workers
+running_jobs = set()  # job ids currently in a worker
+site_slots = {}  # site -> asyncio.Semaphore
+active_jobs = {}  # job_id -> {"title", "thumbnail", "progress"}
+# Loops, jobs and pipelines; the event loop only holds weak references to tasks
+background_tasks = set()
+
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 
-class DownloadProgressHook:
-    def __init__(self, job_id: str):
+class WorkerProgressHook:
+    """yt-dlp progress hook inside a worker process
+    
+    Queues throttled progress for the publisher, holds the job to its
+    bandwidth budget and aborts the download once the job is cancelled or
+    past its deadline.
+    """
+    
+    def __init__(self, job_id: str, progress_queue, cancel_flags, rate_limits,
+                 deadline: float, min_interval: float):
         self.job_id = job_id
-        self.title = None
-        self.thumbnail = None
+        self.progress_queue = progress_queue
+        self.cancel_flags = cancel_flags
+        self.rate_limits = rate_limits
+        self.deadline = deadline
+        self.min_interval = min_interval
+        self.last_sent = 0
+        self.rate = 0
+        self.rate_checked = 0
+        self.rate_start = (0, 0)  # (monotonic time, downloaded bytes)
+        self.last_bytes = 0
+    
+    def cancel_reason(self) -> Optional[str]:
+        if time.time() > self.deadline:
+            return "Download timed out"
+        return self.cancel_flags.get(self.job_id)
+    
+    def check_cancelled(self):
+        reason = self.cancel_reason()
+        if reason:
+            raise yt_dlp.utils.DownloadCancelled(reason)
+    
+    def watch(self, stop: threading.Event):
+        """Cancel external downloaders (aria2c, ffmpeg), which never call the hook"""
+        while not stop.wait(self.min_interval):
+            if self.cancel_reason():
+                kill_child_processes()
+                return
+    
+    def throttle(self, downloaded: int, now: float):
+        """Sleep while the job is over its budget; the rate is re-read every interval"""
+        if now - self.rate_checked >= self.min_interval:
+            self.rate_checked = now
+            rate = self.rate_limits.get(self.job_id) or 0
+            if rate != self.rate:
+                self.rate = rate
+                self.rate_start = (now, downloaded)
+        # A new file (video, then audio) restarts the byte count
+        if downloaded < self.last_bytes:
+            self.rate_start = (now, downloaded)
+        self.last_bytes = downloaded
+        if not self.rate:
+            return
+        started, start_bytes = self.rate_start
+        delay = (downloaded - start_bytes) / self.rate - (now - started)
+        if delay > 0:
+            time.sleep(delay)
     
     def __call__(self, d):
+        now = time.monotonic()
         if d['status'] == 'downloading':
+            self.throttle(d.get('downloaded_bytes') or 0, now)
+            if now - self.last_sent < self.min_interval:
+                return
+            self.last_sent = now
+            self.check_cancelled()
             progress = 0
             if 'total_bytes' in d and d['total_bytes']:
                 progress = (d['downloaded_bytes'] / d['total_bytes']) * 100
             elif 'total_bytes_estimate' in d and d['total_bytes_estimate']:
                 progress = (d['downloaded_bytes'] / d['total_bytes_estimate']) * 100
-            
-            update_job_status(
-                self.job_id, 
-                "downloading", 
-                progress, 
-                title=self.title,
-                thumbnail=self.thumbnail
-            )
+            self.progress_queue.put((self.job_id, "progress", progress))
         
         elif d['status'] == 'finished':
-            update_job_status(
-                self.job_id, 
-                "downloading", 
-                99, 
-                title=self.title,
-                thumbnail=self.thumbnail
-            )
+            self.progress_queue.put((self.job_id, "progress", 99))
+
+
+def kill_child_processes():
+    """SIGTERM the child processes of this worker"""
+    task_dir = f"/proc/{os.getpid()}/task"
+    for task in os.listdir(task_dir):
+        try:
+            with open(os.path.join(task_dir, task, "children")) as f:
+                pids = f.read().split()
+        except OSError:
+            continue
+        for pid in pids:
+            try:
+                os.kill(int(pid), signal.SIGTERM)
+            except OSError:
+                pass
 
 
-async def run_download(job_id: str, url: str, format_id: str, convert_to: str = None):
-    """Run download with yt-dlp"""
-    update_job_status(job_id, "pending", 0)
+def get_throughput_opts() -> dict:
+    """yt-dlp options for the high-throughput download mode"""
+    if not settings.download_fast_mode:
+        return {}
+    opts = {
+        'concurrent_fragment_downloads': settings.download_concurrent_fragments,
+        'http_chunk_size': settings.download_http_chunk_size,
+    }
+    # aria2c splits plain HTTP files into ranges fetched over several connections;
+    # HLS/DASH stay native so fragments are fetched in parallel by yt-dlp
+    if settings.download_connections > 1 and shutil.which("aria2c"):
+        connections = settings.download_connections
+        opts['external_downloader'] = {'http': 'aria2c'}
+        opts['external_downloader_args'] = {'aria2c': [
+            f'--max-connection-per-server={connections}',
+            f'--split={connections}',
+            '--min-split-size=1M',
+        ]}
+    return opts
+
+
+def download_worker(job_id: str, url: str, info: Optional[dict], ydl_opts: dict,
+                    progress_queue, cancel_flags, rate_limits, deadline: float,
+                    min_interval: float) -> dict:
+    """Download one URL in a worker process
     
-    download_dir = os.path.join(settings.storage_path, "downloads")
-    os.makedirs(download_dir, exist_ok=True)
+    Extraction runs only when no cached info dict is given; a fresh one is
+    sent back for the cache. The final file path (after merging and
+    post-processing) comes from yt-dlp's post hooks. Errors come back as
+    {"error": ...} so nothing yt-dlp raises has to survive pickling.
+    """
+    hook = WorkerProgressHook(job_id, progress_queue, cancel_flags, rate_limits,
+                              deadline, min_interval)
+    stop = threading.Event()
+    threading.Thread(target=hook.watch, args=(stop,), daemon=True).start()
+    
+    # aria2c never calls the hook, so it gets the budget current at start
+    rate = rate_limits.get(job_id)
+    if rate and 'aria2c' in ydl_opts.get('external_downloader_args', {}):
+        ydl_opts = {**ydl_opts, 'external_downloader_args': {'aria2c': [
+            *ydl_opts['external_downloader_args']['aria2c'],
+            f'--max-overall-download-limit={rate}',
+        ]}}
+    
+    filepaths = []
+    try:
+        hook.check_cancelled()
+        with yt_dlp.YoutubeDL({**ydl_opts, 'progress_hooks': [hook],
+                               'post_hooks': [filepaths.append]}) as ydl:
+            if info is None:
+                info = ydl.sanitize_info(ydl.extract_info(url, download=False),
+                                         remove_private_keys=True)
+                progress_queue.put((job_id, "info", info))
+                hook.check_cancelled()
+                ydl.process_ie_result(info, download=True)
+            else:
+                try:
+                    ydl.process_ie_result(info, download=True)
+                except (yt_dlp.utils.DownloadError, yt_dlp.utils.ReExtractInfo) as e:
+                    # Format URLs in a cached info dict can expire; extract again
+                    print(f"Cached info failed for {job_id}, extracting again: {e}")
+                    ydl.download([info.get('webpage_url') or url])
+        if not filepaths:
+            return {"error": "Downloaded file not found"}
+        return {"title": info.get('title', 'Unknown'), "filepath": filepaths[-1]}
+    except yt_dlp.utils.DownloadCancelled as e:
+        return {"error": str(e), "cancelled": True}
+    except BaseException as e:
+        # A killed external downloader surfaces as a plain download error
+        reason = hook.cancel_reason()
+        if reason:
+            return {"error": reason, "cancelled": True}
+        return {"error": str(e)}
+    finally:
+        stop.set()
+
+
+def get_site_key(url: str) -> str:
+    """Registrable-ish domain used for per-site limits"""
+    host = (urlparse(url).hostname or "").lower()
+    if host == "youtu.be":
+        return "youtube.com"
+    return ".".join(host.split(".")[-2:]) or "unknown"
+
+
+def get_site_slot(url: str) -> asyncio.Semaphore:
+    site = get_site_key(url)
+    if site not in site_slots:
+        site_slots[site] = asyncio.Semaphore(settings.download_site_limit)
+    return site_slots[site]
+
+
+def drain_progress_queue(timeout: float) -> list:
+    """Block for the next progress message, then take everything queued"""
+    try:
+        messages = [progress_queue.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while True:
+        try:
+            messages.append(progress_queue.get_nowait())
+        except queue.Empty:
+            return messages
+
+
+async def handle_job_info(job_id: str, info: dict, status: str = "downloading"):
+    """Title and thumbnail from the job's info dict, sent to the UI at once"""
+    job = active_jobs.get(job_id)
+    if job is None:
+        return
+    job["title"] = info.get('title', 'Unknown')
     
-    output_template = os.path.join(download_dir, f"{job_id}_%(title)s.%(ext)s")
+    # Use cached thumbnail or download new one
+    if os.path.exists(get_thumbnail_path(job_id)):
+        job["thumbnail"] = f"/api/thumbnails/{job_id}.jpg"
+    elif info.get("thumbnail"):
+        job["thumbnail"] = await download_thumbnail(info["thumbnail"], job_id)
     
-    progress_hook = DownloadProgressHook(job_id)
+    await update_job_status(job_id, status, job["progress"],
+                            title=job["title"], thumbnail=job["thumbnail"])
+
+
+async def publish_progress():
+    """Single consumer of worker progress; coalesces to the latest per job"""
+    while True:
+        try:
+            messages = await asyncio.to_thread(drain_progress_queue, 0.5)
+            latest = {}
+            for job_id, kind, data in messages:
+                if kind == "info":
+                    if job_id in active_jobs:
+                        start_background_task(cache_video_info(active_jobs[job_id]["url"], data))
+                    start_background_task(handle_job_info(job_id, data))
+                else:
+                    latest[job_id] = data
+            for job_id, progress in latest.items():
+                job = active_jobs.get(job_id)
+                if job is not None:
+                    job["progress"] = progress
+                    await update_job_status(job_id, "downloading", progress,
+                                            title=job["title"], thumbnail=job["thumbnail"])
+        except Exception as e:
+            print(f"Progress publisher error: {e}")
+            await asyncio.sleep(1)
+
+
+def rebalance_rate_limits():
+    """Split the global bandwidth budget evenly across running jobs"""
+    share = 0
+    if settings.download_total_rate_limit and running_jobs:
+        share = settings.download_total_rate_limit // len(running_jobs)
+    for job_id in running_jobs:
+        budgets = [rate for rate in (settings.download_rate_limit, share) if rate]
+        rate_limits[job_id] = min(budgets) if budgets else 0
+
+
+async def run_in_download_pool(job_id: str, url: str, info: Optional[dict], ydl_opts: dict) -> dict:
+    """Run a download in the pool, holding a slot for its site"""
+    deadline = time.time() + settings.download_timeout
+    async with get_site_slot(url):
+        if cancel_flags.get(job_id):
+            return {"error": cancel_flags[job_id], "cancelled": True}
+        running_jobs.add(job_id)
+        rebalance_rate_limits()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            download_pool, download_worker, job_id, url, info, ydl_opts,
+            progress_queue, cancel_flags, rate_limits, deadline,
+            settings.progress_min_interval
+        )
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), settings.download_timeout)
+        except asyncio.TimeoutError:
+            # The worker aborts at its next progress callback
+            cancel_flags[job_id] = "Download timed out"
+            return await future
+        finally:
+            running_jobs.discard(job_id)
+            rate_limits.pop(job_id, None)
+            rebalance_rate_limits()
+
+
+async def extract_in_download_pool(url: str) -> dict:
+    """Info dict for a URL: from the cache, or extracted in the pool under its site slot"""
+    info = await get_cached_info(url)
+    if info is not None:
+        return info
+    async with get_site_slot(url):
+        # A request that held the slot may have just extracted the same URL
+        info = await get_cached_info(url)
+        if info is None:
+            loop = asyncio.get_running_loop()
+            info = await loop.run_in_executor(download_pool, extract_video_info, url, YDL_EXTRACT_OPTS)
+            await cache_video_info(url, info)
+    return info
+
+
+# ===========================================
+# Pipeline orchestrator
+# ===========================================
+# A job is a declarative chain of stages, e.g. download -> convert ->
+# thumbnail, kept in a Redis hash with the index of the current stage, so
+# in-flight chains survive a restart. Stages run back to back until one hands
+# work to another service: the convert stage returns "waiting", and the
+# converter's completion event on the conversion:events stream (read through
+# a consumer group, acked once handled) advances the chain. Conversion
+# progress is relayed from conversion:status:* pub/sub.
+
+PIPELINES_KEY = "download:pipelines"  # set of in-flight job ids
+pipeline_locks = {}  # job_id -> asyncio.Lock
+
+# Shared by every pipeline stage that calls the converter
+converter_client = httpx.AsyncClient(
+    base_url=settings.converter_service_url,
+    timeout=httpx.Timeout(60.0, connect=5.0)
+)
+
+
+def get_pipeline_key(job_id: str) -> str:
+    return f"download:pipeline:{job_id}"
+
+
+def get_pipeline_lock(job_id: str) -> asyncio.Lock:
+    return pipeline_locks.setdefault(job_id, asyncio.Lock())
+
+
+def get_default_stages(convert_to: Optional[str]) -> List[str]:
+    return ["download", "convert"] if convert_to else ["download"]
+
+
+def validate_stages(stages: List[str], convert_to: Optional[str]):
+    if not stages or stages[0] != "download":
+        raise HTTPException(status_code=400, detail="A pipeline must start with the download stage")
+    unknown = [stage for stage in stages if stage not in PIPELINE_STAGES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown pipeline stages: {unknown}")
+    if "convert" in stages and not convert_to:
+        raise HTTPException(status_code=400, detail="The convert stage requires convert_to")
+
+
+async def run_download_stage(job_id: str, pipeline: dict) -> str:
+    """Download the URL in the worker pool"""
+    url = pipeline["url"]
+    output_template = os.path.join(get_download_dir(job_id), f"{job_id}_%(title)s.%(ext)s")
     
     ydl_opts = {
+        **YDL_EXTRACT_OPTS,
         'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',  # Prefer MP4
         'outtmpl': output_template,
-        'progress_hooks': [progress_hook],
-        'noplaylist': True,
-        'quiet': True,
-        'no_warnings': True,
-        'js_runtimes': {'node': {}},  # Use Node.js for JS challenges (required for YouTube)
-        'extractor_args': {
-            'youtube': {
-                'player_client': ['android', 'web'],  # Use multiple clients for better format availability
-            }
-        },
-        'http_headers': {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        },
         'retries': 3,
         'fragment_retries': 3,
         'file_access_retries': 3,
         'ignoreerrors': False,
-        'no_check_certificate': True,
+        **get_throughput_opts(),
     }
     
+    job = active_jobs.setdefault(job_id, {"url": url, "title": None, "thumbnail": None, "progress": 0})
     try:
-        # PRIORITY 1: Get info (title + thumbnail) FIRST before anything else
-        # This provides immediate feedback to the user
-        info_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'skip_download': True,
-            'js_runtimes': {'node': {}},  # Use Node.js for JS challenges (required for YouTube)
-        }
+        # An /info call or a recent download of the same URL already extracted
+        # it; title and thumbnail then reach the UI before the job even starts
+        info = await get_cached_info(url)
+        if info:
+            await handle_job_info(job_id, info, status="pending")
         
-        # Check if thumbnail already cached
-        cached_thumb = get_thumbnail_path(job_id)
-        local_thumbnail = None
-        if os.path.exists(cached_thumb):
-            local_thumbnail = f"/api/thumbnails/{job_id}.jpg"
+        result = await run_in_download_pool(job_id, url, info, ydl_opts)
+        if result.get("cancelled"):
+            await update_job_status(job_id, "cancelled", 0, title=job["title"],
+                                    error=result["error"], thumbnail=job["thumbnail"])
+            return "stop"
+        if "error" in result:
+            raise Exception(result["error"])
         
-        with yt_dlp.YoutubeDL(info_opts) as ydl_info:
-            info = ydl_info.extract_info(url, download=False)
-            progress_hook.title = info.get('title', 'Unknown')
-            original_thumbnail = info.get('thumbnail')
-            
-            # Use cached thumbnail or download new one
-            if local_thumbnail:
-                progress_hook.thumbnail = local_thumbnail
-            elif original_thumbnail:
-                # Download and cache thumbnail in background
-                progress_hook.thumbnail = await download_thumbnail(original_thumbnail, job_id)
-            
-            # Immediately send the title and thumbnail to frontend
-            update_job_status(
-                job_id, 
-                "downloading", 
-                0, 
-                title=progress_hook.title,
-                thumbnail=progress_hook.thumbnail
-            )
-        
-        # Now start the actual download
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            # Download
-            ydl.download([url])
-            
-            # Find downloaded file
-            downloaded_file = None
-            for file in os.listdir(download_dir):
-                if file.startswith(job_id):
-                    downloaded_file = os.path.join(download_dir, file)
-                    break
+        await redis_client.hset(get_pipeline_key(job_id), mapping={
+            "file": result["filepath"],
+            "title": job["title"] or result["title"],
+            "thumbnail": job["thumbnail"] or ""
+        })
+        return "next"
+    finally:
+        active_jobs.pop(job_id, None)
+        cancel_flags.pop(job_id, None)
+
+
+async def run_convert_stage(job_id: str, pipeline: dict) -> str:
+    """Hand the file to the converter; its completion event resumes the pipeline"""
+    conversion_id = f"conv_{job_id}"
+    await redis_client.hset(get_pipeline_key(job_id), "conversion_id", conversion_id)
+    await update_job_status(job_id, "converting", 0, title=pipeline["title"],
+                            thumbnail=pipeline["thumbnail"])
+    
+    response = await converter_client.post("/convert", json={
+        "input_path": pipeline["file"],
+        "output_format": pipeline["convert_to"],
+        "job_id": conversion_id
+    })
+    if response.status_code != 200:
+        raise Exception(f"Conversion request failed: {response.text}")
+    return "waiting"
+
+
+async def run_thumbnail_stage(job_id: str, pipeline: dict) -> str:
+    """Thumbnail from the final file, used when the source had no local one"""
+    if pipeline["thumbnail"].startswith("/api/"):
+        return "next"
+    try:
+        response = await converter_client.post("/thumbnail", params={"input_path": pipeline["file"]})
+        if response.status_code == 200:
+            name = os.path.basename(response.json()["thumbnail_path"])
+            await redis_client.hset(get_pipeline_key(job_id), "thumbnail", f"/api/thumbnails/{name}")
+    except Exception as e:
+        print(f"Thumbnail stage failed for {job_id}: {e}")
+    return "next"
+
+
+# Stage name -> coroutine returning "next", "waiting" (an event resumes it)
+# or "stop" (the job already reached a terminal state)
+PIPELINE_STAGES = {
+    "download": run_download_stage,
+    "convert": run_convert_stage,
+    "thumbnail": run_thumbnail_stage,
+}
+
+
+async def end_pipeline(job_id: str):
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.srem(PIPELINES_KEY, job_id)
+        pipe.delete(get_pipeline_key(job_id))
+        await pipe.execute()
+    pipeline_locks.pop(job_id, None)
+
+
+async def run_pipeline(job_id: str):
+    """Run stages from the current one until the chain ends or waits on an event"""
+    async with get_pipeline_lock(job_id):
+        while True:
+            pipeline = await redis_client.hgetall(get_pipeline_key(job_id))
+            if not pipeline:
+                return
+            stages = json.loads(pipeline["stages"])
+            index = int(pipeline["stage"])
             
-            if not downloaded_file:
-                raise Exception("Downloaded file not found")
+            if index >= len(stages):
+                await redis_client.set(get_output_key(job_id), pipeline["file"],
+                                       ex=settings.output_index_ttl)
+                await update_job_status(job_id, "completed", 100, title=pipeline["title"],
+                                        output_path=pipeline["file"],
+                                        thumbnail=pipeline["thumbnail"])
+                await end_pipeline(job_id)
+                return
             
-            # Convert if requested
-            if convert_to:
-                update_job_status(
-                    job_id, 
-                    "converting", 
-                    0, 
-                    title=progress_hook.title,
-                    thumbnail=progress_hook.thumbnail
-                )
-                
-                async with httpx.AsyncClient(timeout=3600) as client:
-                    response = await client.post(
-                        f"{settings.converter_service_url}/convert",
-                        json={
-                            "input_path": downloaded_file,
-                            "output_format": convert_to,
-                            "job_id": f"conv_{job_id}"
-                        }
-                    )
-                    
-                    if response.status_code == 200:
-                        conv_data = response.json()
-                        # Wait for conversion
-                        while True:
-                            await asyncio.sleep(2)
-                            status_resp = await client.get(
-                                f"{settings.converter_service_url}/status/{conv_data['job_id']}"
-                            )
-                            if status_resp.status_code == 200:
-                                status_data = status_resp.json()
-                                if status_data['status'] == 'completed':
-                                    downloaded_file = status_data['output_path']
-                                    break
-                                elif status_data['status'] == 'failed':
-                                    raise Exception(status_data.get('error', 'Conversion failed'))
-                                else:
-                                    update_job_status(
-                                        job_id, 
-                                        "converting", 
-                                        status_data['progress'],
-                                        title=progress_hook.title,
-                                        thumbnail=progress_hook.thumbnail
-                                    )
+            try:
+                outcome = await PIPELINE_STAGES[stages[index]](job_id, pipeline)
+            except Exception as e:
+                await update_job_status(job_id, "failed", 0, title=pipeline["title"],
+                                        error=str(e), thumbnail=pipeline["thumbnail"])
+                await end_pipeline(job_id)
+                return
             
-            update_job_status(
-                job_id, 
-                "completed", 
-                100, 
-                title=progress_hook.title,
-                output_path=downloaded_file,
-                thumbnail=progress_hook.thumbnail
-            )
+            if outcome == "waiting":
+                return
+            if outcome == "stop":
+                await end_pipeline(job_id)
+                return
+            await redis_client.hincrby(get_pipeline_key(job_id), "stage", 1)
+
+
+async def run_download(job_id: str, url: str, format_id: str, convert_to: str = None,
+                       stages: List[str] = None):
+    """Start a job's pipeline; by default download, then convert when requested"""
+    await update_job_status(job_id, "pending", 0)
+    
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(get_pipeline_key(job_id), mapping={
+            "url": url,
+            "stages": json.dumps(stages or get_default_stages(convert_to)),
+            "stage": 0,
+            "convert_to": convert_to or "",
+            "file": "",
+            "title": "",
+            "thumbnail": "",
+            "conversion_id": ""
+        })
+        pipe.sadd(PIPELINES_KEY, job_id)
+        await pipe.execute()
+    
+    await run_pipeline(job_id)
+
+
+async def handle_conversion_result(job_id: str, data: dict):
+    """Advance a pipeline waiting on the converter, once per conversion"""
+    async with get_pipeline_lock(job_id):
+        pipeline = await redis_client.hgetall(get_pipeline_key(job_id))
+        if not pipeline or pipeline["conversion_id"] != data["job_id"]:
+            return
+        if json.loads(pipeline["stages"])[int(pipeline["stage"])] != "convert":
+            return
+        
+        if data["status"] == "failed":
+            await update_job_status(job_id, "failed", 0, title=pipeline["title"],
+                                    error=data.get("error") or "Conversion failed",
+                                    thumbnail=pipeline["thumbnail"])
+            await end_pipeline(job_id)
+            return
+        
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hset(get_pipeline_key(job_id), "file", data["output_path"])
+            pipe.hincrby(get_pipeline_key(job_id), "stage", 1)
+            await pipe.execute()
+    start_background_task(run_pipeline(job_id))
+
+
+async def consume_conversion_events():
+    """Converter completion events, read through a consumer group"""
+    stream = settings.conversion_events_stream
+    group = settings.pipeline_consumer_group
+    consumer = socket.gethostname()
+    last_id = None
+    claimed_at = 0
+    while True:
+        try:
+            if last_id is None:
+                try:
+                    await redis_client.xgroup_create(stream, group, id="$", mkstream=True)
+                except aioredis.ResponseError as e:
+                    if "BUSYGROUP" not in str(e):
+                        raise
+            if last_id is None or time.monotonic() - claimed_at > settings.pipeline_claim_idle:
+                # Events another consumer took but never acked (it died) come to us
+                await redis_client.xautoclaim(stream, group, consumer,
+                                              min_idle_time=settings.pipeline_claim_idle * 1000)
+                claimed_at = time.monotonic()
+                # "0" re-reads our own unacked events first (claimed ones, or ours
+                # after a restart or a failed handler), then ">" reads new ones
+                last_id = "0"
             
+            # The block time must stay below the Redis socket timeout
+            response = await redis_client.xreadgroup(group, consumer, {stream: last_id},
+                                                     count=50, block=2000)
+            entries = response[0][1] if response else []
+            if last_id != ">":
+                if not entries:
+                    last_id = ">"
+                    continue
+                # Pending events are paged by ID, past any that fail again
+                last_id = entries[-1][0]
+            for entry_id, data in entries:
+                job_id = data.get("job_id", "")
+                if job_id.startswith("conv_") and data.get("status") in ("completed", "failed"):
+                    try:
+                        await handle_conversion_result(job_id[len("conv_"):], data)
+                    except Exception as e:
+                        # Left unacked: retried when pending events are next re-read
+                        print(f"Conversion event {entry_id} failed: {e}")
+                        continue
+                await redis_client.xack(stream, group, entry_id)
+        except Exception as e:
+            print(f"Conversion event consumer error: {e}")
+            # The failed event stays pending; start over so it is read again
+            last_id = None
+            await asyncio.sleep(1)
+
+
+async def relay_conversion_progress():
+    """Conversion progress of pipeline jobs, forwarded as their converting status"""
+    while True:
+        try:
+            pubsub = redis_client.pubsub()
+            await pubsub.psubscribe("conversion:status:conv_*")
+            async for message in pubsub.listen():
+                if message["type"] != "pmessage":
+                    continue
+                data = json.loads(message["data"])
+                if data.get("status") != "processing":
+                    continue
+                job_id = data["job_id"][len("conv_"):]
+                pipeline = await redis_client.hgetall(get_pipeline_key(job_id))
+                if pipeline and pipeline["conversion_id"] == data["job_id"]:
+                    await update_job_status(job_id, "converting", float(data["progress"]),
+                                            title=pipeline["title"],
+                                            thumbnail=pipeline["thumbnail"])
+        except Exception as e:
+            print(f"Conversion progress relay error: {e}")
+            await asyncio.sleep(1)
+
+
+async def recover_pipelines():
+    """Resume chains that were in flight when the service stopped"""
+    try:
+        job_ids = await redis_client.smembers(PIPELINES_KEY)
     except Exception as e:
-        update_job_status(job_id, "failed", 0, error=str(e))
+        print(f"Could not load in-flight pipelines: {e}")
+        return
+    for job_id in job_ids:
+        pipeline = await redis_client.hgetall(get_pipeline_key(job_id))
+        if not pipeline:
+            await redis_client.srem(PIPELINES_KEY, job_id)
+            continue
+        stages = json.loads(pipeline["stages"])
+        index = int(pipeline["stage"])
+        stage = stages[index] if index < len(stages) else None
+        print(f"Recovering pipeline {job_id} at stage {stage}")
+        
+        if stage == "convert" and pipeline["conversion_id"]:
+            # Results that landed while we were down are in the stream, but
+            # a conversion started before the consumer group existed is not
+            try:
+                response = await converter_client.get(f"/status/{pipeline['conversion_id']}")
+                if response.status_code == 200:
+                    data = response.json()
+                    if data["status"] in ("completed", "failed"):
+                        await handle_conversion_result(job_id, data)
+                    continue
+            except Exception as e:
+                print(f"Could not check conversion of {job_id}: {e}")
+                continue
+        # Downloads restart (yt-dlp resumes partial files); a conversion the
+        # converter never received is requested again
+        start_background_task(run_pipeline(job_id))
+
+
+@app.on_event("startup")
+async def start_download_executor():
+    global download_pool, progress_manager, progress_queue, cancel_flags, rate_limits
+    # spawn: forking a process that runs an event loop and open sockets is unsafe
+    context = multiprocessing.get_context("spawn")
+    progress_manager = context.Manager()
+    progress_queue = progress_manager.Queue()
+    cancel_flags = progress_manager.dict()
+    rate_limits = progress_manager.dict()
+    download_pool = ProcessPoolExecutor(max_workers=settings.download_workers, mp_context=context)
+    start_background_task(publish_progress())
+
+
+@app.on_event("startup")
+async def start_pipeline_orchestrator():
+    start_background_task(consume_conversion_events())
+    start_background_task(relay_conversion_progress())
+    start_background_task(recover_pipelines())
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    # Stop the loops before the Manager they poll goes away; pipelines in
+    # flight stay in Redis and resume on the next start
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    download_pool.shutdown(wait=False, cancel_futures=True)
+    progress_manager.shutdown()
+    await converter_client.aclose()
+    await pusher_client.aclose()
+    await redis_client.aclose()
 
 
 @app.get("/")
@@ -358,7 +1065,7 @@ async def root():
 @app.get("/health")
 async def health():
     try:
-        redis_client.ping()
+        await redis_client.ping()
         return {"status": "healthy", "redis": "connected"}
     except:
         return JSONResponse(status_code=503, content={"status": "unhealthy"})
@@ -367,35 +1074,28 @@ async def health():
 @app.post("/info")
 async def get_video_info(url: str):
     """Get video information from URL"""
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'skip_download': True,
-    }
-    
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            formats = []
-            for f in info.get('formats', []):
-                formats.append({
-                    'format_id': f.get('format_id'),
-                    'ext': f.get('ext'),
-                    'resolution': f.get('resolution', 'audio only'),
-                    'filesize': f.get('filesize'),
-                    'vcodec': f.get('vcodec'),
-                    'acodec': f.get('acodec'),
-                })
-            
-            return VideoInfo(
-                url=url,
-                title=info.get('title', 'Unknown'),
-                duration=info.get('duration'),
-                thumbnail=info.get('thumbnail'),
-                formats=formats,
-                description=info.get('description')
-            )
+        info = await extract_in_download_pool(url)
+        
+        formats = []
+        for f in info.get('formats', []):
+            formats.append({
+                'format_id': f.get('format_id'),
+                'ext': f.get('ext'),
+                'resolution': f.get('resolution', 'audio only'),
+                'filesize': f.get('filesize'),
+                'vcodec': f.get('vcodec'),
+                'acodec': f.get('acodec'),
+            })
+        
+        return VideoInfo(
+            url=url,
+            title=info.get('title', 'Unknown'),
+            duration=info.get('duration'),
+            thumbnail=info.get('thumbnail'),
+            formats=formats,
+            description=info.get('description')
+        )
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -408,28 +1108,31 @@ async def download(request: DownloadRequest):
     # Validate URL
     if not request.url:
         raise HTTPException(status_code=400, detail="URL is required")
+    stages = request.pipeline or get_default_stages(request.convert_to)
+    validate_stages(stages, request.convert_to)
     
     # Initialize job in Redis FIRST
-    update_job_status(job_id, "pending", 0)
+    await update_job_status(job_id, "pending", 0)
     
-    # Start download in background using asyncio.create_task
+    # Start download in a background task
     # This returns immediately without waiting
-    asyncio.create_task(
+    start_background_task(
         run_download(
             job_id, 
             request.url, 
             request.format,
-            request.convert_to
+            request.convert_to,
+            stages
         )
     )
     
-    return {"job_id": job_id, "status": "pending"}
+    return {"job_id": job_id, "status": "pending", "pipeline": stages}
 
 
 @app.get("/status/{job_id}")
 async def get_status(job_id: str):
     """Get download job status"""
-    job_data = redis_client.hgetall(get_job_key(job_id))
+    job_data = await redis_client.hgetall(get_job_key(job_id))
     
     if not job_data:
         raise HTTPException(status_code=404, detail="Job not found")
@@ -445,6 +1148,29 @@ async def get_status(job_id: str):
     )
 
 
+@app.get("/output/{job_id}")
+async def get_output(job_id: str):
+    """Output file of a finished job, still available after its status expires"""
+    output_path = await redis_client.get(get_output_key(job_id))
+    if output_path and not os.path.exists(output_path):
+        # The file was removed outside the API; drop the stale entry
+        await redis_client.delete(get_output_key(job_id))
+        output_path = None
+    if not output_path:
+        raise HTTPException(status_code=404, detail="No output for this job")
+    return {"job_id": job_id, "output_path": output_path}
+
+
+@app.post("/cancel/{job_id}")
+async def cancel_download(job_id: str):
+    """Cancel a queued or running download"""
+    if job_id not in active_jobs:
+        raise HTTPException(status_code=404, detail="No active download with this id")
+    # Queued jobs stop before starting; running ones at the next progress callback
+    cancel_flags[job_id] = "Cancelled by user"
+    return {"job_id": job_id, "status": "cancelling"}
+
+
 @app.get("/supported")
 async def supported_sites():
     """Get list of supported sites"""
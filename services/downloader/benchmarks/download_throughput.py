@@ -0,0 +1,175 @@
+"""
+AllOne Downloader - download throughput benchmark
+Measures yt-dlp throughput of the default and high-throughput download modes
+
+Serves a large file and an HLS fixture from a local stand-in HTTP server that
+supports Range requests, caps each connection's speed and adds per-request
+latency, like a CDN would. Both fixtures are then downloaded with the default
+yt-dlp options and with the high-throughput options (parallel fragments,
+aria2c multi-connection when installed, chunked HTTP):
+
+    docker compose exec -T downloader python - --size-mb 200 < services/downloader/benchmarks/download_throughput.py
+"""
+import os
+import re
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import yt_dlp
+
+BLOCK_SIZE = 64 * 1024
+
+
+class ThrottledHandler(SimpleHTTPRequestHandler):
+    """Static files with single Range support, a per-connection speed cap and latency"""
+
+    connection_bps = 0
+    latency = 0
+    requests = 0
+    remaining = None  # bytes left in the current response body
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        type(self).requests += 1
+        time.sleep(self.latency)
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+        if match and match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        f = open(path, "rb")
+        f.seek(start)
+        self.remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        if self.remaining is None:
+            return super().copyfile(source, outputfile)
+        started = time.perf_counter()
+        sent = 0
+        while self.remaining > 0:
+            block = source.read(min(BLOCK_SIZE, self.remaining))
+            if not block:
+                break
+            try:
+                outputfile.write(block)
+            except (BrokenPipeError, ConnectionResetError):
+                # yt-dlp probes the large file with a GET it closes early
+                return
+            sent += len(block)
+            self.remaining -= len(block)
+            if self.connection_bps:
+                delay = sent / self.connection_bps - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+def make_fixtures(root: str, size_mb: int, segments: int, segment_kb: int):
+    with open(os.path.join(root, "large.mp4"), "wb") as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(1024 * 1024))
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:4",
+             "#EXT-X-MEDIA-SEQUENCE:0", "#EXT-X-PLAYLIST-TYPE:VOD"]
+    for index in range(segments):
+        with open(os.path.join(root, f"segment_{index:03d}.ts"), "wb") as f:
+            f.write(os.urandom(segment_kb * 1024))
+        lines += ["#EXTINF:4.0,", f"segment_{index:03d}.ts"]
+    lines.append("#EXT-X-ENDLIST")
+    with open(os.path.join(root, "index.m3u8"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def throughput_opts(args) -> dict:
+    """Must match get_throughput_opts() in app/main.py"""
+    opts = {
+        'concurrent_fragment_downloads': args.fragments,
+        'http_chunk_size': args.chunk_mb * 1024 * 1024,
+    }
+    if args.connections > 1 and shutil.which("aria2c"):
+        opts['external_downloader'] = {'http': 'aria2c'}
+        opts['external_downloader_args'] = {'aria2c': [
+            f'--max-connection-per-server={args.connections}',
+            f'--split={args.connections}',
+            '--min-split-size=1M',
+        ]}
+    return opts
+
+
+def run_download(url: str, work_dir: str, opts: dict) -> tuple:
+    """Download with yt-dlp; returns (seconds, bytes, server requests)"""
+    out_dir = tempfile.mkdtemp(dir=work_dir)
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,
+        'fixup': 'never',
+        'outtmpl': os.path.join(out_dir, 'out.%(ext)s'),
+        **opts,
+    }
+    ThrottledHandler.requests = 0
+    started = time.perf_counter()
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        ydl.download([url])
+    elapsed = time.perf_counter() - started
+    size = sum(os.path.getsize(os.path.join(out_dir, name)) for name in os.listdir(out_dir))
+    shutil.rmtree(out_dir)
+    return elapsed, size, ThrottledHandler.requests
+
+
+def main(args):
+    ThrottledHandler.connection_bps = args.connection_mbps * 1e6 / 8
+    ThrottledHandler.latency = args.latency_ms / 1000
+    with tempfile.TemporaryDirectory() as work_dir:
+        fixtures = os.path.join(work_dir, "fixtures")
+        os.makedirs(fixtures)
+        make_fixtures(fixtures, args.size_mb, args.segments, args.segment_kb)
+        server = ThreadingHTTPServer(("127.0.0.1", 0),
+                                     functools.partial(ThrottledHandler, directory=fixtures))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+        fast = throughput_opts(args)
+        if 'external_downloader' not in fast:
+            print("aria2c not installed: plain HTTP uses yt-dlp's native downloader")
+        modes = {"default": {}, "fast": fast}
+
+        try:
+            for fixture, path in (("large file", "/large.mp4"), ("HLS", "/index.m3u8")):
+                for mode, opts in modes.items():
+                    elapsed, size, requests = run_download(base_url + path, work_dir, opts)
+                    print(f"{fixture:<10} {mode:<14} {elapsed:7.2f}s  "
+                          f"{size * 8 / elapsed / 1e6:8.1f} Mbit/s  {requests:>5} requests")
+        finally:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[1])
+    parser.add_argument("--size-mb", type=int, default=100, help="Size of the large file")
+    parser.add_argument("--segments", type=int, default=60, help="HLS fixture segments")
+    parser.add_argument("--segment-kb", type=int, default=1024)
+    parser.add_argument("--connection-mbps", type=float, default=100,
+                        help="Speed cap of each server connection (0 = none)")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Delay before each response")
+    parser.add_argument("--fragments", type=int, default=8, help="DOWNLOAD_CONCURRENT_FRAGMENTS")
+    parser.add_argument("--connections", type=int, default=8, help="DOWNLOAD_CONNECTIONS")
+    parser.add_argument("--chunk-mb", type=int, default=10, help="DOWNLOAD_HTTP_CHUNK_SIZE in MiB")
+    main(parser.parse_args())
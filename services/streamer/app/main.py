@@ -3,19 +3,25 @@ AllOne Converter - Streamer Microservice
 Handles HLS streaming and video preview generation
 """
 import os
+import re
+import math
 import uuid
+import socket
+import shutil
 import asyncio
-import subprocess
 import json
+import time
 import hashlib
-from typing import Optional
-from pathlib import Path
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional, List, Union
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
-import redis
+import redis.asyncio as aioredis
 import aiofiles
 
 
@@ -24,6 +30,40 @@ class Settings(BaseSettings):
     redis_port: int = 6379
     storage_path: str = "/app/storage"
     cache_path: str = "/app/cache"
+    redis_max_connections: int = 50
+    redis_socket_timeout: float = 5.0
+    # ffprobe results: in-process LRU entries and shared Redis TTL (s)
+    probe_cache_size: int = 512
+    probe_cache_ttl: int = 86400
+    # Adaptive encoding policy: HLS encodes must run at least this many times realtime
+    encoding_policy_enabled: bool = True
+    stream_min_speed: float = 1.5
+    # Just-in-time HLS: segments encoded ahead of the one being played, and the
+    # x264 preset they use (each must finish before the player asks for it)
+    jit_read_ahead: int = 2
+    jit_preset: str = "veryfast"
+    # Progressive serving: how long playlist/segment requests wait for ffmpeg (s)
+    playlist_wait_seconds: float = 15
+    segment_wait_seconds: float = 30
+    # Single-flight HLS generation: lock lease, refreshed by a heartbeat (s)
+    stream_lock_seconds: int = 30
+    # Cache directory budget: eviction starts above the high watermark (or when
+    # the disk's free space drops below cache_min_free_bytes) and stops at the low one
+    cache_max_bytes: int = 50 * 1024 ** 3
+    cache_high_watermark: float = 0.9
+    cache_low_watermark: float = 0.75
+    cache_min_free_bytes: int = 2 * 1024 ** 3
+    cache_check_interval: float = 60
+    # Trickplay sprites: seconds per tile, tile width, tiles per sheet, and
+    # CPU niceness / concurrent jobs for the background generator
+    trickplay_interval: float = 10
+    trickplay_width: int = 160
+    trickplay_columns: int = 10
+    trickplay_rows: int = 10
+    trickplay_nice: int = 19
+    trickplay_max_jobs: int = 1
+    # Most frames (timestamps x sizes) one batch thumbnail request may ask for
+    thumbnail_batch_max: int = 100
     
     class Config:
         env_file = ".env"
@@ -41,25 +81,47 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Redis connection
-redis_client = redis.Redis(
-    host=settings.redis_host,
-    port=settings.redis_port,
-    decode_responses=True
+# Redis connection (async, pooled)
+redis_client = aioredis.Redis(
+    connection_pool=aioredis.ConnectionPool(
+        host=settings.redis_host,
+        port=settings.redis_port,
+        decode_responses=True,
+        max_connections=settings.redis_max_connections,
+        socket_timeout=settings.redis_socket_timeout,
+        socket_connect_timeout=2,
+        socket_keepalive=True,
+        health_check_interval=30,
+        retry_on_timeout=True
+    )
 )
 
 
 class StreamRequest(BaseModel):
     file_path: str
-    quality: Optional[str] = "720p"
+    quality: Optional[str] = "720p"  # a QUALITY_PRESETS key, or "abr" for every rendition
+    renditions: Optional[List[str]] = None  # subset of QUALITY_PRESETS for an ABR stream
+    mode: Optional[str] = "full"  # "full" encodes up front, "jit" encodes segments on request
 
 
 class PreviewRequest(BaseModel):
     file_path: str
-    start_time: Optional[str] = "00:00:00"
+    start_time: Optional[str] = "00:00:00"  # or "auto" to start at the liveliest part
     duration: Optional[int] = 30  # seconds
 
 
+class ThumbnailBatchRequest(BaseModel):
+    file_path: str
+    timestamps: List[Union[str, float]]  # "00:01:05" or seconds
+    sizes: Optional[List[str]] = ["320x180"]  # WIDTHxHEIGHT
+
+
+class TrickplayRequest(BaseModel):
+    file_path: str
+    interval: Optional[float] = None  # seconds per tile, defaults to settings
+    width: Optional[int] = None  # tile width in pixels
+
+
 QUALITY_PRESETS = {
     "360p": {
         "resolution": "640x360",
@@ -84,10 +146,112 @@ QUALITY_PRESETS = {
 }
 
 
-def get_cache_key(file_path: str, quality: str) -> str:
+# ===========================================
+# Probe cache
+# ===========================================
+# Shared with the converter through Redis (same storage volume and key format)
+
+PROBE_KEY_PREFIX = "media:probe"
+
+
+async def run_ffprobe(input_path: str) -> tuple:
+    """Probe a file without blocking the event loop; returns (ok, info)"""
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "quiet", "-print_format", "json",
+        "-show_format", "-show_streams", input_path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    stdout, _ = await process.communicate()
+    try:
+        return process.returncode == 0, json.loads(stdout or b"{}")
+    except ValueError as e:
+        return False, {"error": str(e)}
+
+
+class ProbeCache:
+    """ffprobe results keyed on file identity (path, size, mtime, inode)
+    
+    Lookups try an in-process LRU, then the shared Redis tier, and only then
+    run ffprobe. Concurrent lookups of the same file share one probe.
+    """
+    
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+    
+    @staticmethod
+    def identity(path: str) -> str:
+        st = os.stat(path)
+        return f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}:{st.st_ino}"
+    
+    async def get(self, path: str) -> dict:
+        try:
+            identity = await asyncio.to_thread(self.identity, path)
+        except OSError as e:
+            return {"error": str(e)}
+        
+        info = self.entries.get(identity)
+        if info is not None:
+            self.entries.move_to_end(identity)
+            return info
+        
+        future = self.inflight.get(identity)
+        if future is None:
+            future = asyncio.ensure_future(self._load(identity, path))
+            self.inflight[identity] = future
+            future.add_done_callback(lambda _: self.inflight.pop(identity, None))
+        # A cancelled caller must not cancel the probe other callers wait on
+        return await asyncio.shield(future)
+    
+    async def _load(self, identity: str, path: str) -> dict:
+        redis_key = f"{PROBE_KEY_PREFIX}:{hashlib.sha1(identity.encode()).hexdigest()}"
+        try:
+            cached = await redis_client.get(redis_key)
+        except Exception as e:
+            print(f"Probe cache lookup failed: {e}")
+            cached = None
+        
+        if cached:
+            info = json.loads(cached)
+        else:
+            ok, info = await run_ffprobe(path)
+            if not ok:
+                # Don't cache failures; the file may still be being written
+                return info
+            try:
+                await redis_client.set(redis_key, json.dumps(info), ex=self.ttl)
+            except Exception as e:
+                print(f"Probe cache store failed: {e}")
+        
+        self.entries[identity] = info
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return info
+
+
+probe_cache = ProbeCache(settings.probe_cache_size, settings.probe_cache_ttl)
+
+
+
+async def get_video_duration(file_path: str) -> float:
+    """Get video duration from the cached probe"""
+    info = await probe_cache.get(file_path)
+    try:
+        return float(info["format"]["duration"])
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+async def get_cache_key(file_path: str, quality: str) -> str:
     """Generate cache key for HLS stream"""
-    hash_input = f"{file_path}:{quality}:{os.path.getmtime(file_path) if os.path.exists(file_path) else ''}"
-    return hashlib.md5(hash_input.encode()).hexdigest()
+    try:
+        identity = await asyncio.to_thread(ProbeCache.identity, file_path)
+    except OSError:
+        identity = file_path
+    return hashlib.md5(f"{identity}:{quality}".encode()).hexdigest()
 
 
 def get_hls_dir(cache_key: str) -> str:
@@ -95,8 +259,380 @@ def get_hls_dir(cache_key: str) -> str:
     return os.path.join(settings.cache_path, "hls", cache_key)
 
 
-async def generate_hls(file_path: str, cache_key: str, quality: str):
-    """Generate HLS stream from video file"""
+# ===========================================
+# Cache manager
+# ===========================================
+# Every cache entry (an HLS or preview directory, a thumbnail file) is indexed
+# in Redis by its path relative to cache_path, with its size and last access,
+# so eviction never has to walk the cache directory. HLS streams are indexed
+# once ready (JIT streams from prepare, growing per segment) and touched on
+# every playlist and segment hit; the manager task deletes least recently used
+# entries one at a time in a worker thread.
+
+CACHE_TYPES = ("hls", "previews", "thumbnails", "transmux", "trickplay")
+CACHE_SIZES_KEY = "streamer:cache:sizes"
+CACHE_LRU_KEY = "streamer:cache:lru"
+CACHE_BYTES_KEY = "streamer:cache:bytes"
+CACHE_STATS_KEY = "streamer:cache:stats"
+CACHE_INDEXED_KEY = "streamer:cache:indexed"
+
+cache_pressure = asyncio.Event()
+
+
+def get_entry_path(entry: str) -> str:
+    return os.path.join(settings.cache_path, entry)
+
+
+def measure_path(path: str) -> int:
+    """Bytes used by a file or directory tree"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def remove_path(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def check_cache_total(total: int):
+    if total > settings.cache_max_bytes * settings.cache_high_watermark:
+        cache_pressure.set()
+
+
+async def track_cache_entry(entry: str):
+    """(Re)measure an entry and mark it as just used"""
+    size = await asyncio.to_thread(measure_path, get_entry_path(entry))
+    previous = await redis_client.hget(CACHE_SIZES_KEY, entry)
+    await redis_client.hset(CACHE_SIZES_KEY, entry, size)
+    await redis_client.zadd(CACHE_LRU_KEY, {entry: time.time()})
+    check_cache_total(await redis_client.incrby(CACHE_BYTES_KEY, size - int(previous or 0)))
+
+
+async def grow_cache_entry(entry: str, added: int):
+    """Account bytes written into an already indexed entry"""
+    if await redis_client.zadd(CACHE_LRU_KEY, {entry: time.time()}, xx=True, ch=True):
+        await redis_client.hincrby(CACHE_SIZES_KEY, entry, added)
+        check_cache_total(await redis_client.incrby(CACHE_BYTES_KEY, added))
+
+
+async def touch_cache_entry(entry: str):
+    await redis_client.zadd(CACHE_LRU_KEY, {entry: time.time()}, xx=True)
+
+
+async def drop_cache_entry(entry: str) -> int:
+    """Remove an entry from the index and disk; returns the indexed bytes released"""
+    size = await redis_client.hget(CACHE_SIZES_KEY, entry)
+    released = 0
+    if size is not None and await redis_client.hdel(CACHE_SIZES_KEY, entry):
+        released = int(size)
+        await redis_client.decrby(CACHE_BYTES_KEY, released)
+    await redis_client.zrem(CACHE_LRU_KEY, entry)
+    
+    cache_type, _, name = entry.partition("/")
+    if cache_type == "hls":
+        # Stop serving the stream before its files disappear
+        await redis_client.delete(f"stream:{name}")
+        jit_transcoder.forget(name)
+    elif cache_type in ("transmux", "trickplay"):
+        await redis_client.delete(f"{cache_type}:{name}")
+    await asyncio.to_thread(remove_path, get_entry_path(entry))
+    return released
+
+
+async def evict_cache_entry(entry: str) -> int:
+    released = await drop_cache_entry(entry)
+    await redis_client.hincrby(CACHE_STATS_KEY, "evictions", 1)
+    await redis_client.hincrby(CACHE_STATS_KEY, "evicted_bytes", released)
+    await redis_client.hset(CACHE_STATS_KEY, "last_eviction", time.time())
+    return released
+
+
+def get_free_bytes() -> int:
+    try:
+        return shutil.disk_usage(settings.cache_path).free
+    except OSError:
+        return settings.cache_min_free_bytes
+
+
+async def evict_to_low_watermark() -> int:
+    """Evict LRU entries while the cache is over budget or the disk is short"""
+    low = settings.cache_max_bytes * settings.cache_low_watermark
+    evicted = 0
+    while True:
+        total = int(await redis_client.get(CACHE_BYTES_KEY) or 0)
+        free = await asyncio.to_thread(get_free_bytes)
+        if total <= low and free >= settings.cache_min_free_bytes:
+            break
+        oldest = await redis_client.zrange(CACHE_LRU_KEY, 0, 0)
+        if not oldest:
+            break
+        await evict_cache_entry(oldest[0])
+        evicted += 1
+    return evicted
+
+
+def scan_cache_dir() -> dict:
+    """One-off walk of the cache directory: entry -> (size, mtime)"""
+    entries = {}
+    for cache_type in CACHE_TYPES:
+        cache_dir = os.path.join(settings.cache_path, cache_type)
+        if not os.path.isdir(cache_dir):
+            continue
+        for item in os.scandir(cache_dir):
+            try:
+                entries[f"{cache_type}/{item.name}"] = (measure_path(item.path), item.stat().st_mtime)
+            except OSError:
+                pass
+    return entries
+
+
+async def index_existing_cache():
+    """Index entries written before the cache manager existed (once per Redis)"""
+    if not await redis_client.set(CACHE_INDEXED_KEY, time.time(), nx=True):
+        return
+    entries = await asyncio.to_thread(scan_cache_dir)
+    for entry, (size, mtime) in entries.items():
+        if await redis_client.hsetnx(CACHE_SIZES_KEY, entry, size):
+            await redis_client.zadd(CACHE_LRU_KEY, {entry: mtime}, nx=True)
+            await redis_client.incrby(CACHE_BYTES_KEY, size)
+    print(f"Indexed {len(entries)} existing cache entries")
+
+
+async def cache_manager_loop():
+    """Evict down to the low watermark whenever usage crosses the high one"""
+    try:
+        await index_existing_cache()
+    except Exception as e:
+        print(f"Cache indexing failed: {e}")
+    
+    high = settings.cache_max_bytes * settings.cache_high_watermark
+    while True:
+        try:
+            await asyncio.wait_for(cache_pressure.wait(), settings.cache_check_interval)
+        except asyncio.TimeoutError:
+            pass
+        cache_pressure.clear()
+        try:
+            total = int(await redis_client.get(CACHE_BYTES_KEY) or 0)
+            free = await asyncio.to_thread(get_free_bytes)
+            if total > high or free < settings.cache_min_free_bytes:
+                evicted = await evict_to_low_watermark()
+                print(f"Cache manager evicted {evicted} entries")
+        except Exception as e:
+            print(f"Cache eviction failed: {e}")
+
+
+# ===========================================
+# Adaptive encoding policy
+# ===========================================
+# HLS encodes must stay ahead of playback, so each stream gets the slowest
+# (best quality) x264 preset whose estimated speed, with the threads left
+# over by other active encodes, still meets stream_min_speed. Speeds are
+# learned from finished encodes and shared with the converter through Redis.
+
+# Slowest first, with relative speeds that seed the estimates
+ENCODER_LADDER = [("slow", 0.5), ("medium", 1.0), ("fast", 1.3), ("veryfast", 2.4),
+                  ("superfast", 4.0), ("ultrafast", 6.0)]
+# Media seconds encoded per wall second, per thread, at relative speed 1.0
+BASE_THREAD_SPEED = 0.25
+SPEED_EWMA_ALPHA = 0.3
+
+POLICY_LOG_KEY = "encoding:policy:log"
+POLICY_SPEEDS_KEY = "encoding:policy:speeds"
+POLICY_LOG_LENGTH = 1000
+
+active_encodes = 0
+
+
+def get_available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def estimate_thread_speeds(ladder: list, observed: dict) -> dict:
+    """Per-thread speed of every tier; unobserved tiers scale from observed ones"""
+    scales = [observed[tier] / relative for tier, relative in ladder if tier in observed]
+    scale = sum(scales) / len(scales) if scales else BASE_THREAD_SPEED
+    return {tier: observed.get(tier, relative * scale) for tier, relative in ladder}
+
+
+async def load_observed_speeds(profile: str, codec: str) -> dict:
+    prefix = f"{profile}:{codec}:"
+    speeds = await redis_client.hgetall(POLICY_SPEEDS_KEY)
+    return {field[len(prefix):]: float(value)
+            for field, value in speeds.items() if field.startswith(prefix)}
+
+
+async def choose_stream_policy(cache_key: str, quality: str, duration: float) -> dict:
+    """Pick the x264 preset and thread count for an HLS encode, and log the decision"""
+    profile = f"hls_{quality}"
+    threads = max(get_available_cores() // (active_encodes + 1), 1)
+    tier = "veryfast"
+    
+    if settings.encoding_policy_enabled:
+        speeds = estimate_thread_speeds(ENCODER_LADDER,
+                                        await load_observed_speeds(profile, "libx264"))
+        tier = ENCODER_LADDER[-1][0]
+        for candidate, _ in ENCODER_LADDER:
+            if speeds[candidate] * threads >= settings.stream_min_speed:
+                tier = candidate
+                break
+        
+        decision = {
+            "job_id": cache_key,
+            "profile": profile,
+            "codec": "libx264",
+            "tier": tier,
+            "threads": threads,
+            "active_encodes": active_encodes,
+            "duration": round(duration, 2),
+            "estimated_speed": round(speeds[tier] * threads, 2),
+            "target_speed": settings.stream_min_speed,
+            "worker": "streamer",
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.lpush(POLICY_LOG_KEY, json.dumps(decision))
+            pipe.ltrim(POLICY_LOG_KEY, 0, POLICY_LOG_LENGTH - 1)
+            await pipe.execute()
+    
+    return {"profile": profile, "tier": tier, "threads": threads, "duration": duration}
+
+
+async def record_encoding_speed(decision: dict, elapsed: float):
+    """Fold a finished encode's per-thread speed into the learned estimates"""
+    if not decision["duration"] or elapsed <= 0:
+        return
+    field = f"{decision['profile']}:libx264:{decision['tier']}"
+    speed = decision["duration"] / elapsed / decision["threads"]
+    previous = await redis_client.hget(POLICY_SPEEDS_KEY, field)
+    if previous:
+        speed = SPEED_EWMA_ALPHA * speed + (1 - SPEED_EWMA_ALPHA) * float(previous)
+    await redis_client.hset(POLICY_SPEEDS_KEY, field, round(speed, 4))
+
+
+# ===========================================
+# Adaptive bitrate (multi-variant) HLS
+# ===========================================
+# Every rendition comes out of one ffmpeg run: the input is decoded once and
+# each rung is scaled from the rung above it, so the expensive downscale from
+# the source happens only once. Keyframes are forced on segment boundaries so
+# players can switch renditions at any segment.
+
+HLS_SEGMENT_SECONDS = 4
+
+
+def get_preset_height(quality: str) -> int:
+    return int(QUALITY_PRESETS[quality]["resolution"].split("x")[1])
+
+
+def resolve_renditions(names: Optional[List[str]]) -> List[str]:
+    """Validate requested renditions; highest first, all presets by default"""
+    names = list(dict.fromkeys(names or QUALITY_PRESETS))
+    for name in names:
+        if name not in QUALITY_PRESETS:
+            raise HTTPException(status_code=400, detail=f"Unknown quality: {name}")
+    return sorted(names, key=get_preset_height, reverse=True)
+
+
+def build_abr_command(file_path: str, hls_dir: str, renditions: List[str],
+                      has_audio: bool, policy: dict) -> list:
+    """One ffmpeg command writing every rendition plus master.m3u8"""
+    graph = []
+    source = "[0:v]"
+    for i, quality in enumerate(renditions):
+        scale = f"{source}scale=-2:{get_preset_height(quality)}"
+        if i < len(renditions) - 1:
+            # Keep one copy for this rung and feed the other to the next one down
+            graph.append(f"{scale},split=2[v{i}][c{i}]")
+            source = f"[c{i}]"
+        else:
+            graph.append(f"{scale}[v{i}]")
+    
+    cmd = [
+        "ffmpeg", "-y", "-i", file_path,
+        "-filter_complex", ";".join(graph)
+    ]
+    stream_map = []
+    for i, quality in enumerate(renditions):
+        preset = QUALITY_PRESETS[quality]
+        bitrate = int(preset["bitrate"].rstrip("k"))
+        cmd.extend([
+            "-map", f"[v{i}]",
+            f"-b:v:{i}", preset["bitrate"],
+            f"-maxrate:v:{i}", f"{int(bitrate * 1.07)}k",
+            f"-bufsize:v:{i}", f"{bitrate * 2}k"
+        ])
+        entry = f"v:{i}"
+        if has_audio:
+            cmd.extend(["-map", "0:a:0", f"-b:a:{i}", preset["audio_bitrate"]])
+            entry += f",a:{i}"
+        stream_map.append(f"{entry},name:{quality}")
+    
+    cmd.extend([
+        "-c:v", "libx264",
+        "-preset", policy["tier"],
+        "-threads", str(policy["threads"]),
+        # Aligned keyframes on every segment boundary, in every rendition
+        "-force_key_frames", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})",
+        "-sc_threshold", "0"
+    ])
+    if has_audio:
+        cmd.extend(["-c:a", "aac"])
+    cmd.extend([
+        "-f", "hls",
+        "-hls_time", str(HLS_SEGMENT_SECONDS),
+        "-hls_list_size", "0",
+        "-hls_playlist_type", "event",
+        "-hls_flags", "temp_file",
+        "-master_pl_name", "master.m3u8",
+        "-var_stream_map", " ".join(stream_map),
+        "-hls_segment_filename", os.path.join(hls_dir, "stream_%v_%03d.ts"),
+        os.path.join(hls_dir, "stream_%v.m3u8")
+    ])
+    return cmd
+
+
+async def track_hls_progress(process, cache_key: str, duration: float):
+    """Publish generation progress from ffmpeg's -progress output, at most once a second"""
+    last_update = 0
+    while True:
+        line = await process.stdout.readline()
+        if not line:
+            break
+        line = line.decode().strip()
+        if not line.startswith("out_time_ms=") or duration <= 0:
+            continue
+        try:
+            current_time = int(line.split("=")[1]) / 1000000
+        except ValueError:
+            continue
+        if time.monotonic() - last_update >= 1:
+            last_update = time.monotonic()
+            progress = round(min(current_time / duration * 100, 99), 1)
+            await redis_client.hset(f"stream:{cache_key}", "progress", progress)
+
+
+async def generate_hls(file_path: str, cache_key: str, quality: str,
+                       renditions: Optional[List[str]] = None):
+    """Generate HLS stream from video file
+    
+    With renditions, every listed quality is encoded in one pass and
+    master.m3u8 ties them together for adaptive playback.
+    """
+    global active_encodes
     hls_dir = get_hls_dir(cache_key)
     os.makedirs(hls_dir, exist_ok=True)
     
@@ -105,70 +641,268 @@ async def generate_hls(file_path: str, cache_key: str, quality: str):
     playlist_path = os.path.join(hls_dir, "playlist.m3u8")
     segment_path = os.path.join(hls_dir, "segment_%03d.ts")
     
+    # Get video duration and pick the encoder speed for the current load
+    duration = await get_video_duration(file_path)
+    policy = await choose_stream_policy(cache_key, quality, duration)
+    
     # Build FFmpeg command
-    cmd = [
-        "ffmpeg", "-y",
-        "-i", file_path,
-        "-c:v", "libx264",
-        "-preset", "veryfast",
-        "-tune", "zerolatency",
-        "-crf", "23",
-        "-vf", f"scale={preset['resolution']}",
-        "-b:v", preset["bitrate"],
-        "-c:a", "aac",
-        "-b:a", preset["audio_bitrate"],
-        "-f", "hls",
-        "-hls_time", "4",
-        "-hls_list_size", "0",
-        "-hls_segment_filename", segment_path,
-        playlist_path
-    ]
+    if renditions:
+        info = await probe_cache.get(file_path)
+        streams = info.get("streams", [])
+        source_height = max((s.get("height") or 0 for s in streams
+                             if s.get("codec_type") == "video"), default=0)
+        # Don't upscale: drop rungs above the source, keeping at least the lowest
+        renditions = [q for q in renditions if get_preset_height(q) <= source_height] or renditions[-1:]
+        has_audio = any(s.get("codec_type") == "audio" for s in streams)
+        playlist_path = os.path.join(hls_dir, "master.m3u8")
+        cmd = build_abr_command(file_path, hls_dir, renditions, has_audio, policy)
+    else:
+        cmd = [
+            "ffmpeg", "-y",
+            "-i", file_path,
+            "-c:v", "libx264",
+            "-preset", policy["tier"],
+            "-threads", str(policy["threads"]),
+            "-tune", "zerolatency",
+            "-crf", "23",
+            "-vf", f"scale={preset['resolution']}",
+            "-b:v", preset["bitrate"],
+            "-c:a", "aac",
+            "-b:a", preset["audio_bitrate"],
+            "-f", "hls",
+            "-hls_time", "4",
+            "-hls_list_size", "0",
+            # EVENT playlists grow as segments finish, so playback can start early;
+            # temp_file keeps half-written segments out of sight
+            "-hls_playlist_type", "event",
+            "-hls_flags", "temp_file",
+            "-hls_segment_filename", segment_path,
+            playlist_path
+        ]
+    cmd[1:1] = ["-progress", "pipe:1", "-nostats"]
     
     # Set status in Redis
-    redis_client.hset(f"stream:{cache_key}", mapping={
+    await redis_client.hset(f"stream:{cache_key}", mapping={
         "status": "generating",
         "progress": 0,
         "file_path": file_path,
         "quality": quality
     })
     
+    active_encodes += 1
     try:
-        # Get video duration
-        duration_result = subprocess.run([
-            "ffprobe", "-v", "error",
-            "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-            file_path
-        ], capture_output=True, text=True)
-        duration = float(duration_result.stdout.strip()) if duration_result.stdout.strip() else 0
-        
         # Run FFmpeg
+        started = time.monotonic()
         process = await asyncio.create_subprocess_exec(
             *cmd,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE
         )
-        
+        # Drain stderr concurrently so a full pipe can't stall ffmpeg
+        stderr_task = asyncio.create_task(process.stderr.read())
+        await track_hls_progress(process, cache_key, duration)
         await process.wait()
+        stderr = await stderr_task
         
         if process.returncode == 0:
-            redis_client.hset(f"stream:{cache_key}", mapping={
+            await redis_client.hset(f"stream:{cache_key}", mapping={
                 "status": "ready",
                 "progress": 100,
                 "playlist": playlist_path
             })
+            await record_encoding_speed(policy, time.monotonic() - started)
+            await track_cache_entry(f"hls/{cache_key}")
         else:
-            stderr = await process.stderr.read()
-            redis_client.hset(f"stream:{cache_key}", mapping={
+            await redis_client.hset(f"stream:{cache_key}", mapping={
                 "status": "failed",
                 "error": stderr.decode()[:500]
             })
             
     except Exception as e:
-        redis_client.hset(f"stream:{cache_key}", mapping={
+        await redis_client.hset(f"stream:{cache_key}", mapping={
             "status": "failed",
             "error": str(e)
         })
+    finally:
+        active_encodes -= 1
+
+
+# ===========================================
+# Just-in-time HLS
+# ===========================================
+# The playlist is written from the probed duration straight away and each
+# segment is transcoded with -ss/-t the first time it is requested. A short
+# read-ahead encodes the next segments in the background and is cancelled
+# when the viewer seeks elsewhere.
+
+JIT_SEGMENT_PATTERN = re.compile(r"^jit_(\d{5})\.ts$")
+
+
+def get_jit_segment_name(index: int) -> str:
+    return f"jit_{index:05d}.ts"
+
+
+def build_jit_playlist(duration: float) -> tuple:
+    """VOD playlist covering the whole input; returns (text, segment count)"""
+    count = max(math.ceil(duration / HLS_SEGMENT_SECONDS), 1)
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{HLS_SEGMENT_SECONDS}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD"
+    ]
+    for index in range(count):
+        length = min(HLS_SEGMENT_SECONDS, duration - index * HLS_SEGMENT_SECONDS)
+        lines.append(f"#EXTINF:{length:.3f},")
+        lines.append(get_jit_segment_name(index))
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n", count
+
+
+async def prepare_jit_stream(file_path: str, cache_key: str, quality: str):
+    duration = await get_video_duration(file_path)
+    if not duration:
+        raise HTTPException(status_code=422, detail="Could not read the video duration")
+    
+    hls_dir = get_hls_dir(cache_key)
+    os.makedirs(hls_dir, exist_ok=True)
+    playlist, count = build_jit_playlist(duration)
+    playlist_path = os.path.join(hls_dir, "playlist.m3u8")
+    async with aiofiles.open(playlist_path, "w") as f:
+        await f.write(playlist)
+    
+    await redis_client.hset(f"stream:{cache_key}", mapping={
+        "status": "ready",
+        "mode": "jit",
+        "progress": 100,
+        "file_path": file_path,
+        "quality": quality,
+        "duration": duration,
+        "segments": count,
+        "playlist": playlist_path
+    })
+    await track_cache_entry(f"hls/{cache_key}")
+
+
+async def transcode_segment(stream_id: str, stream: dict, index: int) -> str:
+    """Encode one segment of a JIT stream; returns its path"""
+    segment_path = os.path.join(get_hls_dir(stream_id), get_jit_segment_name(index))
+    if os.path.exists(segment_path):
+        return segment_path
+    
+    preset = QUALITY_PRESETS.get(stream.get("quality"), QUALITY_PRESETS["720p"])
+    start = index * HLS_SEGMENT_SECONDS
+    length = min(HLS_SEGMENT_SECONDS, float(stream["duration"]) - start)
+    part_path = f"{segment_path}.part"
+    cmd = [
+        "ffmpeg", "-y",
+        "-ss", f"{start:.3f}",
+        "-i", stream["file_path"],
+        "-t", f"{length:.3f}",
+        "-c:v", "libx264",
+        "-preset", settings.jit_preset,
+        "-tune", "zerolatency",
+        "-crf", "23",
+        "-vf", f"scale={preset['resolution']}",
+        "-b:v", preset["bitrate"],
+        "-c:a", "aac",
+        "-b:a", preset["audio_bitrate"],
+        # Keep timestamps continuous across independently encoded segments
+        "-output_ts_offset", f"{start:.3f}",
+        "-f", "mpegts",
+        part_path
+    ]
+    
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    
+    if process.returncode != 0:
+        raise RuntimeError(stderr.decode(errors="replace")[-500:])
+    os.replace(part_path, segment_path)
+    await grow_cache_entry(f"hls/{stream_id}", os.path.getsize(segment_path))
+    return segment_path
+
+
+class JitTranscoder:
+    """Runs JIT segment encodes, sharing them between concurrent requests"""
+    
+    def __init__(self, read_ahead: int):
+        self.read_ahead = read_ahead
+        self.segments = {}  # (stream_id, index) -> Task
+        self.read_ahead_tasks = {}  # stream_id -> (first index, Task)
+    
+    def _ensure(self, stream_id: str, stream: dict, index: int) -> asyncio.Task:
+        key = (stream_id, index)
+        task = self.segments.get(key)
+        if task is None or task.cancelled():
+            task = asyncio.create_task(transcode_segment(stream_id, stream, index))
+            self.segments[key] = task
+            task.add_done_callback(
+                lambda t: self.segments.pop(key) if self.segments.get(key) is t else None
+            )
+        return task
+    
+    async def _read_ahead(self, stream_id: str, stream: dict, first: int):
+        last = min(first + self.read_ahead, int(stream["segments"]))
+        for index in range(first, last):
+            try:
+                # Shielded so cancelling the loop leaves an in-flight segment running
+                await asyncio.shield(self._ensure(stream_id, stream, index))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"JIT read-ahead failed for {stream_id} #{index}: {e}")
+                return
+    
+    def _schedule_read_ahead(self, stream_id: str, stream: dict, index: int):
+        previous = self.read_ahead_tasks.pop(stream_id, None)
+        if previous:
+            first, task = previous
+            task.cancel()
+            if not first - 1 <= index <= first + self.read_ahead:
+                # The viewer seeked: drop read-ahead work outside the new window
+                window = range(index, index + self.read_ahead + 1)
+                for (other_id, other_index), segment_task in list(self.segments.items()):
+                    if other_id == stream_id and other_index not in window:
+                        segment_task.cancel()
+        task = asyncio.create_task(self._read_ahead(stream_id, stream, index + 1))
+        self.read_ahead_tasks[stream_id] = (index + 1, task)
+    
+    async def get_segment(self, stream_id: str, stream: dict, index: int) -> str:
+        self._schedule_read_ahead(stream_id, stream, index)
+        while True:
+            task = self._ensure(stream_id, stream, index)
+            try:
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                # A seek from another request cancelled the shared encode; we
+                # still want this segment, so start it again
+                if task.cancelled():
+                    continue
+                raise
+    
+    def forget(self, stream_id: str):
+        previous = self.read_ahead_tasks.pop(stream_id, None)
+        if previous:
+            previous[1].cancel()
+        for (other_id, _), task in list(self.segments.items()):
+            if other_id == stream_id:
+                task.cancel()
+
+
+jit_transcoder = JitTranscoder(settings.jit_read_ahead)
 
 
 async def generate_preview(file_path: str, start_time: str, duration: int) -> str:
@@ -182,6 +916,7 @@ async def generate_preview(file_path: str, start_time: str, duration: int) -> st
     
     # Check if already exists
     if os.path.exists(playlist_path):
+        await touch_cache_entry(f"previews/{preview_hash}")
         return preview_hash
     
     cmd = [
@@ -198,6 +933,8 @@ async def generate_preview(file_path: str, start_time: str, duration: int) -> st
         "-f", "hls",
         "-hls_time", "2",
         "-hls_list_size", "0",
+        # Segments are served as immutable, so never expose half-written ones
+        "-hls_flags", "temp_file",
         "-hls_segment_filename", segment_path,
         playlist_path
     ]
@@ -214,9 +951,84 @@ async def generate_preview(file_path: str, start_time: str, duration: int) -> st
         stderr = await process.stderr.read()
         raise Exception(f"Preview generation failed: {stderr.decode()[:200]}")
     
+    await track_cache_entry(f"previews/{preview_hash}")
     return preview_hash
 
 
+@app.on_event("startup")
+async def start_cache_manager():
+    asyncio.create_task(cache_manager_loop())
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    await redis_client.aclose()
+
+
+# ===========================================
+# Single-flight stream generation
+# ===========================================
+# One generate_hls per cache key across all streamer processes. The owner
+# holds a leased Redis lock and refreshes it while ffmpeg runs; if the owner
+# dies the lease expires and the next prepare takes over.
+
+streamer_id = f"{socket.gethostname()}:{os.getpid()}"
+
+# Refresh or delete the lock only if we still own it
+REFRESH_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def get_stream_lock_key(cache_key: str) -> str:
+    return f"stream:lock:{cache_key}"
+
+
+async def acquire_stream_lock(cache_key: str) -> Optional[str]:
+    """Take the generation lock for a stream; returns the owner token or None"""
+    token = f"{streamer_id}:{uuid.uuid4().hex}"
+    if await redis_client.set(get_stream_lock_key(cache_key), token,
+                              nx=True, ex=settings.stream_lock_seconds):
+        return token
+    return None
+
+
+async def release_stream_lock(cache_key: str, token: str):
+    await redis_client.eval(RELEASE_LOCK_SCRIPT, 1, get_stream_lock_key(cache_key), token)
+
+
+async def stream_lock_heartbeat(cache_key: str, token: str):
+    interval = max(settings.stream_lock_seconds // 3, 1)
+    while True:
+        await asyncio.sleep(interval)
+        if not await redis_client.eval(REFRESH_LOCK_SCRIPT, 1, get_stream_lock_key(cache_key),
+                                       token, settings.stream_lock_seconds):
+            print(f"Lost generation lock for stream {cache_key}")
+            return
+
+
+async def run_stream_generation(file_path: str, cache_key: str, quality: str,
+                                renditions: Optional[List[str]], token: str):
+    """Generate a stream while holding (and heartbeating) its lock"""
+    heartbeat = asyncio.create_task(stream_lock_heartbeat(cache_key, token))
+    try:
+        # Segments left behind by a crashed owner must not be served as ours
+        await asyncio.to_thread(shutil.rmtree, get_hls_dir(cache_key), True)
+        await generate_hls(file_path, cache_key, quality, renditions)
+    finally:
+        heartbeat.cancel()
+        await release_stream_lock(cache_key, token)
+
+
 @app.get("/")
 async def root():
     return {"service": "streamer", "status": "running", "version": "1.0.0"}
@@ -225,7 +1037,7 @@ async def root():
 @app.get("/health")
 async def health():
     try:
-        redis_client.ping()
+        await redis_client.ping()
         return {"status": "healthy", "redis": "connected"}
     except:
         return JSONResponse(status_code=503, content={"status": "unhealthy"})
@@ -237,31 +1049,73 @@ async def prepare_stream(request: StreamRequest, background_tasks: BackgroundTas
     if not os.path.exists(request.file_path):
         raise HTTPException(status_code=404, detail="File not found")
     
-    cache_key = get_cache_key(request.file_path, request.quality)
+    quality = request.quality
+    if request.mode == "jit":
+        if quality == "abr" or request.renditions:
+            raise HTTPException(status_code=400, detail="JIT streams have a single rendition")
+        cache_key = await get_cache_key(request.file_path, f"jit:{quality}")
+        stream_data = await redis_client.hgetall(f"stream:{cache_key}")
+        if stream_data.get("status") != "ready":
+            await prepare_jit_stream(request.file_path, cache_key, quality)
+        return {
+            "stream_id": cache_key,
+            "status": "ready",
+            "mode": "jit",
+            "playlist_url": f"/stream/{cache_key}/playlist.m3u8"
+        }
+    
+    renditions = None
+    playlist_name = "playlist.m3u8"
+    if quality == "abr" or request.renditions:
+        renditions = resolve_renditions(request.renditions)
+        quality = "abr"
+        playlist_name = "master.m3u8"
+        cache_key = await get_cache_key(request.file_path, "abr:" + ",".join(renditions))
+    else:
+        cache_key = await get_cache_key(request.file_path, quality)
     
     # Check if already cached
-    stream_data = redis_client.hgetall(f"stream:{cache_key}")
+    stream_data = await redis_client.hgetall(f"stream:{cache_key}")
     if stream_data and stream_data.get("status") == "ready":
         return {
             "stream_id": cache_key,
             "status": "ready",
-            "playlist_url": f"/stream/{cache_key}/playlist.m3u8"
+            "playlist_url": f"/stream/{cache_key}/{playlist_name}"
         }
     
-    # Start generation in background
-    background_tasks.add_task(generate_hls, request.file_path, cache_key, request.quality)
+    # Only the lock owner generates; everyone else attaches to that run and
+    # picks up segments as they appear
+    token = await acquire_stream_lock(cache_key)
+    if token and await redis_client.hget(f"stream:{cache_key}", "status") == "ready":
+        # The previous owner finished between our check and the lock
+        await release_stream_lock(cache_key, token)
+        return {
+            "stream_id": cache_key,
+            "status": "ready",
+            "playlist_url": f"/stream/{cache_key}/{playlist_name}"
+        }
+    if token:
+        await redis_client.hset(f"stream:{cache_key}", mapping={
+            "status": "generating",
+            "progress": 0,
+            "file_path": request.file_path,
+            "quality": quality
+        })
+        background_tasks.add_task(run_stream_generation, request.file_path, cache_key,
+                                  quality, renditions, token)
     
     return {
         "stream_id": cache_key,
         "status": "generating",
-        "playlist_url": f"/stream/{cache_key}/playlist.m3u8"
+        "attached": token is None,
+        "playlist_url": f"/stream/{cache_key}/{playlist_name}"
     }
 
 
 @app.get("/stream/{stream_id}/status")
 async def stream_status(stream_id: str):
     """Get stream generation status"""
-    stream_data = redis_client.hgetall(f"stream:{stream_id}")
+    stream_data = await redis_client.hgetall(f"stream:{stream_id}")
     
     if not stream_data:
         raise HTTPException(status_code=404, detail="Stream not found")
@@ -269,40 +1123,144 @@ async def stream_status(stream_id: str):
     return stream_data
 
 
+# ===========================================
+# Cached file serving
+# ===========================================
+# Segments are only renamed into place once complete (temp_file, .part), so
+# a file's inode, size and mtime identify its bytes exactly: that makes a
+# strong ETag, and finished segments can be cached as immutable. Playlists
+# that ffmpeg is still extending get a short TTL instead.
+
+SEGMENT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+PLAYLIST_CACHE_CONTROL = "public, max-age=300"
+LIVE_PLAYLIST_CACHE_CONTROL = "public, max-age=1"
+PLAYLIST_MEDIA_TYPE = "application/vnd.apple.mpegurl"
+
+
+class CachedFileResponse(FileResponse):
+    # Fewer worker-thread round trips per segment than the 64 KiB default
+    chunk_size = 512 * 1024
+
+
+def get_file_etag(stat_result: os.stat_result) -> str:
+    return f'"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """Evaluate If-None-Match / If-Modified-Since against the file"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison, as RFC 9110 requires for If-None-Match
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def serve_cached_file(request: Request, path: str, media_type: str,
+                      cache_control: str) -> Response:
+    """FileResponse with validators, answering conditional requests with 304"""
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    etag = get_file_etag(stat_result)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Access-Control-Allow-Origin": "*"
+    }
+    if is_not_modified(request, etag, stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
+    return CachedFileResponse(path, media_type=media_type, headers=headers,
+                              stat_result=stat_result)
+
+
+async def get_playlist_cache_control(stream_id: str) -> str:
+    status = await redis_client.hget(f"stream:{stream_id}", "status")
+    return LIVE_PLAYLIST_CACHE_CONTROL if status == "generating" else PLAYLIST_CACHE_CONTROL
+
+
+async def wait_for_stream_file(stream_id: str, path: str, timeout: float) -> bool:
+    """Long-poll for a file ffmpeg is still producing
+    
+    Returns as soon as the file exists, or False once the stream stops
+    generating or the timeout passes.
+    """
+    deadline = time.monotonic() + timeout
+    next_status_check = 0
+    while not os.path.exists(path):
+        now = time.monotonic()
+        if now >= deadline:
+            return False
+        if now >= next_status_check:
+            status = await redis_client.hget(f"stream:{stream_id}", "status")
+            if status == "generating" and not await redis_client.exists(get_stream_lock_key(stream_id)):
+                # Its owner died; the next prepare restarts it
+                status = "stale"
+            if status != "generating":
+                # Finished or failed in the meantime; one last look
+                return os.path.exists(path)
+            next_status_check = now + 1
+        await asyncio.sleep(0.25)
+    return True
+
+
 @app.get("/stream/{stream_id}/playlist.m3u8")
-async def get_playlist(stream_id: str):
+async def get_playlist(stream_id: str, request: Request):
     """Get HLS playlist"""
     hls_dir = get_hls_dir(stream_id)
     playlist_path = os.path.join(hls_dir, "playlist.m3u8")
     
-    if not os.path.exists(playlist_path):
-        # Check if generating
-        stream_data = redis_client.hgetall(f"stream:{stream_id}")
+    # While generating, wait for ffmpeg to finish the first segment; the
+    # EVENT playlist then lists every segment completed so far
+    if not await wait_for_stream_file(stream_id, playlist_path, settings.playlist_wait_seconds):
+        stream_data = await redis_client.hgetall(f"stream:{stream_id}")
         if stream_data and stream_data.get("status") == "generating":
             raise HTTPException(status_code=202, detail="Stream is being generated")
         raise HTTPException(status_code=404, detail="Playlist not found")
     
-    return FileResponse(
-        playlist_path,
-        media_type="application/vnd.apple.mpegurl",
-        headers={"Access-Control-Allow-Origin": "*"}
-    )
+    await touch_cache_entry(f"hls/{stream_id}")
+    # The playlist grows until generation ends
+    return serve_cached_file(request, playlist_path, PLAYLIST_MEDIA_TYPE,
+                             await get_playlist_cache_control(stream_id))
 
 
 @app.get("/stream/{stream_id}/{segment}")
-async def get_segment(stream_id: str, segment: str):
+async def get_segment(stream_id: str, segment: str, request: Request):
     """Get HLS segment"""
     hls_dir = get_hls_dir(stream_id)
     segment_path = os.path.join(hls_dir, segment)
     
-    if not os.path.exists(segment_path):
+    # JIT segments go through the transcoder even when cached, so every
+    # request moves the read-ahead window along
+    match = JIT_SEGMENT_PATTERN.match(segment)
+    stream_data = await redis_client.hgetall(f"stream:{stream_id}") if match else {}
+    if stream_data.get("mode") == "jit":
+        index = int(match.group(1))
+        if index >= int(stream_data["segments"]):
+            raise HTTPException(status_code=404, detail="Segment not found")
+        try:
+            segment_path = await jit_transcoder.get_segment(stream_id, stream_data, index)
+        except RuntimeError as e:
+            raise HTTPException(status_code=500, detail=f"Segment transcode failed: {e}")
+    
+    if not await wait_for_stream_file(stream_id, segment_path, settings.segment_wait_seconds):
         raise HTTPException(status_code=404, detail="Segment not found")
     
-    return FileResponse(
-        segment_path,
-        media_type="video/mp2t",
-        headers={"Access-Control-Allow-Origin": "*"}
-    )
+    await touch_cache_entry(f"hls/{stream_id}")
+    # ABR streams serve master.m3u8 and the variant playlists from here too
+    if segment.endswith(".m3u8"):
+        return serve_cached_file(request, segment_path, PLAYLIST_MEDIA_TYPE,
+                                 await get_playlist_cache_control(stream_id))
+    return serve_cached_file(request, segment_path, "video/mp2t", SEGMENT_CACHE_CONTROL)
 
 
 @app.post("/preview")
@@ -312,9 +1270,13 @@ async def create_preview(request: PreviewRequest):
         raise HTTPException(status_code=404, detail="File not found")
     
     try:
+        start_time = request.start_time
+        if start_time == "auto":
+            analysis = await analyse_media(request.file_path, request.duration, 1)
+            start_time = f"{analysis['preview_start']:.3f}"
         preview_id = await generate_preview(
             request.file_path,
-            request.start_time,
+            start_time,
             request.duration
         )
         
@@ -327,7 +1289,7 @@ async def create_preview(request: PreviewRequest):
 
 
 @app.get("/preview/{preview_id}/playlist.m3u8")
-async def get_preview_playlist(preview_id: str):
+async def get_preview_playlist(preview_id: str, request: Request):
     """Get preview HLS playlist"""
     preview_dir = os.path.join(settings.cache_path, "previews", preview_id)
     playlist_path = os.path.join(preview_dir, "playlist.m3u8")
@@ -335,67 +1297,453 @@ async def get_preview_playlist(preview_id: str):
     if not os.path.exists(playlist_path):
         raise HTTPException(status_code=404, detail="Preview not found")
     
-    return FileResponse(
-        playlist_path,
-        media_type="application/vnd.apple.mpegurl",
-        headers={"Access-Control-Allow-Origin": "*"}
-    )
+    await touch_cache_entry(f"previews/{preview_id}")
+    return serve_cached_file(request, playlist_path, PLAYLIST_MEDIA_TYPE, PLAYLIST_CACHE_CONTROL)
 
 
 @app.get("/preview/{preview_id}/{segment}")
-async def get_preview_segment(preview_id: str, segment: str):
+async def get_preview_segment(preview_id: str, segment: str, request: Request):
     """Get preview HLS segment"""
     preview_dir = os.path.join(settings.cache_path, "previews", preview_id)
     segment_path = os.path.join(preview_dir, segment)
     
-    if not os.path.exists(segment_path):
-        raise HTTPException(status_code=404, detail="Segment not found")
+    await touch_cache_entry(f"previews/{preview_id}")
+    return serve_cached_file(request, segment_path, "video/mp2t", SEGMENT_CACHE_CONTROL)
+
+
+# ===========================================
+# Trickplay
+# ===========================================
+# Scrubbing previews: one low-priority ffmpeg decodes only keyframes, samples
+# a frame per interval and tiles them into sprite sheets, and a WebVTT file
+# maps each interval to its tile (#xywh) for the player.
+
+trickplay_slots = asyncio.Semaphore(settings.trickplay_max_jobs)
+
+
+def get_trickplay_dir(trickplay_id: str) -> str:
+    return os.path.join(settings.cache_path, "trickplay", trickplay_id)
+
+
+def format_vtt_time(seconds: float) -> str:
+    hours, rest = divmod(seconds, 3600)
+    minutes, rest = divmod(rest, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{rest:06.3f}"
+
+
+def build_trickplay_vtt(duration: float, interval: float, width: int, height: int,
+                        columns: int, rows: int) -> str:
+    lines = ["WEBVTT", ""]
+    per_sheet = columns * rows
+    for index in range(max(math.ceil(duration / interval), 1)):
+        start = index * interval
+        end = min((index + 1) * interval, duration)
+        sheet, position = divmod(index, per_sheet)
+        x = (position % columns) * width
+        y = (position // columns) * height
+        lines.append(f"{format_vtt_time(start)} --> {format_vtt_time(end)}")
+        # image2 numbers sheets from 1
+        lines.append(f"sprite_{sheet + 1:03d}.jpg#xywh={x},{y},{width},{height}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+async def generate_trickplay(file_path: str, trickplay_id: str, interval: float,
+                             width: int, token: str):
+    """Render sprite sheets and their WebVTT index while holding the lock"""
+    heartbeat = asyncio.create_task(stream_lock_heartbeat(trickplay_id, token))
+    trickplay_dir = get_trickplay_dir(trickplay_id)
+    columns, rows = settings.trickplay_columns, settings.trickplay_rows
+    try:
+        async with trickplay_slots:
+            await asyncio.to_thread(shutil.rmtree, trickplay_dir, True)
+            os.makedirs(trickplay_dir, exist_ok=True)
+            
+            info = await probe_cache.get(file_path)
+            duration = await get_video_duration(file_path)
+            video = next((s for s in info.get("streams", []) if s.get("codec_type") == "video"), None)
+            if not video or not duration:
+                raise RuntimeError("No video stream or duration")
+            # Even tile height keeping the source aspect, so the VTT coordinates are exact
+            height = max(round(width * video["height"] / video["width"] / 2) * 2, 2)
+            
+            cmd = [
+                "nice", "-n", str(settings.trickplay_nice),
+                "ffmpeg", "-y",
+                # Decode keyframes only; fps then picks one per interval
+                "-skip_frame", "nokey",
+                "-i", file_path,
+                "-an", "-sn",
+                "-vf", f"fps=1/{interval},scale={width}:{height},tile={columns}x{rows}",
+                "-q:v", "5",
+                os.path.join(trickplay_dir, "sprite_%03d.jpg")
+            ]
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            _, stderr = await process.communicate()
+            if process.returncode != 0:
+                raise RuntimeError(stderr.decode(errors="replace")[-500:])
+            
+            vtt = build_trickplay_vtt(duration, interval, width, height, columns, rows)
+            async with aiofiles.open(os.path.join(trickplay_dir, "thumbnails.vtt"), "w") as f:
+                await f.write(vtt)
+        
+        await redis_client.hset(f"trickplay:{trickplay_id}", mapping={
+            "status": "ready",
+            "sheets": len([n for n in os.listdir(trickplay_dir) if n.endswith(".jpg")]),
+            "tile_width": width,
+            "tile_height": height
+        })
+        await track_cache_entry(f"trickplay/{trickplay_id}")
+    except Exception as e:
+        await redis_client.hset(f"trickplay:{trickplay_id}", mapping={
+            "status": "failed",
+            "error": str(e)[:500]
+        })
+    finally:
+        heartbeat.cancel()
+        await release_stream_lock(trickplay_id, token)
+
+
+@app.post("/trickplay")
+async def create_trickplay(request: TrickplayRequest, background_tasks: BackgroundTasks):
+    """Queue trickplay sprite generation for a video"""
+    if not os.path.exists(request.file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    interval = request.interval or settings.trickplay_interval
+    width = request.width or settings.trickplay_width
+    if interval <= 0 or not 16 <= width <= 640:
+        raise HTTPException(status_code=400, detail="Invalid interval or width")
+    
+    grid = f"{settings.trickplay_columns}x{settings.trickplay_rows}"
+    trickplay_id = await get_cache_key(request.file_path, f"trickplay:{interval}:{width}:{grid}")
+    response = {
+        "trickplay_id": trickplay_id,
+        "vtt_url": f"/trickplay/{trickplay_id}/thumbnails.vtt"
+    }
+    
+    state = await redis_client.hgetall(f"trickplay:{trickplay_id}")
+    if state.get("status") == "ready":
+        return {**response, "status": "ready"}
+    
+    token = await acquire_stream_lock(trickplay_id)
+    if token:
+        await redis_client.hset(f"trickplay:{trickplay_id}", mapping={
+            "status": "generating",
+            "file_path": request.file_path,
+            "interval": interval,
+            "width": width
+        })
+        background_tasks.add_task(generate_trickplay, request.file_path, trickplay_id,
+                                  interval, width, token)
+    return {**response, "status": "generating"}
+
+
+@app.get("/trickplay/{trickplay_id}")
+async def trickplay_status(trickplay_id: str):
+    """Get trickplay generation status"""
+    state = await redis_client.hgetall(f"trickplay:{trickplay_id}")
+    if not state:
+        raise HTTPException(status_code=404, detail="Trickplay not found")
+    return state
+
+
+@app.get("/trickplay/{trickplay_id}/{name}")
+async def get_trickplay_file(trickplay_id: str, name: str, request: Request):
+    """Get the WebVTT index or a sprite sheet"""
+    if await redis_client.hget(f"trickplay:{trickplay_id}", "status") != "ready":
+        raise HTTPException(status_code=404, detail="Trickplay not ready")
     
-    return FileResponse(
-        segment_path,
-        media_type="video/mp2t",
-        headers={"Access-Control-Allow-Origin": "*"}
+    await touch_cache_entry(f"trickplay/{trickplay_id}")
+    path = os.path.join(get_trickplay_dir(trickplay_id), name)
+    if name == "thumbnails.vtt":
+        return serve_cached_file(request, path, "text/vtt", PLAYLIST_CACHE_CONTROL)
+    if name.endswith(".jpg"):
+        return serve_cached_file(request, path, "image/jpeg", SEGMENT_CACHE_CONTROL)
+    raise HTTPException(status_code=404, detail="File not found")
+
+
+# ===========================================
+# Frame analysis
+# ===========================================
+# Picks thumbnails and preview windows that aren't black frames or logos.
+# One low-priority ffmpeg decodes keyframes only at 160px and reports, per
+# frame, the scene-change score, mean luma and normalized entropy. The frame
+# list is cached in Redis on the file identity, like probes, and scored on
+# each request.
+
+ANALYSIS_KEY_PREFIX = "media:analysis"
+ANALYSIS_WIDTH = 160
+ANALYSIS_METRICS = {
+    "lavfi.scene_score": "scene",
+    "lavfi.signalstats.YAVG": "brightness",
+    "lavfi.entropy.normalized_entropy.normal.Y": "entropy"
+}
+ANALYSIS_METRIC_PATTERN = re.compile(r"(lavfi\.[\w.]+)=([\d.]+)")
+ANALYSIS_FRAME_PATTERN = re.compile(r"pts_time:([\d.]+)")
+# Cuts above this scene score make a preview window livelier
+SCENE_CUT_THRESHOLD = 0.3
+
+analysis_inflight = {}
+
+
+async def run_frame_analysis(file_path: str) -> list:
+    """[(time, scene, brightness, entropy)] for every keyframe"""
+    cmd = [
+        "nice", "-n", str(settings.trickplay_nice),
+        "ffmpeg", "-hide_banner", "-nostats",
+        "-skip_frame", "nokey",
+        "-i", file_path,
+        "-an", "-sn",
+        # select only computes scene scores when its expression uses them
+        "-vf", f"scale={ANALYSIS_WIDTH}:-2,select='gte(scene,0)',signalstats,entropy,metadata=print",
+        "-f", "null", "-"
+    ]
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
     )
+    _, stderr = await process.communicate()
+    
+    frames = []
+    current = None
+    for line in stderr.decode(errors="replace").splitlines():
+        frame_match = ANALYSIS_FRAME_PATTERN.search(line)
+        if frame_match:
+            current = {"time": float(frame_match.group(1))}
+            frames.append(current)
+            continue
+        metric_match = ANALYSIS_METRIC_PATTERN.search(line)
+        if current is not None and metric_match and metric_match.group(1) in ANALYSIS_METRICS:
+            current[ANALYSIS_METRICS[metric_match.group(1)]] = float(metric_match.group(2))
+    
+    if process.returncode != 0 and not frames:
+        raise RuntimeError(stderr.decode(errors="replace")[-300:])
+    return [(f["time"], f.get("scene", 0), f.get("brightness", 0), f.get("entropy", 0)) for f in frames]
 
 
-@app.get("/thumbnail")
-async def generate_thumbnail(file_path: str, time: str = "00:00:01"):
-    """Generate thumbnail from video"""
+async def get_frame_analysis(file_path: str) -> list:
+    """Cached frame analysis; concurrent callers share one ffmpeg"""
+    identity = await asyncio.to_thread(ProbeCache.identity, file_path)
+    redis_key = f"{ANALYSIS_KEY_PREFIX}:{hashlib.sha1(identity.encode()).hexdigest()}"
+    cached = await redis_client.get(redis_key)
+    if cached:
+        return json.loads(cached)
+    
+    future = analysis_inflight.get(identity)
+    if future is None:
+        future = asyncio.ensure_future(run_frame_analysis(file_path))
+        analysis_inflight[identity] = future
+        future.add_done_callback(lambda _: analysis_inflight.pop(identity, None))
+    frames = await asyncio.shield(future)
+    if frames:
+        await redis_client.set(redis_key, json.dumps(frames), ex=settings.probe_cache_ttl)
+    return frames
+
+
+def score_frame(scene: float, brightness: float, entropy: float) -> float:
+    # Black, faded or blown-out frames score near zero whatever their detail
+    exposure = max(1 - abs(brightness - 125) / 110, 0)
+    return round(entropy * exposure + 0.2 * min(scene, 1), 4)
+
+
+def pick_highlights(frames: list, duration: float, preview_duration: float, limit: int) -> dict:
+    """Best thumbnail times and preview start from analysed frames"""
+    scored = [
+        {"time": t, "score": score_frame(scene, brightness, entropy),
+         "scene": scene, "brightness": brightness, "entropy": entropy}
+        for t, scene, brightness, entropy in frames
+    ]
+    duration = duration or (scored[-1]["time"] if scored else 0)
+    # Skip intros and credits when there is anything in between
+    start_bound, end_bound = duration * 0.05, duration * 0.9
+    inner = [f for f in scored if start_bound <= f["time"] <= end_bound] or scored
+    candidates = sorted(inner, key=lambda f: f["score"], reverse=True)[:limit]
+    
+    # Preview: the window with the best mean score, plus a bonus per cut
+    preview_start, best_value = 0, -1
+    for i, first in enumerate(inner):
+        if i and first["time"] + preview_duration > end_bound:
+            break
+        window = [f for f in inner[i:] if f["time"] < first["time"] + preview_duration]
+        cuts = sum(1 for f in window if f["scene"] >= SCENE_CUT_THRESHOLD)
+        value = sum(f["score"] for f in window) / len(window) + 0.05 * cuts
+        if value > best_value:
+            preview_start, best_value = first["time"], value
+    
+    return {
+        "thumbnail_time": candidates[0]["time"] if candidates else min(1, duration),
+        "preview_start": preview_start,
+        "candidates": candidates
+    }
+
+
+async def analyse_media(file_path: str, preview_duration: float = 30, limit: int = 5) -> dict:
+    frames = await get_frame_analysis(file_path)
+    duration = await get_video_duration(file_path)
+    return {
+        "duration": duration,
+        "frames": len(frames),
+        **pick_highlights(frames, duration, preview_duration, limit)
+    }
+
+
+@app.get("/analysis")
+async def analyse_video(file_path: str, preview_duration: float = 30, limit: int = 5):
+    """Representative thumbnail times and preview start for a video"""
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found")
+    try:
+        return await analyse_media(file_path, preview_duration, min(max(limit, 1), 50))
+    except RuntimeError as e:
+        raise HTTPException(status_code=422, detail=f"Analysis failed: {e}")
+
+
+# ===========================================
+# Thumbnails
+# ===========================================
+# Any number of frames come out of one ffmpeg: each timestamp is its own
+# input with -ss before -i (a keyframe seek, not a decode from the start),
+# select keeps its first frame and split/scale fan it out to every size.
+# Frames are cached by md5 of path, time and (non-default) size.
+
+THUMBNAIL_DEFAULT_SIZE = "320x180"
+THUMBNAIL_SIZE_PATTERN = re.compile(r"^(\d{2,4})x(\d{2,4})$")
+
+
+def get_thumbnail_dir() -> str:
+    return os.path.join(settings.cache_path, "thumbnails")
+
+
+def get_thumbnail_name(file_path: str, timestamp: str, size: str) -> str:
+    key = f"{file_path}:{timestamp}" if size == THUMBNAIL_DEFAULT_SIZE else f"{file_path}:{timestamp}:{size}"
+    return f"{hashlib.md5(key.encode()).hexdigest()}.jpg"
+
+
+def build_thumbnail_command(file_path: str, frames: dict) -> tuple:
+    """One ffmpeg for {time: {size: output path}}; returns (cmd, [(tmp, final)])"""
+    cmd = ["ffmpeg", "-y", "-v", "error"]
+    for timestamp in frames:
+        cmd += ["-ss", timestamp, "-i", file_path]
     
-    thumb_hash = hashlib.md5(f"{file_path}:{time}".encode()).hexdigest()
-    thumb_dir = os.path.join(settings.cache_path, "thumbnails")
+    filters = []
+    outputs = []
+    renames = []
+    for index, sizes in enumerate(frames.values()):
+        labels = [f"t{index}s{n}" for n in range(len(sizes))]
+        filters.append(f"[{index}:v:0]select='eq(n,0)',split={len(sizes)}" +
+                       "".join(f"[{label}]" for label in labels))
+        for label, (size, path) in zip(labels, sizes.items()):
+            width, height = size.split("x")
+            filters.append(f"[{label}]scale={width}:{height}[{label}o]")
+            tmp_path = f"{path[:-4]}.tmp.jpg"
+            outputs += ["-map", f"[{label}o]", "-frames:v", "1", "-update", "1", tmp_path]
+            renames.append((tmp_path, path))
+    return cmd + ["-filter_complex", ";".join(filters)] + outputs, renames
+
+
+async def extract_thumbnails(file_path: str, timestamps: List[str], sizes: List[str]) -> list:
+    """Cached thumbnails for every timestamp and size, extracting the missing ones"""
+    thumb_dir = get_thumbnail_dir()
     os.makedirs(thumb_dir, exist_ok=True)
     
-    thumb_path = os.path.join(thumb_dir, f"{thumb_hash}.jpg")
+    results = []
+    missing = {}
+    for timestamp in timestamps:
+        for size in sizes:
+            name = get_thumbnail_name(file_path, timestamp, size)
+            path = os.path.join(thumb_dir, name)
+            cached = os.path.exists(path)
+            if cached:
+                await touch_cache_entry(f"thumbnails/{name}")
+            else:
+                missing.setdefault(timestamp, {})[size] = path
+            results.append({"time": timestamp, "size": size, "name": name, "cached": cached})
     
-    if not os.path.exists(thumb_path):
-        cmd = [
-            "ffmpeg", "-y",
-            "-ss", time,
-            "-i", file_path,
-            "-vframes", "1",
-            "-vf", "scale=320:180",
-            thumb_path
+    if missing:
+        cmd, renames = build_thumbnail_command(file_path, missing)
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        for tmp_path, path in renames:
+            # A timestamp past the end yields no frame; the rest still count
+            if os.path.exists(tmp_path):
+                os.replace(tmp_path, path)
+                await track_cache_entry(f"thumbnails/{os.path.basename(path)}")
+        if process.returncode != 0:
+            print(f"Thumbnail extraction failed for {file_path}: {stderr.decode(errors='replace')[-300:]}")
+    
+    for result in results:
+        result["ready"] = os.path.exists(os.path.join(thumb_dir, result["name"]))
+    return results
+
+
+@app.post("/thumbnails/batch")
+async def generate_thumbnail_batch(request: ThumbnailBatchRequest):
+    """Extract thumbnails at many timestamps and sizes with one ffmpeg"""
+    if not os.path.exists(request.file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    timestamps = list(dict.fromkeys(str(t) for t in request.timestamps))
+    sizes = list(dict.fromkeys(request.sizes or [THUMBNAIL_DEFAULT_SIZE]))
+    if not timestamps or any(not THUMBNAIL_SIZE_PATTERN.match(size) for size in sizes):
+        raise HTTPException(status_code=400, detail="Timestamps required and sizes must be WIDTHxHEIGHT")
+    if len(timestamps) * len(sizes) > settings.thumbnail_batch_max:
+        raise HTTPException(status_code=400, detail=f"At most {settings.thumbnail_batch_max} thumbnails per request")
+    
+    results = await extract_thumbnails(request.file_path, timestamps, sizes)
+    return {
+        "thumbnails": [
+            {
+                "time": r["time"],
+                "size": r["size"],
+                "cached": r["cached"],
+                "url": f"/thumbnails/{r['name']}" if r["ready"] else None
+            }
+            for r in results
         ]
-        
-        result = subprocess.run(cmd, capture_output=True)
-        
-        if result.returncode != 0:
-            raise HTTPException(status_code=500, detail="Failed to generate thumbnail")
+    }
+
+
+@app.get("/thumbnails/{name}")
+async def get_thumbnail(name: str, request: Request):
+    """Get a cached thumbnail"""
+    await touch_cache_entry(f"thumbnails/{name}")
+    return serve_cached_file(request, os.path.join(get_thumbnail_dir(), name),
+                             "image/jpeg", SEGMENT_CACHE_CONTROL)
+
+
+@app.get("/thumbnail")
+async def generate_thumbnail(file_path: str, time: str = "00:00:01"):
+    """Generate thumbnail from video ("auto" picks a representative frame)"""
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
     
-    return FileResponse(thumb_path, media_type="image/jpeg")
+    if time == "auto":
+        try:
+            time = f"{(await analyse_media(file_path, limit=1))['thumbnail_time']:.3f}"
+        except RuntimeError:
+            time = "00:00:01"
+    
+    result = (await extract_thumbnails(file_path, [time], [THUMBNAIL_DEFAULT_SIZE]))[0]
+    if not result["ready"]:
+        raise HTTPException(status_code=500, detail="Failed to generate thumbnail")
+    
+    return FileResponse(os.path.join(get_thumbnail_dir(), result["name"]), media_type="image/jpeg")
 
 
 @app.delete("/cache/preview/{preview_id}")
 async def delete_preview(preview_id: str):
     """Delete preview cache"""
-    preview_dir = os.path.join(settings.cache_path, "previews", preview_id)
-    
-    if os.path.exists(preview_dir):
-        import shutil
-        shutil.rmtree(preview_dir)
+    await drop_cache_entry(f"previews/{preview_id}")
     
     return {"status": "deleted"}
 
@@ -403,101 +1751,274 @@ async def delete_preview(preview_id: str):
 @app.delete("/cache/stream/{stream_id}")
 async def delete_stream(stream_id: str):
     """Delete stream cache"""
-    hls_dir = get_hls_dir(stream_id)
-    
-    if os.path.exists(hls_dir):
-        import shutil
-        shutil.rmtree(hls_dir)
-    
-    redis_client.delete(f"stream:{stream_id}")
+    await drop_cache_entry(f"hls/{stream_id}")
     
     return {"status": "deleted"}
 
 
 @app.post("/cache/cleanup")
 async def cleanup_cache(max_age_hours: int = 24):
-    """Clean up old cache files"""
-    import time
-    import shutil
+    """Remove cache entries not accessed for max_age_hours
     
-    now = time.time()
-    max_age_seconds = max_age_hours * 3600
+    Size-based eviction runs on its own in the cache manager.
+    """
+    cutoff = time.time() - max_age_hours * 3600
     deleted = 0
-    
-    for cache_type in ["hls", "previews", "thumbnails"]:
-        cache_dir = os.path.join(settings.cache_path, cache_type)
-        if not os.path.exists(cache_dir):
-            continue
-        
-        for item in os.listdir(cache_dir):
-            item_path = os.path.join(cache_dir, item)
-            try:
-                if os.path.isdir(item_path):
-                    mtime = os.path.getmtime(item_path)
-                    if now - mtime > max_age_seconds:
-                        shutil.rmtree(item_path)
-                        deleted += 1
-                elif os.path.isfile(item_path):
-                    mtime = os.path.getmtime(item_path)
-                    if now - mtime > max_age_seconds:
-                        os.remove(item_path)
-                        deleted += 1
-            except Exception:
-                pass
-    
+    for entry in await redis_client.zrangebyscore(CACHE_LRU_KEY, "-inf", cutoff):
+        await evict_cache_entry(entry)
+        deleted += 1
     return {"deleted": deleted}
 
 
-@app.get("/transmux")
-async def transmux_video(file_path: str):
-    """Transmux video file to browser-compatible MP4 format (no re-encoding video)
-    Used for MKV and other non-browser-native formats
-    """
-    if not os.path.exists(file_path):
+@app.get("/cache/stats")
+async def cache_stats():
+    """Cache usage and eviction statistics"""
+    total = int(await redis_client.get(CACHE_BYTES_KEY) or 0)
+    stats = await redis_client.hgetall(CACHE_STATS_KEY)
+    return {
+        "entries": await redis_client.zcard(CACHE_LRU_KEY),
+        "bytes": total,
+        "max_bytes": settings.cache_max_bytes,
+        "usage": round(total / settings.cache_max_bytes, 4) if settings.cache_max_bytes else 0,
+        "high_watermark_bytes": int(settings.cache_max_bytes * settings.cache_high_watermark),
+        "low_watermark_bytes": int(settings.cache_max_bytes * settings.cache_low_watermark),
+        "disk_free_bytes": await asyncio.to_thread(get_free_bytes),
+        "evictions": int(stats.get("evictions", 0)),
+        "evicted_bytes": int(stats.get("evicted_bytes", 0)),
+        "last_eviction": float(stats["last_eviction"]) if "last_eviction" in stats else None
+    }
+
+
+# ===========================================
+# Cached fMP4 transmux
+# ===========================================
+# Each source is remuxed once (video copied, audio to AAC) into a fragmented
+# MP4 in the cache, under the same single-flight lock as HLS generation.
+# Viewers read that file, so seeking is a Range request instead of a new
+# ffmpeg. While the remux runs, the growing file is followed from disk; once
+# done, ffmpeg's mfra trailer indexes every fragment for random access.
+
+TRANSMUX_NATIVE_EXTENSIONS = ("mp4", "webm")
+TRANSMUX_CHUNK_SIZE = 512 * 1024
+TRANSMUX_POLL_SECONDS = 0.25
+
+transmux_tasks = set()
+
+
+def get_transmux_dir(cache_key: str) -> str:
+    return os.path.join(settings.cache_path, "transmux", cache_key)
+
+
+def parse_range(range_header: str, size: Optional[int]) -> Optional[tuple]:
+    """(start, end) of a single "bytes=" range; end is None when open-ended"""
+    try:
+        unit, _, spec = range_header.partition("=")
+        first, _, last = spec.split(",")[0].strip().partition("-")
+        if unit.strip() != "bytes":
+            return None
+        if not first:
+            # Suffix range: the last N bytes
+            if size is None or not last:
+                return None
+            return max(size - int(last), 0), size - 1
+        start = int(first)
+        end = int(last) if last else None
+    except ValueError:
+        return None
+    if size is not None:
+        end = size - 1 if end is None else min(end, size - 1)
+    return start, end
+
+
+async def read_file_range(path: str, start: int, end: Optional[int], cache_key: str = None):
+    """Yield bytes start..end of a file, following it while a remux still writes it"""
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(start)
+        position = start
+        while end is None or position <= end:
+            limit = TRANSMUX_CHUNK_SIZE if end is None else min(TRANSMUX_CHUNK_SIZE, end - position + 1)
+            data = await f.read(limit)
+            if data:
+                position += len(data)
+                yield data
+                continue
+            if cache_key is None:
+                return
+            # At the current end of a growing file: done once the remux is
+            # finished and everything it wrote has been read
+            state = await redis_client.hgetall(f"transmux:{cache_key}")
+            if state.get("status") != "generating" and position >= int(state.get("size", position)):
+                return
+            if state.get("status") == "generating" and not await redis_client.exists(get_stream_lock_key(cache_key)):
+                return
+            await asyncio.sleep(TRANSMUX_POLL_SECONDS)
+
+
+def serve_file_range(request: Request, path: str, media_type: str,
+                     cache_control: str = "no-cache") -> Response:
+    """Serve a complete file, honouring Range and conditional requests"""
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     
-    ext = file_path.split(".")[-1].lower()
+    size = stat_result.st_size
+    etag = get_file_etag(stat_result)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+        "Access-Control-Allow-Origin": "*"
+    }
+    if is_not_modified(request, etag, stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
     
-    # For already compatible formats, just stream the file directly
-    if ext in ["mp4", "webm"]:
-        return FileResponse(file_path, media_type=f"video/{ext}")
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    byte_range = parse_range(range_header, size) if range_header else None
+    if byte_range and (if_range is None or if_range == etag):
+        start, end = byte_range
+        if start > end:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(read_file_range(path, start, end), status_code=206,
+                                 media_type=media_type, headers=headers)
+    return CachedFileResponse(path, media_type=media_type, headers=headers,
+                              stat_result=stat_result)
+
+
+def serve_growing_file(request: Request, path: str, cache_key: str) -> Response:
+    """Serve a file a remux is still writing
     
-    def generate():
+    Its total size isn't known yet, so ranges are not honoured: the response
+    is an open-ended 200 that follows the file until the remux ends, and
+    ranged requests get sized 206s once the file is finished. A range past
+    the bytes written so far is a 416 carrying the current size.
+    """
+    headers = {
+        "Accept-Ranges": "none",
+        "Cache-Control": "no-store",
+        "Access-Control-Allow-Origin": "*"
+    }
+    range_header = request.headers.get("range")
+    byte_range = parse_range(range_header, None) if range_header else None
+    written = os.path.getsize(path)
+    if byte_range and byte_range[0] >= written > 0:
+        # Not written yet: the client retries once more of the file exists
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{written}"})
+    return StreamingResponse(read_file_range(path, 0, None, cache_key),
+                             media_type="video/mp4", headers=headers)
+
+
+async def remux_to_fmp4(file_path: str, cache_key: str, token: str):
+    """Write the cached fMP4 for a source while holding its lock"""
+    heartbeat = asyncio.create_task(stream_lock_heartbeat(cache_key, token))
+    transmux_dir = get_transmux_dir(cache_key)
+    part_path = os.path.join(transmux_dir, "video.mp4.part")
+    try:
+        await asyncio.to_thread(shutil.rmtree, transmux_dir, True)
+        os.makedirs(transmux_dir, exist_ok=True)
+        await redis_client.delete(f"transmux:{cache_key}")
+        await redis_client.hset(f"transmux:{cache_key}", mapping={
+            "status": "generating",
+            "file_path": file_path
+        })
+        
         cmd = [
-            "ffmpeg",
+            "ffmpeg", "-y",
             "-i", file_path,
             "-c:v", "copy",  # Copy video stream (no re-encoding)
             "-c:a", "aac",   # Convert audio to AAC (browser compatible)
             "-b:a", "192k",
-            "-movflags", "frag_keyframe+empty_moov+faststart",
+            # Self-contained fragments at every keyframe, readable while written
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof",
             "-f", "mp4",
-            "-"
+            part_path
         ]
-        
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL,
-            bufsize=65536
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
         )
+        _, stderr = await process.communicate()
         
-        try:
-            while True:
-                chunk = process.stdout.read(65536)
-                if not chunk:
-                    break
-                yield chunk
-        finally:
-            process.terminate()
-            process.wait()
-    
-    return StreamingResponse(
-        generate(),
-        media_type="video/mp4",
-        headers={
-            "Access-Control-Allow-Origin": "*",
-        }
-    )
+        if process.returncode == 0:
+            # Renaming keeps the inode, so readers following the part file carry on
+            output_path = os.path.join(transmux_dir, "video.mp4")
+            os.replace(part_path, output_path)
+            await redis_client.hset(f"transmux:{cache_key}", mapping={
+                "status": "ready",
+                "path": output_path,
+                "size": os.path.getsize(output_path)
+            })
+            await track_cache_entry(f"transmux/{cache_key}")
+        else:
+            await redis_client.hset(f"transmux:{cache_key}", mapping={
+                "status": "failed",
+                "error": stderr.decode(errors="replace")[-500:]
+            })
+    except Exception as e:
+        await redis_client.hset(f"transmux:{cache_key}", mapping={
+            "status": "failed",
+            "error": str(e)
+        })
+    finally:
+        heartbeat.cancel()
+        await release_stream_lock(cache_key, token)
+
+
+async def wait_for_transmux(cache_key: str, path: str, timeout: float) -> dict:
+    """Wait until the remux has written its first bytes; returns its state"""
+    deadline = time.monotonic() + timeout
+    while True:
+        state = await redis_client.hgetall(f"transmux:{cache_key}")
+        if state.get("status") != "generating":
+            return state
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            return state
+        if time.monotonic() >= deadline or not await redis_client.exists(get_stream_lock_key(cache_key)):
+            return state
+        await asyncio.sleep(TRANSMUX_POLL_SECONDS)
+
+
+@app.get("/transmux")
+async def transmux_video(file_path: str, request: Request):
+    """Transmux video file to browser-compatible MP4 format (no re-encoding video)
+    Used for MKV and other non-browser-native formats
+    """
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    ext = file_path.split(".")[-1].lower()
+    
+    # For already compatible formats, just serve the file directly
+    if ext in TRANSMUX_NATIVE_EXTENSIONS:
+        return serve_file_range(request, file_path, f"video/{ext}")
+    
+    cache_key = await get_cache_key(file_path, "transmux")
+    output_path = os.path.join(get_transmux_dir(cache_key), "video.mp4")
+    state = await redis_client.hgetall(f"transmux:{cache_key}")
+    if state.get("status") != "ready" or not os.path.exists(output_path):
+        token = await acquire_stream_lock(cache_key)
+        if token:
+            # Don't let the wait below see the previous run's state
+            await redis_client.hset(f"transmux:{cache_key}", "status", "generating")
+            task = asyncio.create_task(remux_to_fmp4(file_path, cache_key, token))
+            transmux_tasks.add(task)
+            task.add_done_callback(transmux_tasks.discard)
+        part_path = f"{output_path}.part"
+        state = await wait_for_transmux(cache_key, part_path, settings.playlist_wait_seconds)
+        if state.get("status") == "failed":
+            raise HTTPException(status_code=500, detail=f"Transmux failed: {state.get('error', '')[:200]}")
+        if state.get("status") == "generating" and os.path.exists(part_path):
+            return serve_growing_file(request, part_path, cache_key)
+        if not os.path.exists(output_path):
+            raise HTTPException(status_code=503, detail="Transmux is starting, retry shortly")
+    
+    await touch_cache_entry(f"transmux/{cache_key}")
+    return serve_file_range(request, output_path, "video/mp4")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+"""
+AllOne Streamer - segment serving benchmark
+Measures HLS segment requests per second, and per CPU core of the service
+
+Writes a synthetic stream straight into the cache directory, then hammers its
+segments with full and conditional (If-None-Match) GETs. CPU time is read
+from /proc for the uvicorn processes, so run it inside the streamer container:
+
+    docker compose exec -T streamer python - --seconds 20 < services/streamer/benchmarks/segment_serving.py
+"""
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import argparse
+import httpx
+
+
+def make_stream(cache_path: str, segments: int, segment_bytes: int) -> str:
+    stream_id = f"bench_{uuid.uuid4().hex[:8]}"
+    hls_dir = os.path.join(cache_path, "hls", stream_id)
+    os.makedirs(hls_dir)
+    for index in range(segments):
+        with open(os.path.join(hls_dir, f"segment_{index:03d}.ts"), "wb") as f:
+            f.write(os.urandom(segment_bytes))
+    return stream_id
+
+
+def server_cpu_seconds() -> float:
+    """User + system CPU time of every uvicorn process visible in /proc"""
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                if b"uvicorn" not in f.read():
+                    continue
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / ticks
+        except OSError:
+            pass
+    return total
+
+
+async def hammer(client: httpx.AsyncClient, urls: list, seconds: float,
+                 concurrency: int, conditional: bool) -> tuple:
+    """Request segments round-robin; returns (requests, bytes, status counts)"""
+    etags = {}
+    if conditional:
+        for url in urls:
+            etags[url] = (await client.get(url)).headers["etag"]
+
+    deadline = time.perf_counter() + seconds
+    counts = {"requests": 0, "bytes": 0}
+    statuses = {}
+
+    async def worker(offset: int):
+        index = offset
+        while time.perf_counter() < deadline:
+            url = urls[index % len(urls)]
+            index += 1
+            headers = {"If-None-Match": etags[url]} if conditional else None
+            response = await client.get(url, headers=headers)
+            counts["requests"] += 1
+            counts["bytes"] += len(response.content)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return counts["requests"], counts["bytes"], statuses
+
+
+async def main(args):
+    stream_id = make_stream(args.cache_path, args.segments, args.segment_kb * 1024)
+    urls = [f"/stream/{stream_id}/segment_{i:03d}.ts" for i in range(args.segments)]
+    limits = httpx.Limits(max_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=30) as client:
+            for conditional in (False, True):
+                cpu_before = server_cpu_seconds()
+                started = time.perf_counter()
+                requests, sent, statuses = await hammer(client, urls, args.seconds,
+                                                        args.concurrency, conditional)
+                elapsed = time.perf_counter() - started
+                cpu = server_cpu_seconds() - cpu_before
+                label = "conditional (304)" if conditional else "full segments"
+                print(f"{label:<18} {requests / elapsed:8.0f} req/s  "
+                      f"{requests / cpu if cpu else 0:8.0f} req/s per core  "
+                      f"{sent * 8 / elapsed / 1e6:8.0f} Mbit/s  statuses {statuses}")
+    finally:
+        shutil.rmtree(os.path.join(args.cache_path, "hls", stream_id), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[1])
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--cache-path", default="/app/cache")
+    parser.add_argument("--segments", type=int, default=50)
+    parser.add_argument("--segment-kb", type=int, default=1024, help="Size of each segment")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=32)
+    asyncio.run(main(parser.parse_args()))
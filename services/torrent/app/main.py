@@ -7,6 +7,8 @@ import uuid
 import asyncio
 import json
 import hashlib
+import hmac
+import time
 import tempfile
 from typing import Optional, List
 from datetime import datetime, timezone
@@ -15,10 +17,9 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
-import redis
+import redis.asyncio as aioredis
 import httpx
 import aiofiles
-import pusher
 
 # Try to import libtorrent, fallback to mock if not available
 try:
@@ -40,6 +41,10 @@ class Settings(BaseSettings):
     pusher_secret: str = "allone-secret"
     pusher_host: str = "websocket"
     pusher_port: int = 6001
+    pusher_timeout: float = 5.0
+    redis_max_connections: int = 50
+    redis_socket_timeout: float = 5.0
+    max_torrent_file_bytes: int = 10 * 1024 ** 2
     
     class Config:
         env_file = ".env"
@@ -57,21 +62,82 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Redis connection
-redis_client = redis.Redis(
-    host=settings.redis_host,
-    port=settings.redis_port,
-    decode_responses=True
+# Redis connection (async, pooled)
+redis_client = aioredis.Redis(
+    connection_pool=aioredis.ConnectionPool(
+        host=settings.redis_host,
+        port=settings.redis_port,
+        decode_responses=True,
+        max_connections=settings.redis_max_connections,
+        socket_timeout=settings.redis_socket_timeout,
+        socket_connect_timeout=2,
+        socket_keepalive=True,
+        health_check_interval=30,
+        retry_on_timeout=True
+    )
 )
 
+
+class AsyncPusher:
+    """Async Pusher HTTP API client with keep-alive connections and timeouts"""
+    
+    def __init__(self, app_id: str, key: str, secret: str, host: str,
+                 port: int, ssl: bool = False, timeout: float = 5.0):
+        self.app_id = app_id
+        self.key = key
+        self.secret = secret
+        scheme = "https" if ssl else "http"
+        self.client = httpx.AsyncClient(
+            base_url=f"{scheme}://{host}:{port}",
+            timeout=httpx.Timeout(timeout, connect=2.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10,
+                                keepalive_expiry=30)
+        )
+    
+    def _sign(self, path: str, body: bytes) -> dict:
+        params = {
+            "auth_key": self.key,
+            "auth_timestamp": str(int(time.time())),
+            "auth_version": "1.0",
+            "body_md5": hashlib.md5(body).hexdigest()
+        }
+        query = "&".join(f"{k}={params[k]}" for k in sorted(params))
+        string_to_sign = f"POST\n{path}\n{query}"
+        params["auth_signature"] = hmac.new(
+            self.secret.encode(), string_to_sign.encode(), hashlib.sha256
+        ).hexdigest()
+        return params
+    
+    async def _post(self, path: str, payload: dict):
+        body = json.dumps(payload).encode()
+        response = await self.client.post(
+            path,
+            content=body,
+            params=self._sign(path, body),
+            headers={"Content-Type": "application/json"}
+        )
+        response.raise_for_status()
+    
+    async def trigger(self, channel: str, event_name: str, data: dict):
+        await self._post(f"/apps/{self.app_id}/events", {
+            "name": event_name,
+            "channels": [channel],
+            "data": json.dumps(data)
+        })
+    
+    async def aclose(self):
+        await self.client.aclose()
+
+
 # Pusher client for broadcasting
-pusher_client = pusher.Pusher(
+pusher_client = AsyncPusher(
     app_id=settings.pusher_app_id,
     key=settings.pusher_key,
     secret=settings.pusher_secret,
     host=settings.pusher_host,
     port=settings.pusher_port,
-    ssl=False
+    ssl=False,
+    timeout=settings.pusher_timeout
 )
 
 # Torrent session
@@ -125,11 +191,11 @@ def get_job_key(job_id: str) -> str:
     return f"torrent:job:{job_id}"
 
 
-def broadcast_job_update(job_id: str, status: str, progress: float = 0,
-                         file_name: str = None, error: str = None,
-                         thumbnail: str = None, download_rate: float = 0,
-                         upload_rate: float = 0, num_peers: int = 0, 
-                         num_seeds: int = 0, files: list = None):
+async def broadcast_job_update(job_id: str, status: str, progress: float = 0,
+                               file_name: str = None, error: str = None,
+                               thumbnail: str = None, download_rate: float = 0,
+                               upload_rate: float = 0, num_peers: int = 0, 
+                               num_seeds: int = 0, files: list = None):
     """Broadcast job update via Pusher/Soketi"""
     try:
         # Convert thumbnail path to URL if it exists
@@ -155,12 +221,12 @@ def broadcast_job_update(job_id: str, status: str, progress: float = 0,
             },
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
-        pusher_client.trigger('jobs', 'job.updated', event_data)
+        await pusher_client.trigger('jobs', 'job.updated', event_data)
     except Exception as e:
         print(f"Failed to broadcast torrent job update: {e}")
 
 
-def update_job_status(job_id: str, data: dict):
+async def update_job_status(job_id: str, data: dict):
     """Update job status in Redis and broadcast via WebSocket"""
     # Get data before JSON serialization
     file_name = data.get("name")
@@ -180,14 +246,15 @@ def update_job_status(job_id: str, data: dict):
         if isinstance(value, (list, dict)):
             data_for_redis[key] = json.dumps(value)
     
-    redis_client.hset(get_job_key(job_id), mapping=data_for_redis)
-    redis_client.expire(get_job_key(job_id), 86400 * 7)  # 7 days expiry
-    
-    # Publish status update via Redis
-    redis_client.publish(f"torrent:status:{job_id}", json.dumps(data_for_redis))
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(get_job_key(job_id), mapping=data_for_redis)
+        pipe.expire(get_job_key(job_id), 86400 * 7)  # 7 days expiry
+        # Publish status update via Redis
+        pipe.publish(f"torrent:status:{job_id}", json.dumps(data_for_redis))
+        await pipe.execute()
     
     # Broadcast via Pusher/WebSocket with all data
-    broadcast_job_update(job_id, status, progress, file_name, error, thumbnail,
+    await broadcast_job_update(job_id, status, progress, file_name, error, thumbnail,
                          download_rate, upload_rate, num_peers, num_seeds, files)
 
 def get_session():
@@ -242,7 +309,7 @@ async def monitor_torrent_metadata(job_id: str, handle):
                         "progress": 0
                     })
                 
-                update_job_status(job_id, {
+                await update_job_status(job_id, {
                     "job_id": job_id,
                     "status": "waiting_selection",
                     "progress": 0,
@@ -255,7 +322,7 @@ async def monitor_torrent_metadata(job_id: str, handle):
             await asyncio.sleep(1)
             
         except Exception as e:
-            update_job_status(job_id, {
+            await update_job_status(job_id, {
                 "job_id": job_id,
                 "status": "failed",
                 "progress": 0,
@@ -316,14 +383,17 @@ async def on_torrent_complete(job_id: str, handle, convert_to: str = None):
         print(f"on_torrent_complete error: {e}")
 
 
-async def generate_thumbnail_via_streamer(job_id: str, file_path: str, time: str = "00:00:10"):
-    """Generate thumbnail using the streamer service"""
+async def generate_thumbnail_via_streamer(job_id: str, file_path: str, time: str = "auto"):
+    """Generate thumbnail using the streamer service
+    
+    "auto" lets the streamer's frame analysis skip black frames and logos.
+    """
     try:
         async with httpx.AsyncClient() as client:
             response = await client.get(
                 f"{settings.streamer_service_url}/thumbnail",
                 params={"file_path": file_path, "time": time},
-                timeout=30
+                timeout=120
             )
             if response.status_code == 200:
                 # Save thumbnail locally with job_id name
@@ -334,7 +404,7 @@ async def generate_thumbnail_via_streamer(job_id: str, file_path: str, time: str
                 async with aiofiles.open(thumbnail_path, 'wb') as f:
                     await f.write(response.content)
                 
-                update_job_status(job_id, {"thumbnail": f"/api/thumbnails/{job_id}.jpg"})
+                await update_job_status(job_id, {"thumbnail": f"/api/thumbnails/{job_id}.jpg"})
                 print(f"Thumbnail generated for {job_id}")
     except Exception as e:
         print(f"Thumbnail generation failed: {e}")
@@ -355,7 +425,7 @@ async def start_conversion(job_id: str, input_path: str, output_format: str):
                 timeout=30
             )
             if response.status_code == 200:
-                update_job_status(job_id, {"status": "converting"})
+                await update_job_status(job_id, {"status": "converting"})
                 print(f"Conversion started for {job_id}")
     except Exception as e:
         print(f"Conversion start failed: {e}")
@@ -410,7 +480,7 @@ async def monitor_torrent(job_id: str, handle, convert_to: str = None):
             torrent_status = state_map.get(status.state, "unknown")
             progress = status.progress * 100
             
-            update_job_status(job_id, {
+            await update_job_status(job_id, {
                 "job_id": job_id,
                 "status": torrent_status,
                 "progress": progress,
@@ -432,7 +502,7 @@ async def monitor_torrent(job_id: str, handle, convert_to: str = None):
                     if is_media_file(f.get("name", "")) and f.get("priority", 0) > 0:
                         file_path = os.path.join(download_dir, f["name"])
                         if os.path.exists(file_path) and os.path.getsize(file_path) > 1024 * 1024:  # >1MB
-                            asyncio.create_task(generate_thumbnail_via_streamer(job_id, file_path, "00:00:05"))
+                            asyncio.create_task(generate_thumbnail_via_streamer(job_id, file_path))
                             thumbnail_generated = True
                             break
             
@@ -444,7 +514,7 @@ async def monitor_torrent(job_id: str, handle, convert_to: str = None):
             await asyncio.sleep(1)
             
         except Exception as e:
-            update_job_status(job_id, {
+            await update_job_status(job_id, {
                 "job_id": job_id,
                 "status": "failed",
                 "progress": 0,
@@ -458,7 +528,7 @@ async def add_torrent_from_magnet(job_id: str, magnet_url: str):
     session = get_session()
     
     if not session:
-        update_job_status(job_id, {
+        await update_job_status(job_id, {
             "job_id": job_id,
             "status": "failed",
             "error": "libtorrent not available"
@@ -477,7 +547,7 @@ async def add_torrent_from_magnet(job_id: str, magnet_url: str):
         handle = session.add_torrent(params)
         active_torrents[job_id] = handle
         
-        update_job_status(job_id, {
+        await update_job_status(job_id, {
             "job_id": job_id,
             "status": "metadata",
             "progress": 0,
@@ -490,7 +560,7 @@ async def add_torrent_from_magnet(job_id: str, magnet_url: str):
         asyncio.create_task(monitor_torrent_metadata(job_id, handle))
         
     except Exception as e:
-        update_job_status(job_id, {
+        await update_job_status(job_id, {
             "job_id": job_id,
             "status": "failed",
             "error": str(e)
@@ -502,7 +572,7 @@ async def add_torrent_from_file(job_id: str, torrent_path: str):
     session = get_session()
     
     if not session:
-        update_job_status(job_id, {
+        await update_job_status(job_id, {
             "job_id": job_id,
             "status": "failed",
             "error": "libtorrent not available"
@@ -538,7 +608,7 @@ async def add_torrent_from_file(job_id: str, torrent_path: str):
                 "progress": 0
             })
         
-        update_job_status(job_id, {
+        await update_job_status(job_id, {
             "job_id": job_id,
             "status": "waiting_selection",
             "progress": 0,
@@ -550,7 +620,7 @@ async def add_torrent_from_file(job_id: str, torrent_path: str):
         # Don't start monitoring yet - wait for file selection
         
     except Exception as e:
-        update_job_status(job_id, {
+        await update_job_status(job_id, {
             "job_id": job_id,
             "status": "failed",
             "error": str(e)
@@ -601,6 +671,12 @@ def parse_torrent_file(torrent_data: bytes) -> dict:
         raise HTTPException(status_code=400, detail=f"Invalid torrent file: {str(e)}")
 
 
+@app.on_event("shutdown")
+async def close_clients():
+    await pusher_client.aclose()
+    await redis_client.aclose()
+
+
 @app.get("/")
 async def root():
     return {
@@ -614,7 +690,7 @@ async def root():
 @app.get("/health")
 async def health():
     try:
-        redis_client.ping()
+        await redis_client.ping()
         return {
             "status": "healthy",
             "redis": "connected",
@@ -653,10 +729,25 @@ async def add_torrent_file(
     os.makedirs(torrent_dir, exist_ok=True)
     
     torrent_path = os.path.join(torrent_dir, f"{job_id}.torrent")
+    part_path = f"{torrent_path}.part"
     
-    content = await file.read()
-    async with aiofiles.open(torrent_path, 'wb') as f:
-        await f.write(content)
+    # Copy in chunks with a size cap, then rename so readers never see a partial file
+    size = 0
+    try:
+        async with aiofiles.open(part_path, 'wb') as f:
+            while True:
+                chunk = await file.read(64 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > settings.max_torrent_file_bytes:
+                    raise HTTPException(status_code=413, detail="Torrent file too large")
+                await f.write(chunk)
+        os.replace(part_path, torrent_path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
     
     background_tasks.add_task(add_torrent_from_file, job_id, torrent_path)
     
@@ -712,7 +803,7 @@ async def parse_magnet(magnet_url: str):
 @app.get("/status/{job_id}")
 async def get_status(job_id: str):
     """Get torrent status"""
-    job_data = redis_client.hgetall(get_job_key(job_id))
+    job_data = await redis_client.hgetall(get_job_key(job_id))
     
     if not job_data:
         raise HTTPException(status_code=404, detail="Job not found")
@@ -762,7 +853,7 @@ async def select_files(request: FileSelectRequest, background_tasks: BackgroundT
     handle.resume()
     
     # Update status
-    update_job_status(request.job_id, {
+    await update_job_status(request.job_id, {
         "status": "downloading",
         "waiting_selection": "",
         "convert_to": request.convert_to or ""
@@ -783,7 +874,7 @@ async def pause_torrent(job_id: str):
     handle = active_torrents[job_id]
     handle.pause()
     
-    update_job_status(job_id, {"status": "paused"})
+    await update_job_status(job_id, {"status": "paused"})
     
     return {"status": "paused"}
 
@@ -797,7 +888,7 @@ async def resume_torrent(job_id: str):
     handle = active_torrents[job_id]
     handle.resume()
     
-    update_job_status(job_id, {"status": "downloading"})
+    await update_job_status(job_id, {"status": "downloading"})
     
     return {"status": "resumed"}
 
@@ -819,7 +910,7 @@ async def remove_torrent(job_id: str):
     if os.path.exists(download_dir):
         shutil.rmtree(download_dir, ignore_errors=True)
     
-    redis_client.delete(get_job_key(job_id))
+    await redis_client.delete(get_job_key(job_id))
     
     return {"status": "removed"}
 
@@ -853,8 +944,13 @@ async def list_torrents():
     seen_ids = set()
     
     # First, get active torrents from memory
-    for job_id in active_torrents:
-        job_data = redis_client.hgetall(get_job_key(job_id))
+    active_ids = list(active_torrents)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for job_id in active_ids:
+            pipe.hgetall(get_job_key(job_id))
+        active_data = await pipe.execute()
+    
+    for job_id, job_data in zip(active_ids, active_data):
         if job_data:
             seen_ids.add(job_id)
             torrents.append({
@@ -870,21 +966,27 @@ async def list_torrents():
     
     # Also scan Redis for any completed torrents not in active_torrents
     # This ensures completed torrents remain visible
-    for key in redis_client.scan_iter(match="torrent:job:*"):
-        job_id = key.replace("torrent:job:", "")
-        if job_id not in seen_ids:
-            job_data = redis_client.hgetall(key)
-            if job_data:
-                torrents.append({
-                    "job_id": job_id,
-                    "name": job_data.get("name", "Unknown"),
-                    "status": job_data.get("status", "unknown"),
-                    "progress": float(job_data.get("progress", 0)),
-                    "download_rate": 0,
-                    "upload_rate": 0,
-                    "num_peers": 0,
-                    "num_seeds": 0,
-                })
+    other_keys = [
+        key async for key in redis_client.scan_iter(match="torrent:job:*", count=500)
+        if key.replace("torrent:job:", "") not in seen_ids
+    ]
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key in other_keys:
+            pipe.hgetall(key)
+        other_data = await pipe.execute()
+    
+    for key, job_data in zip(other_keys, other_data):
+        if job_data:
+            torrents.append({
+                "job_id": key.replace("torrent:job:", ""),
+                "name": job_data.get("name", "Unknown"),
+                "status": job_data.get("status", "unknown"),
+                "progress": float(job_data.get("progress", 0)),
+                "download_rate": 0,
+                "upload_rate": 0,
+                "num_peers": 0,
+                "num_seeds": 0,
+            })
     
     return {"torrents": torrents}
 
@@ -894,7 +996,7 @@ async def stream_torrent_file(job_id: str, file_index: int, request: Request):
     """Stream a file from torrent (supports partial downloads)"""
     
     # Get job info from Redis
-    job_data = redis_client.hgetall(get_job_key(job_id))
+    job_data = await redis_client.hgetall(get_job_key(job_id))
     if not job_data:
         raise HTTPException(status_code=404, detail="Job not found")
     
@@ -1000,7 +1102,7 @@ async def stream_torrent_file_compat(job_id: str, file_index: int, request: Requ
     Redirects to streamer's transmux endpoint for MKV and other formats
     """
     # Get job info from Redis
-    job_data = redis_client.hgetall(get_job_key(job_id))
+    job_data = await redis_client.hgetall(get_job_key(job_id))
     if not job_data:
         raise HTTPException(status_code=404, detail="Job not found")
     
@@ -1032,23 +1134,48 @@ async def stream_torrent_file_compat(job_id: str, file_index: int, request: Requ
         # Use normal stream endpoint
         return await stream_torrent_file(job_id, file_index, request)
     
-    # For MKV and other formats, proxy to streamer service
-    async def proxy_stream():
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream(
+    # For MKV and other formats, proxy to the streamer's cached transmux.
+    # Range and validators are forwarded so seeks are served from its cache.
+    forward_headers = {
+        name: request.headers[name]
+        for name in ("range", "if-range", "if-none-match", "if-modified-since")
+        if name in request.headers
+    }
+    client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=5.0))
+    try:
+        upstream = await client.send(
+            client.build_request(
                 "GET",
                 f"{settings.streamer_service_url}/transmux",
-                params={"file_path": file_path}
-            ) as response:
-                async for chunk in response.aiter_bytes(65536):
-                    yield chunk
+                params={"file_path": file_path},
+                headers=forward_headers
+            ),
+            stream=True
+        )
+    except httpx.HTTPError as e:
+        await client.aclose()
+        raise HTTPException(status_code=502, detail=f"Streamer unavailable: {e}")
     
+    async def proxy_stream():
+        try:
+            async for chunk in upstream.aiter_bytes(65536):
+                yield chunk
+        finally:
+            await upstream.aclose()
+            await client.aclose()
+    
+    headers = {
+        name: upstream.headers[name]
+        for name in ("content-range", "content-length", "accept-ranges",
+                     "etag", "last-modified", "cache-control")
+        if name in upstream.headers
+    }
+    headers["Access-Control-Allow-Origin"] = "*"
     return StreamingResponse(
         proxy_stream(),
-        media_type="video/mp4",
-        headers={
-            "Access-Control-Allow-Origin": "*",
-        }
+        status_code=upstream.status_code,
+        media_type=upstream.headers.get("content-type", "video/mp4"),
+        headers=headers
     )
 
 